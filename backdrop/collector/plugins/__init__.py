@@ -2,11 +2,129 @@
 from pkgutil import extend_path
 __path__ = extend_path(__path__, __name__)
 
-from .aggregate import AggregateKey, aggregate_count, aggregate_rate
-from .comment import Comment
-from .compute_id import ComputeIdFrom
-from .department import ComputeDepartmentKey, SetDepartment
-from .rank import ComputeRank
-from .remove_key import RemoveKey
-
-from .load_plugin import load_plugins
+# Plugin modules are imported when one of their names is first used, so a
+# collector only pays for the plugins its configuration mentions.
+import sys
+from importlib import import_module
+from types import ModuleType
+
+# The names exported by the package, and the modules they live in
+_EXPORTS = {
+    "AggregateKey": ".aggregate",
+    "aggregate_count": ".aggregate",
+    "aggregate_rate": ".aggregate",
+    "BatchForBackdrop": ".batch",
+    "ColumnBatch": ".columnar",
+    "Comment": ".comment",
+    "ComputeDepartmentKey": ".department",
+    "ComputeDepartments": ".department",
+    "ExplodeDepartments": ".department",
+    "Deduplicate": ".deduplicate",
+    "SetDepartment": ".department",
+    "SortBy": ".sort",
+    "ComputeIdFrom": ".compute_id",
+    "ComputeRank": ".rank",
+    "Filter": ".filter",
+    "RemoveKey": ".remove_key",
+    "TopN": ".top_n",
+    "record_type": ".record",
+    "records": ".record",
+    "HTTPSink": ".overlap",
+    "Instrumentation": ".instrument",
+    "LogReporter": ".instrument",
+    "StatsdReporter": ".instrument",
+    "OverlappedRunner": ".overlap",
+    "ParallelExecutor": ".parallel",
+    "explain": ".optimise",
+    "optimise_plugins": ".optimise",
+    "Pipeline": ".pipeline",
+    "load_pipeline": ".load_plugin",
+    "load_plugins": ".load_plugin",
+}
+
+__all__ = sorted(_EXPORTS)
+
+# The names which plugin strings may call: plugins and aggregation functions,
+# but not the machinery for loading and running them
+PLUGIN_NAMES = frozenset([
+    "AggregateKey",
+    "aggregate_count",
+    "aggregate_rate",
+    "BatchForBackdrop",
+    "Comment",
+    "ComputeDepartmentKey",
+    "ComputeDepartments",
+    "ComputeIdFrom",
+    "ComputeRank",
+    "Deduplicate",
+    "ExplodeDepartments",
+    "Filter",
+    "RemoveKey",
+    "SetDepartment",
+    "SortBy",
+    "TopN",
+])
+
+
+class LazyModule(ModuleType):
+    """
+    The package module, which imports each of `_EXPORTS` from its module on
+    first access.
+    """
+
+    def __getattr__(self, name):
+        try:
+            module_name = _EXPORTS[name]
+        except KeyError:
+            raise AttributeError("module {0!r} has no attribute {1!r}".format(
+                __name__, name))
+        value = getattr(import_module(module_name, __name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_EXPORTS))
+
+
+def _make_lazy(module):
+    try:
+        module.__class__ = LazyModule
+    except TypeError:
+        # Python 2 modules cannot change class, so replace this one, keeping
+        # it alive so that the globals used above are not cleared.
+        lazy = LazyModule(module.__name__, module.__doc__)
+        lazy.__dict__.update(module.__dict__)
+        lazy._original_module = module
+        sys.modules[module.__name__] = lazy
+
+
+def test_plugins_are_imported_lazily():
+    import subprocess
+    from nose.tools import assert_equal
+
+    script = "; ".join([
+        "import sys",
+        "from backdrop.collector.plugins import RemoveKey",
+        "print(RemoveKey('a')([{'a': 1, 'b': 2}]))",
+        "print(sorted(name for name in ['numpy', 'pytz', 'multiprocessing',"
+        " 'backdrop.collector.plugins.department'] if name in sys.modules))",
+    ])
+    output = subprocess.check_output([sys.executable, "-c", script])
+    assert_equal(output.decode("ascii").split("\n")[:2],
+                 ["[{'b': 2}]", "[]"])
+
+
+def test_LazyModule():
+    from nose.tools import assert_equal, assert_in, assert_is, assert_raises
+    import backdrop.collector.plugins as plugins
+    from backdrop.collector.plugins.rank import ComputeRank
+
+    assert_is(plugins.ComputeRank, ComputeRank)
+    assert_in("ComputeRank", dir(plugins))
+    with assert_raises(AttributeError):
+        plugins.NoSuchPlugin
+    assert_equal(sorted(PLUGIN_NAMES - set(_EXPORTS)), [])
+
+
+# Last, so that Python 2 copies everything above into the replacement
+_make_lazy(sys.modules[__name__])
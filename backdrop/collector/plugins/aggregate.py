@@ -1,6 +1,10 @@
 from __future__ import division
 
 from itertools import groupby
+from operator import itemgetter
+
+from .columnar import ColumnBatch, aggregate_columns
+from .pipeline import DEFAULT_CHUNK_SIZE, chunked
 
 
 class AggregateKey(object):
@@ -20,22 +24,325 @@ class AggregateKey(object):
 
     Aggregate rates are also supported through
     `aggregate_rate(rate_key, count_key)`.
+
+    Documents are folded into one accumulator per key in a single pass, so
+    `documents` may be any iterable. Output is ordered by key.
+
+    With `state_path="/path/to/file"`, the partial aggregates are kept in
+    an `AggregateStore` between runs, and only new or changed documents are
+    folded in; see `aggregate_store.py`.
+
+    With `max_groups=N` or `max_bytes=N`, at most about that many groups (or
+    bytes of groups) are kept in memory, and the rest are hash-partitioned
+    into temporary files in `temp_dir`; see `aggregate_spill.py`. The output
+    is the same.
+
+    To aggregate documents as they arrive, for example one page of GA results
+    at a time, fold each page into an `AggregateState`:
+
+        state = plugin.start()
+        for page in pages:
+            state.update(page)
+        documents = state.finalize()
     """
 
-    def __init__(self, *aggregations):
+    def __init__(self, *aggregations, **options):
         self.aggregations = aggregations
+        self.aggregators = [as_aggregator(aggregation)
+                            for aggregation in aggregations]
+
+        state_path = options.pop("state_path", None)
+        self.emit = options.pop("emit", "changed")
+        self.max_groups = options.pop("max_groups", None)
+        self.max_bytes = options.pop("max_bytes", None)
+        self.temp_dir = options.pop("temp_dir", None)
+        if options:
+            raise TypeError("AggregateKey got unexpected keyword arguments "
+                            "{0}".format(", ".join(sorted(options))))
+
+        self.spills = self.max_groups is not None or self.max_bytes is not None
+        if self.spills and state_path is not None:
+            raise ValueError("AggregateKey cannot both keep its state in a "
+                             "store and spill it to disk")
+
+        self.store = None
+        if state_path is not None:
+            from .aggregate_store import AggregateStore
+            self.store = AggregateStore(state_path)
+
+    # Documents are grouped by every key which is not aggregated, so the
+    # output depends on all of the keys of the input.
+    reads = None
+
+    def filter_commutes(self, keys):
+        """
+        Whether dropping documents by the values of `keys` before aggregating
+        gives the same output as dropping the aggregated documents after: so
+        when none of `keys` are aggregated, since every document of a group
+        has the same values of all the other keys.
+        """
+        aggregated = set(aggregator.key for aggregator in self.aggregators)
+        return self.store is None and not aggregated & set(keys)
+
+    @property
+    def mergeable(self):
+        """
+        Whether `partial` and `merge` can be used: not when the state is
+        being kept in a store or spilled to disk.
+        """
+        return self.store is None and not self.spills
 
     def __call__(self, documents):
-        first = documents[0]
+        if isinstance(documents, ColumnBatch):
+            if self.store is None and not self.spills:
+                return aggregate_columns(documents, self.aggregators)
+            # The store and spilling work on documents
+            return ColumnBatch.from_documents(self(documents.to_documents()))
+        if self.store is not None:
+            return self.store.fold(self.aggregators, documents, self.emit)
+        return self.start().update(documents).finalize()
+
+    def start(self):
+        if self.spills:
+            from .aggregate_spill import SpillingState
+            return SpillingState(self.aggregators, self.max_groups,
+                                 self.max_bytes, temp_dir=self.temp_dir)
+        return AggregateState(self.aggregators)
+
+    def stream(self, chunks):
+        if self.store is not None:
+            output = self([document for chunk in chunks for document in chunk])
+        else:
+            state = self.start()
+            for documents in chunks:
+                state.update(documents)
+            output = state.generate() if self.spills else state.finalize()
+
+        # Hand on the output a chunk at a time, rather than all at once
+        for chunk in chunked(output, DEFAULT_CHUNK_SIZE):
+            yield chunk
+
+    def partial(self, documents):
+        """
+        Return the unfinished `AggregateState` of `documents`, to be combined
+        with those of the documents before and after them using `merge`.
+
+        Aggregators which declare their `inputs` (as `Rate` does) only
+        record them, to be folded in by `merge` in input order, so that sums
+        of floats are added up in the same order as when aggregating all at
+        once. Others, such as `Count`, keep their running state, and only
+        that is merged.
+        """
+        return AggregateState(self.partial_aggregators()).update(documents)
+
+    def merge(self, partials):
+        """
+        Combine partial states, given in input order, into the documents
+        which aggregating all of their input at once would give.
+        """
+        state = AggregateState(self.partial_aggregators())
+        for partial in partials:
+            state.merge(partial)
+        return state.finalize()
+
+    def partial_aggregators(self):
+        return [aggregator if aggregator.inputs is None else
+                Replay(aggregator) for aggregator in self.aggregators]
+
+
+def aggregate(documents, aggregations):
+    """
+    Aggregate `documents` using `aggregations`, which are `Aggregator`s or
+    `(keyname, aggregation_function)` pairs.
+    """
+    aggregators = [as_aggregator(aggregation) for aggregation in aggregations]
+    return AggregateState(aggregators).update(documents).finalize()
 
-        aggregate_keys = [k for k, _ in self.aggregations]
-        groupkeys = set(first) - set(aggregate_keys)
 
-        def key(doc):
-            return tuple(doc[key] for key in groupkeys)
+class AggregateState(object):
 
-        return [make_aggregate(grouped, self.aggregations)
-                for grouped in group(documents, key)]
+    """
+    The accumulators of a hash aggregation which is still in progress.
+
+    The key is computed from the first document: all of its keys which are
+    not being aggregated over. Each group is a `[first_doc, state...]` list
+    holding one state per aggregator.
+
+    Input which is already sorted by key (as GA usually returns it) never
+    touches the hash table or the final sort.
+    """
+
+    def __init__(self, aggregators):
+        self.aggregators = aggregators
+        self.groupkeys = None
+        self.groups = {}
+        # (key, group) in key order, for as long as the input is sorted
+        self.in_order = []
+        self.current_key = self.current = None
+
+    def update(self, documents):
+        """
+        Fold `documents` (any iterable) into the state, returning it.
+        """
+        documents = iter(documents)
+        if self.groupkeys is None:
+            try:
+                first = next(documents)
+            except StopIteration:
+                return self
+            self.start(first)
+            self.update_group(self.current, first)
+
+        groupkeys = self.groupkeys
+        groups = self.groups
+        in_order = self.in_order
+        current_key, current = self.current_key, self.current
+        update_group, new_group = self.update_group, self.new_group
+
+        for doc in documents:
+            doc_key = tuple([doc[key] for key in groupkeys])
+
+            if doc_key == current_key:
+                update_group(current, doc)
+                continue
+
+            group = groups.get(doc_key)
+            if group is None:
+                group = groups[doc_key] = new_group(doc)
+                if in_order is not None:
+                    if doc_key > current_key:
+                        in_order.append((doc_key, group))
+                    else:
+                        in_order = None
+            elif in_order is not None:
+                # Revisiting an earlier key means the input is not sorted.
+                in_order = None
+
+            current_key, current = doc_key, group
+            update_group(current, doc)
+
+        self.in_order = in_order
+        self.current_key, self.current = current_key, current
+        return self
+
+    def start(self, first):
+        aggregate_keys = [aggregator.key for aggregator in self.aggregators]
+        self.groupkeys = tuple(set(first) - set(aggregate_keys))
+        self.steps = list(enumerate([aggregator.update
+                                     for aggregator in self.aggregators], 1))
+        self.current_key = tuple(first[key] for key in self.groupkeys)
+        self.current = self.groups[self.current_key] = self.new_group(first)
+        self.in_order.append((self.current_key, self.current))
+
+    def resume(self, groupkeys, groups):
+        """
+        Carry on folding documents into `groups`, `(key, group)` pairs made
+        by another state grouping by `groupkeys`, returning this state.
+        """
+        self.groupkeys = groupkeys
+        self.steps = list(enumerate([aggregator.update
+                                     for aggregator in self.aggregators], 1))
+        self.groups = dict(groups)
+        self.in_order = None
+        self.current_key = self.current = None
+        return self
+
+    def new_group(self, doc):
+        return [doc] + [aggregator.init() for aggregator in self.aggregators]
+
+    def update_group(self, group, doc):
+        for i, step in self.steps:
+            group[i] = step(group[i], doc)
+
+    def merge(self, other):
+        """
+        Fold in `other`, the state of documents which came after those of
+        this one, returning this state.
+
+        Each group's states are combined with the aggregators' `merge`, so
+        sums of floats are added up in a different order than by folding
+        all of the documents into one state; `AggregateKey.partial` uses
+        `Replay` aggregators for rates to avoid that.
+        """
+        if other.groupkeys is None:
+            return self
+
+        other_groups = other.sorted_groups()
+        if self.groupkeys is None:
+            self.groupkeys = other.groupkeys
+            self.steps = other.steps
+        elif other.groupkeys != self.groupkeys:
+            other_groups = rekey(other_groups, other.groupkeys, self.groupkeys)
+
+        merges = list(enumerate([aggregator.merge
+                                 for aggregator in self.aggregators], 1))
+        inits = [aggregator.init for aggregator in self.aggregators]
+        groups = self.groups
+        for key, group in other_groups:
+            existing = groups.get(key)
+            if existing is None:
+                # Merged into fresh states, so that folding more documents
+                # into this state leaves `other`'s states alone
+                groups[key] = [group[0]] + [
+                    merge(init(), state) for (_, merge), init, state
+                    in zip(merges, inits, group[1:])]
+                continue
+            for i, merge in merges:
+                existing[i] = merge(existing[i], group[i])
+
+        self.in_order = None
+        self.current_key = self.current = None
+        return self
+
+    def sorted_groups(self):
+        if self.in_order is not None:
+            return self.in_order
+        return sorted(self.groups.items())
+
+    def finalize(self):
+        """
+        Return the output documents, ordered by key.
+        """
+        return finalize_groups(self.aggregators, self.sorted_groups())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("steps", None)
+        state["groups"] = state["current_key"] = state["current"] = None
+        state["in_order"] = self.sorted_groups()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.groups = dict(self.in_order)
+        self.steps = list(enumerate([aggregator.update
+                                     for aggregator in self.aggregators], 1))
+        if self.in_order:
+            self.current_key, self.current = self.in_order[-1]
+
+
+def finalize_groups(aggregators, groups):
+    """
+    Turn `(key, [first_doc, state...])` pairs into output documents.
+    """
+    finalizers = [(aggregator.key, aggregator.finalize)
+                  for aggregator in aggregators]
+    output = []
+    for _, group in groups:
+        new_doc = group[0].copy()
+        for (keyname, finalize), state in zip(finalizers, group[1:]):
+            new_doc[keyname] = finalize(state)
+        output.append(new_doc)
+    return output
+
+
+def rekey(groups, from_groupkeys, to_groupkeys):
+    if set(from_groupkeys) != set(to_groupkeys):
+        raise ValueError("Cannot merge aggregates grouped by {0} and {1}"
+                         .format(sorted(from_groupkeys),
+                                 sorted(to_groupkeys)))
+    order = [from_groupkeys.index(k) for k in to_groupkeys]
+    return [(tuple(key[i] for i in order), group) for key, group in groups]
 
 
 def group(iterable, key):
@@ -47,14 +354,213 @@ def group(iterable, key):
         yield list(grouped)
 
 
+class Aggregator(object):
+
+    """
+    Computes one aggregated value, `key`, of a group of documents through a
+    state which can be updated one document at a time and merged with the
+    state of another group of documents:
+
+        init() -> state
+        update(state, doc) -> state
+        merge(state, other_state) -> state
+        finalize(state) -> value
+
+    Subclasses set `key` and define `init`, `update` and `merge`; `merge`
+    must return a state which shares nothing mutable with `other`. By
+    default `finalize` returns the state itself. An aggregator whose result
+    depends on the order its values are folded in, as a sum of floats does,
+    and whose `update` reads only the document keys named by `inputs`
+    without keeping the document, should declare them so that partial
+    aggregates can be merged exactly (see `Replay`).
+
+    For compatibility with plugin strings which pass `(keyname, function)`
+    pairs, an aggregator unpacks as `(key, aggregator)` and calling it with a
+    list of documents gives their aggregated value.
+    """
+
+    key = None
+    inputs = None
+
+    def finalize(self, state):
+        return state
+
+    def __iter__(self):
+        return iter((self.key, self))
+
+    def __call__(self, docs):
+        state = self.init()
+        for doc in docs:
+            state = self.update(state, doc)
+        return self.finalize(state)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self.key))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(
+            "{0}={1!r}".format(k, v) for k, v in sorted(vars(self).items())))
+
+
+class Count(Aggregator):
+
+    """
+    The sum of `key`, kept as a running total. Partial aggregates merge
+    their totals, which is exact for the integer counts this is meant for;
+    a total of floats may differ in the last place from summing all of the
+    documents in order.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def init(self):
+        return 0
+
+    def update(self, total, doc):
+        return total + doc[self.key]
+
+    def merge(self, total, other):
+        return total + other
+
+
+class Rate(Aggregator):
+
+    """
+    The rate `key` weighted by `count_key`, kept as the running
+    `[weighted_total, total]`.
+    """
+
+    def __init__(self, key, count_key):
+        self.key = key
+        self.count_key = count_key
+
+    @property
+    def inputs(self):
+        return (self.key, self.count_key)
+
+    def init(self):
+        return [0, 0]
+
+    def update(self, state, doc):
+        count = doc[self.count_key]
+        state[0] += doc[self.key] * count
+        state[1] += count
+        return state
+
+    def merge(self, state, other):
+        return [state[0] + other[0], state[1] + other[1]]
+
+    def finalize(self, state):
+        weighted_total, total = state
+        return weighted_total / total
+
+
+class Replay(Aggregator):
+
+    """
+    Records the `inputs` of each document for `aggregator`, in order, and
+    only folds them into its state when finalized. Merging two recordings
+    puts one after the other, so the result is exactly that of aggregating
+    all of their documents at once, even where the order of additions
+    matters, as it does for floats.
+    """
+
+    def __init__(self, aggregator):
+        self.key = aggregator.key
+        self.aggregator = aggregator
+        # One value per document for a single input, otherwise a tuple
+        self.read = itemgetter(*aggregator.inputs)
+
+    def init(self):
+        return []
+
+    def update(self, values, doc):
+        values.append(self.read(doc))
+        return values
+
+    def merge(self, values, other):
+        return values + other
+
+    def finalize(self, values):
+        aggregator = self.aggregator
+        update, inputs = aggregator.update, aggregator.inputs
+        state = aggregator.init()
+        doc = {}
+        if len(inputs) == 1:
+            (key,) = inputs
+            for value in values:
+                doc[key] = value
+                state = update(state, doc)
+        else:
+            for row in values:
+                doc.update(zip(inputs, row))
+                state = update(state, doc)
+        return aggregator.finalize(state)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.aggregator == other.aggregator)
+
+    def __hash__(self):
+        return hash((type(self), self.aggregator))
+
+    def __repr__(self):
+        return "Replay({0!r})".format(self.aggregator)
+
+    def __getstate__(self):
+        return {"aggregator": self.aggregator}
+
+    def __setstate__(self, state):
+        self.__init__(state["aggregator"])
+
+
+class GroupFunction(Aggregator):
+
+    """
+    Adapts a `function(docs)` which can only aggregate a whole group of
+    documents at once, by collecting the group's documents as its state.
+    """
+
+    def __init__(self, key, function):
+        self.key = key
+        self.function = function
+
+    def init(self):
+        return []
+
+    def update(self, docs, doc):
+        docs.append(doc)
+        return docs
+
+    def merge(self, docs, other):
+        return docs + other
+
+    def finalize(self, docs):
+        return self.function(docs)
+
+
+def as_aggregator(aggregation):
+    if isinstance(aggregation, Aggregator):
+        return aggregation
+    keyname, function = aggregation
+    if isinstance(function, Aggregator) and function.key == keyname:
+        return function
+    return GroupFunction(keyname, function)
+
+
 def aggregate_count(keyname):
     """
     Straightforward sum of the given keyname.
     """
-    def inner(docs):
-        return sum(doc[keyname] for doc in docs)
-
-    return keyname, inner
+    return Count(keyname)
 
 
 def aggregate_rate(rate_key, count_key):
@@ -62,13 +568,7 @@ def aggregate_rate(rate_key, count_key):
     Compute an aggregate rate for `rate_key` weighted according to
     `count_rate`.
     """
-    def inner(docs):
-        total = sum(doc[count_key] for doc in docs)
-        weighted_total = sum(doc[rate_key] * doc[count_key] for doc in docs)
-        total_rate = weighted_total / total
-        return total_rate
-
-    return rate_key, inner
+    return Rate(rate_key, count_key)
 
 
 def make_aggregate(docs, aggregations):
@@ -149,3 +649,133 @@ def test_AggregateKeyPlugin():
         "rate": (0.25 * 100 + 0.75 * 100) / (100 + 100)}
 
     assert_equal(output_docs, [expected_aggregate])
+
+
+def test_AggregateKey_matches_sorted_groupby():
+    """
+    test_AggregateKey_matches_sorted_groupby()
+
+    The single pass aggregation gives the same documents, in the same order,
+    as sorting and grouping the whole input, whether or not it is sorted.
+    """
+    from nose.tools import assert_equal
+
+    aggregations = [aggregate_count("visits"),
+                    aggregate_rate("rate", "visits")]
+
+    docs = [{"a": a, "b": b, "visits": v, "rate": r}
+            for a, b, v, r in [(2, 1, 10, 0.5), (1, 1, 20, 0.25),
+                               (2, 1, 30, 0.75), (1, 2, 40, 0.5),
+                               (1, 1, 50, 0.125)]]
+
+    def reference(documents):
+        groupkeys = tuple(set(documents[0]) - set(k for k, _ in aggregations))
+
+        def key(doc):
+            return tuple(doc[k] for k in groupkeys)
+
+        return [make_aggregate(grouped, aggregations)
+                for grouped in group(documents, key)]
+
+    plugin = AggregateKey(*aggregations)
+
+    assert_equal(plugin(docs), reference(docs))
+    assert_equal(plugin(sorted(docs, key=lambda d: (d["a"], d["b"]))),
+                 reference(docs))
+    assert_equal(plugin(iter(docs)), reference(docs))
+
+
+def test_AggregateKey_empty_input():
+    from nose.tools import assert_equal
+
+    assert_equal(AggregateKey(aggregate_count("visits"))(iter([])), [])
+
+
+def test_AggregateKey_whole_group_function():
+    """
+    test_AggregateKey_whole_group_function()
+
+    Aggregation functions which only accept a list of documents still work.
+    """
+    from nose.tools import assert_equal
+
+    docs = [{"a": 1, "visits": 3}, {"a": 2, "visits": 1},
+            {"a": 1, "visits": 5}]
+
+    plugin = AggregateKey(("visits", lambda docs: max(d["visits"]
+                                                      for d in docs)))
+
+    assert_equal(plugin(docs), [{"a": 1, "visits": 5}, {"a": 2, "visits": 1}])
+
+
+def test_AggregateKey_partial_and_merge():
+    from nose.tools import assert_equal
+
+    plugin = AggregateKey(aggregate_count("visits"),
+                          aggregate_rate("rate", "visits"),
+                          ("first", lambda docs: docs[0]["first"]))
+
+    docs = [{"a": i % 3, "visits": i, "rate": 0.1 * (i % 7), "first": i}
+            for i in range(1, 20)]
+
+    partials = [plugin.partial(docs[i:i + 4]) for i in range(0, 20, 4)]
+    partials.append(plugin.partial([]))
+
+    # Exactly equal, although merging the sums of each partition's floats
+    # would not be
+    assert_equal(plugin.merge(partials), plugin(docs))
+
+    # Counts are merged as totals rather than recorded document by document
+    assert_equal(sorted(group[1] for group in partials[0].groups.values()),
+                 [2, 3, 1 + 4])
+
+    # Merging copies the other state's groups rather than sharing them
+    first, second = plugin.partial(docs[:1]), plugin.partial(docs[1:8])
+    expected = second.finalize()
+    first.merge(second).update(docs[8:])
+    assert_equal(second.finalize(), expected)
+
+
+def test_AggregateKey_stream_yields_chunks():
+    from nose.tools import assert_equal
+
+    plugin = AggregateKey(aggregate_count("visits"))
+    docs = [{"a": i, "visits": 1} for i in range(DEFAULT_CHUNK_SIZE + 1)]
+
+    chunks = list(plugin.stream([docs[:10], docs[10:]]))
+
+    assert_equal([len(chunk) for chunk in chunks], [DEFAULT_CHUNK_SIZE, 1])
+    assert_equal([doc for chunk in chunks for doc in chunk], plugin(docs))
+    assert_equal(list(plugin.stream([])), [])
+
+
+def test_AggregateState_update_by_page():
+    """
+    test_AggregateState_update_by_page()
+
+    Folding pages one at a time into a state gives the same documents as
+    aggregating them all at once, whether or not the pages are in order.
+    """
+    from nose.tools import assert_equal
+
+    plugin = AggregateKey(aggregate_count("visits"),
+                          aggregate_rate("rate", "visits"))
+    docs = [{"a": a, "visits": v, "rate": 0.5}
+            for a, v in [(1, 1), (1, 2), (2, 3), (3, 4), (1, 5), (2, 6)]]
+
+    for pages in [[docs[:3], docs[3:]], [docs[:1], [], docs[1:4], docs[4:]]]:
+        state = plugin.start()
+        for page in pages:
+            state.update(page)
+        assert_equal(state.finalize(), plugin(docs))
+
+
+def test_aggregators_unpack_as_pairs():
+    from nose.tools import assert_equal
+
+    keyname, function = aggregate_rate("rate", "visits")
+
+    assert_equal(keyname, "rate")
+    assert_equal(function([{"rate": 0.5, "visits": 2},
+                           {"rate": 1.0, "visits": 2}]), 0.75)
+    assert_equal(aggregate_count("visits"), aggregate_count("visits"))
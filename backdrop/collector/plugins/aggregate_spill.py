@@ -0,0 +1,268 @@
+"""
+aggregate_spill.py
+------------------
+
+Aggregation which holds a bounded number of groups in memory, for
+`AggregateKey(..., max_groups=N)` or `max_bytes=N`.
+
+Documents are folded in memory until there are more groups than the budget
+allows. Then the groups so far, and every document after them, are
+hash-partitioned by key into temporary files. At the end each partition is
+aggregated on its own, carrying on from its spilled groups with its documents
+in input order, and the partitions' output is merged back into key order. A
+partition which is itself over budget is partitioned again in the same way.
+
+Every group sees its documents in the same order as it would in memory, so
+the output is identical to that of the in-memory aggregation, down to the
+last place of floating point sums.
+
+"""
+
+import sys
+import tempfile
+
+from .aggregate import AggregateState
+from .pipeline import chunked
+from .sort import RUN_BLOCK_SIZE, merge_sorted, pickle, read_run, write_run
+
+
+DEFAULT_PARTITIONS = 16
+# Partitions this deep are aggregated in memory whatever their size
+MAX_DEPTH = 4
+
+
+class SpillingState(object):
+
+    """
+    An `AggregateState` which spills to disk past `max_groups` groups, or
+    past an estimated `max_bytes` of them.
+    """
+
+    def __init__(self, aggregators, max_groups=None, max_bytes=None,
+                 partitions=DEFAULT_PARTITIONS, temp_dir=None, depth=0):
+        self.aggregators = aggregators
+        self.max_groups = max_groups
+        self.max_bytes = max_bytes
+        self.partitions = partitions
+        self.temp_dir = temp_dir
+        self.depth = depth
+        self.state = AggregateState(aggregators)
+        self.groupkeys = None
+        self.budget = None
+        self.spilled = None
+
+    def update(self, documents):
+        """
+        Fold `documents` (any iterable) into the state, returning it.
+        """
+        # Check the budget every so often, so the in-memory path stays fast
+        step = min(self.max_groups or RUN_BLOCK_SIZE, RUN_BLOCK_SIZE)
+        for chunk in chunked(documents, step):
+            if self.spilled is not None:
+                self.spill_documents(chunk)
+            else:
+                self.state.update(chunk)
+                self.check_budget()
+        return self
+
+    def resume(self, groupkeys, groups):
+        self.state.resume(groupkeys, groups)
+        self.check_budget()
+        return self
+
+    def check_budget(self):
+        groups = self.state.groups
+        if not groups:
+            return
+        if self.budget is None:
+            self.budget = group_budget(self.max_groups, self.max_bytes,
+                                       next(iter(groups.items())))
+        if len(groups) > self.budget and self.depth < MAX_DEPTH:
+            self.spill()
+
+    def spill(self):
+        self.groupkeys = self.state.groupkeys
+        self.spilled = [Partition(self.temp_dir)
+                        for _ in range(self.partitions)]
+        for key, group in self.state.groups.items():
+            self.partition(key).groups.append((key, group))
+        for partition in self.spilled:
+            partition.spill_groups()
+        self.state = None
+
+    def partition(self, key):
+        return self.spilled[hash((self.depth, key)) % self.partitions]
+
+    def spill_documents(self, documents):
+        groupkeys = self.groupkeys
+        for document in documents:
+            self.partition(tuple([document[key] for key in groupkeys])).add(
+                document)
+
+    def generate(self):
+        """
+        Generate the output documents, ordered by key.
+        """
+        if self.spilled is None:
+            for document in self.state.finalize():
+                yield document
+            return
+
+        spilled, self.spilled = self.spilled, None
+        runs = []
+        try:
+            for partition in spilled:
+                if partition.empty:
+                    continue
+                state = SpillingState(self.aggregators, self.max_groups,
+                                      self.max_bytes, self.partitions,
+                                      self.temp_dir, self.depth + 1)
+                state.resume(self.groupkeys, partition.spilled_groups())
+                state.update(partition.documents())
+                partition.close()
+                runs.append(write_run(state.generate(), self.temp_dir))
+
+            groupkeys = self.groupkeys
+            for document in merge_sorted(
+                    [read_run(run) for run in runs],
+                    lambda document: tuple([document[key]
+                                            for key in groupkeys])):
+                yield document
+        finally:
+            for partition in spilled:
+                partition.close()
+            for run in runs:
+                run.close()
+
+    def finalize(self):
+        """
+        Return the output documents, ordered by key.
+        """
+        return list(self.generate())
+
+
+class Partition(object):
+
+    """
+    The spilled groups and documents whose keys hash to one partition, each
+    in a temporary file.
+    """
+
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.groups = []
+        self.buffer = []
+        self.file = None
+
+    @property
+    def empty(self):
+        return not (self.groups or self.buffer or self.file)
+
+    def spill_groups(self):
+        if self.groups:
+            self.groups = write_run(self.groups, self.temp_dir)
+
+    def spilled_groups(self):
+        if isinstance(self.groups, list):
+            return self.groups
+        return read_run(self.groups)
+
+    def add(self, document):
+        self.buffer.append(document)
+        if len(self.buffer) >= RUN_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.temp_dir)
+        pickle.dump(self.buffer, self.file, pickle.HIGHEST_PROTOCOL)
+        self.buffer = []
+
+    def documents(self):
+        if self.buffer:
+            self.flush()
+        if self.file is None:
+            return iter(())
+        self.file.seek(0)
+        return read_run(self.file)
+
+    def close(self):
+        for run in [self.groups, self.file]:
+            if hasattr(run, "close"):
+                run.close()
+
+
+def group_budget(max_groups, max_bytes, sample):
+    """
+    The number of groups allowed, given an estimate of the size of one group
+    from a `(key, group)` `sample`.
+    """
+    budget = max_groups
+    if max_bytes is not None:
+        estimate = max_bytes // group_bytes(sample)
+        budget = estimate if budget is None else min(budget, estimate)
+    return max(budget, 1)
+
+
+def group_bytes(sample):
+    key, group = sample
+    document = group[0]
+    return (sys.getsizeof(key) + sys.getsizeof(group) +
+            sys.getsizeof(document) +
+            sum(sys.getsizeof(value) for value in document.values()) +
+            sum(sys.getsizeof(state) for state in group[1:]) +
+            # The hash table entry for the group
+            3 * sys.getsizeof(0))
+
+
+def aggregation_input(rows, seed=0):
+    import random
+    rng = random.Random(seed)
+    return [{"page": rng.randint(0, rows // 3), "day": rng.choice("mtw"),
+             "visits": rng.randint(1, 10),
+             "rate": rng.randint(0, 1000) / 1000.0}
+            for _ in range(rows)]
+
+
+def test_spilling_matches_in_memory():
+    from nose.tools import assert_equal, assert_is_not_none
+    from .aggregate import aggregate_count, aggregate_rate, as_aggregator
+
+    aggregators = [as_aggregator(aggregate_count("visits")),
+                   as_aggregator(aggregate_rate("rate", "visits"))]
+    documents = aggregation_input(3000)
+    expected = AggregateState(aggregators).update(documents).finalize()
+
+    state = SpillingState(aggregators, max_groups=5, partitions=3)
+    state.update(document for document in documents[:1000])
+    assert_is_not_none(state.spilled)
+    state.update(documents[1000:])
+    assert_equal(state.finalize(), expected)
+
+    state = SpillingState(aggregators, max_bytes=4096)
+    assert_equal(state.update(documents).finalize(), expected)
+    assert_is_not_none(state.budget)
+
+
+def test_spilling_AggregateKey():
+    from nose.tools import assert_equal, assert_false
+    from .aggregate import AggregateKey, aggregate_count, aggregate_rate
+    from .columnar import ColumnBatch
+    from .pipeline import chunked
+
+    aggregations = (aggregate_count("visits"),
+                    aggregate_rate("rate", "visits"))
+    documents = aggregation_input(2000, seed=1)
+    expected = AggregateKey(*aggregations)([dict(d) for d in documents])
+
+    plugin = AggregateKey(*aggregations, max_groups=7)
+    assert_false(plugin.mergeable)
+    assert_equal(plugin([dict(d) for d in documents]), expected)
+
+    output = plugin.stream(chunked([dict(d) for d in documents], 128))
+    assert_equal([d for chunk in output for d in chunk], expected)
+
+    assert_equal(plugin([]), [])
+
+    batch = plugin(ColumnBatch.from_documents(documents))
+    assert_equal(batch.to_documents(), expected)
@@ -0,0 +1,264 @@
+"""
+aggregate_store.py
+------------------
+
+Keeps `AggregateKey`'s partial aggregates in a SQLite file between collector
+runs, so that re-collecting overlapping date ranges only folds in documents
+which have not been seen before.
+
+For each group the store holds its partial aggregate and a digest of every
+document which went into it. When a run contains documents for a group:
+
+* if they are exactly the documents seen before, the group is unchanged;
+* if they are the documents seen before plus some new ones, only the new
+  ones are folded into the stored partial aggregate;
+* otherwise (some documents changed or disappeared) the group is
+  aggregated again from this run's documents, which replace the old ones.
+
+So every group comes out as it would if its latest documents were aggregated
+from scratch. Groups which do not appear in a run are left alone until they
+are removed with `expire`.
+
+"""
+
+import hashlib
+import json
+import pickle
+import sqlite3
+import time
+from collections import Counter
+
+from .aggregate import finalize_groups
+
+
+DIGEST_SIZE = 8
+
+
+class AggregateStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS groups ("
+            " key TEXT PRIMARY KEY,"
+            " record BLOB NOT NULL,"
+            " updated REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS groups_updated ON groups (updated)")
+        self.connection.commit()
+
+    def fold(self, aggregators, documents, emit="changed"):
+        """
+        Fold a run's `documents` into the store, returning the aggregated
+        documents of the groups which changed (`emit="changed"`) or of every
+        group in the store (`emit="all"`), ordered by key.
+        """
+        assert emit in ("changed", "all"), "emit must be 'changed' or 'all'"
+
+        aggregate_keys = set(aggregator.key for aggregator in aggregators)
+        groupkeys, runs = None, {}
+
+        for document in documents:
+            if groupkeys is None:
+                groupkeys = tuple(set(document) - aggregate_keys)
+            key = tuple([document[k] for k in groupkeys])
+            run = runs.get(key)
+            if run is None:
+                run = runs[key] = ([], [])
+            run[0].append(document_digest(document))
+            run[1].append(document)
+
+        changed = []
+        now = time.time()
+        with self.connection:
+            for key, (digests, group_documents) in runs.items():
+                key_id = key_identity(groupkeys, key)
+                group = self.fold_group(key_id, aggregators, digests,
+                                        group_documents)
+                if group is None:
+                    continue
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO groups VALUES (?, ?, ?)",
+                    (key_id, encode((sorted(digests), group)), now))
+                changed.append((key, group))
+
+        if emit == "all":
+            return finalize_groups(aggregators,
+                                   self.groups(aggregate_keys, groupkeys))
+        return finalize_groups(aggregators, sorted(changed))
+
+    def fold_group(self, key_id, aggregators, digests, documents):
+        """
+        Return the group's new `[first_doc, state...]`, or None if it has
+        not changed.
+        """
+        stored = self.load(key_id)
+        if stored is not None:
+            stored_digests, group = stored
+            if sorted(digests) == stored_digests:
+                return None
+
+            seen = Counter(stored_digests)
+            if not seen - Counter(digests):
+                new_documents = []
+                for digest, document in zip(digests, documents):
+                    if seen[digest]:
+                        seen[digest] -= 1
+                    else:
+                        new_documents.append(document)
+                return fold_into(aggregators, group, new_documents)
+
+        group = [documents[0]] + [aggregator.init()
+                                  for aggregator in aggregators]
+        return fold_into(aggregators, group, documents)
+
+    def load(self, key_id):
+        row = self.connection.execute(
+            "SELECT record FROM groups WHERE key = ?", (key_id,)).fetchone()
+        if row is None:
+            return None
+        return decode(row[0])
+
+    def groups(self, aggregate_keys, groupkeys=None):
+        """
+        Return every stored `(key, group)` in key order.
+        """
+        groups = []
+        for (record,) in self.connection.execute("SELECT record FROM groups"):
+            _, group = decode(record)
+            if groupkeys is None:
+                groupkeys = tuple(set(group[0]) - aggregate_keys)
+            groups.append((tuple(group[0][k] for k in groupkeys), group))
+        return sorted(groups)
+
+    def expire(self, older_than):
+        """
+        Forget groups which have not changed for `older_than` seconds,
+        returning how many were removed.
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM groups WHERE updated < ?",
+                (time.time() - older_than,))
+        return cursor.rowcount
+
+    def compact(self):
+        """
+        Give the space left by expired groups back to the filesystem.
+        """
+        self.connection.execute("VACUUM")
+
+    def __len__(self):
+        (count,) = self.connection.execute(
+            "SELECT COUNT(*) FROM groups").fetchone()
+        return count
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+def fold_into(aggregators, group, documents):
+    steps = list(enumerate([aggregator.update
+                            for aggregator in aggregators], 1))
+    for document in documents:
+        for i, step in steps:
+            group[i] = step(group[i], document)
+    return group
+
+
+def key_identity(groupkeys, key):
+    """
+    A string identifying a group which does not depend on the order of
+    `groupkeys`, or on whether strings are unicode.
+    """
+    return json.dumps(dict(zip(groupkeys, key)), sort_keys=True, default=repr)
+
+
+def document_digest(document):
+    if not isinstance(document, dict):
+        document = dict(document)
+    identity = json.dumps(document, sort_keys=True, default=repr)
+    return hashlib.sha1(identity.encode("utf-8")).digest()[:DIGEST_SIZE]
+
+
+def encode(record):
+    return sqlite3.Binary(pickle.dumps(record, 2))
+
+
+def decode(blob):
+    return pickle.loads(bytes(blob))
+
+
+def test_incremental_matches_full_recompute():
+    import os
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal
+    from .aggregate import AggregateKey, aggregate_count, aggregate_rate
+    from .columnar import ColumnBatch
+
+    def documents(day, visits, rate=0.5):
+        return [{"day": day, "page": page, "visits": v, "rate": rate}
+                for page, v in zip("ab", visits)]
+
+    aggregations = (aggregate_count("visits"),
+                    aggregate_rate("rate", "visits"))
+
+    # Day 2 is collected again unchanged, day 3 with a new row and day 4
+    # with changed rows; day 5 is new.
+    first_run = (documents(1, [1, 2]) + documents(2, [3, 4]) +
+                 documents(3, [5, 6]) + documents(4, [7, 8]))
+    second_run = (documents(2, [3, 4]) + documents(3, [5, 6]) +
+                  documents(3, [9, 10], 0.25) + documents(4, [1, 1]) +
+                  documents(5, [2, 2]))
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "state.db")
+
+        plugin = AggregateKey(*aggregations, state_path=path)
+        plugin([dict(d) for d in first_run])
+
+        plugin = AggregateKey(*aggregations, state_path=path)
+        changed = plugin([dict(d) for d in second_run])
+
+        expected = AggregateKey(*aggregations)(documents(1, [1, 2]) +
+                                               second_run)
+        assert_equal(changed, [d for d in expected if d["day"] >= 3])
+
+        plugin = AggregateKey(*aggregations, state_path=path, emit="all")
+        assert_equal(plugin([]), expected)
+        assert_equal(len(plugin.store), 10)
+
+        # Columnar input goes through the store too
+        plugin = AggregateKey(*aggregations, state_path=path, emit="all")
+        batch = plugin(ColumnBatch.from_documents(documents(6, [1, 1])))
+        assert_equal(len(plugin.store), 12)
+        assert_equal(len(batch), 12)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_expire_and_compact():
+    import os
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal
+    from .aggregate import AggregateKey, aggregate_count
+
+    directory = tempfile.mkdtemp()
+    try:
+        plugin = AggregateKey(aggregate_count("visits"),
+                              state_path=os.path.join(directory, "state.db"))
+        plugin([{"day": 1, "visits": 1}, {"day": 2, "visits": 1}])
+
+        assert_equal(plugin.store.expire(older_than=3600), 0)
+        assert_equal(plugin.store.expire(older_than=-1), 2)
+        plugin.store.compact()
+        assert_equal(len(plugin.store), 0)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,290 @@
+"""
+batch.py
+--------
+
+The last stage of a chain: turns documents into request bodies ready to
+POST to backdrop, each holding at most `max_docs` documents and `max_bytes`
+bytes, rather than serialising the whole output as one body at the end.
+
+Documents are serialised one at a time as they arrive, as compact JSON with
+datetimes written the way `compute_id.stringify` writes them. With
+`gzip=True` each body is gzipped as it is built, and `max_bytes` limits the
+gzipped size, so a body holds as many documents as fit once compressed.
+
+"""
+
+import json
+import zlib
+
+from .compute_id import FieldFormatter
+
+
+DEFAULT_MAX_DOCS = 1000
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+GZIP_LEVEL = 6
+
+
+class Batch(object):
+
+    """
+    A request body holding `count` documents.
+    """
+
+    def __init__(self, body, count, gzipped=False):
+        self.body = body
+        self.count = count
+        self.gzipped = gzipped
+
+    @property
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.gzipped:
+            headers["Content-Encoding"] = "gzip"
+        return headers
+
+    def documents(self):
+        body = self.body
+        if self.gzipped:
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return json.loads(body.decode("ascii"))
+
+    def __len__(self):
+        return len(self.body)
+
+    def __repr__(self):
+        return "<Batch of {0} documents in {1} bytes>".format(self.count,
+                                                             len(self))
+
+
+class BatchForBackdrop(object):
+
+    """
+    Turns documents into `Batch`es. Called on a list it returns a list of
+    batches; in a pipeline each batch is output as soon as it is full.
+    """
+
+    def __init__(self, max_docs=DEFAULT_MAX_DOCS, max_bytes=DEFAULT_MAX_BYTES,
+                 gzip=False):
+        if max_docs < 1:
+            raise ValueError("BatchForBackdrop needs max_docs of at least 1")
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.gzip = gzip
+
+    def __call__(self, documents):
+        return list(self.batches(documents))
+
+    def stream(self, chunks):
+        documents = (document for chunk in chunks for document in chunk)
+        for batch in self.batches(documents):
+            yield [batch]
+
+    def batches(self, documents):
+        """
+        Generate the batches of `documents` (any iterable).
+        """
+        encode = json.JSONEncoder(default=FieldFormatter().json_default,
+                                  separators=(",", ":")).encode
+        max_docs = self.max_docs
+        body = self.start()
+
+        for document in documents:
+            part = encode(document).encode("ascii")
+            if len(body.parts) >= max_docs or not body.fits(part):
+                if body.parts:
+                    for batch in self.finish(body):
+                        yield batch
+                    body = self.start()
+                if not body.fits(part):
+                    raise ValueError("A document of {0} bytes does not fit "
+                                     "in max_bytes={1}".format(
+                                         len(part), self.max_bytes))
+            body.add(part)
+
+        if body.count:
+            for batch in self.finish(body):
+                yield batch
+
+    def start(self):
+        if self.gzip:
+            return GzipBody(self.max_bytes)
+        return Body(self.max_bytes)
+
+    def finish(self, body):
+        data = body.finish()
+        if len(data) <= self.max_bytes or body.count == 1:
+            return [Batch(data, body.count, gzipped=self.gzip)]
+        # The gzipped size is only checked exactly near the limit, so in
+        # rare cases a body is split after all
+        middle = body.count // 2
+        first, second = self.start(), self.start()
+        for part in body.parts[:middle]:
+            first.add(part)
+        for part in body.parts[middle:]:
+            second.add(part)
+        return self.finish(first) + self.finish(second)
+
+
+class Body(object):
+
+    """
+    A JSON list of documents being built a document at a time, which can
+    tell whether another would keep it within `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 2
+
+    @property
+    def count(self):
+        return len(self.parts)
+
+    def fits(self, part):
+        return (self.size + len(part) + (1 if self.parts else 0) <=
+                self.max_bytes)
+
+    def add(self, part):
+        self.size += len(part) + (1 if self.parts else 0)
+        self.parts.append(part)
+
+    def finish(self):
+        return b"[" + b",".join(self.parts) + b"]"
+
+
+class GzipBody(Body):
+
+    """
+    A `Body` which is gzipped as it is built, limited by its gzipped size.
+
+    Documents are given to the compressor `GZIP_FEED_SIZE` bytes at a time.
+    Whether a document fits is checked exactly, by finishing a copy of the
+    compressor, only once the output so far plus everything not yet output
+    could exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        Body.__init__(self, max_bytes)
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+        self.output = []
+        self.size = 0
+        # Bytes not yet given to the compressor, and bytes not yet output
+        self.buffer, self.buffered = [b"["], 1
+        self.pending = 1
+
+    def separated(self, part):
+        return b"," + part if self.parts else part
+
+    def fits(self, part):
+        if (self.size + self.pending + len(part) + GZIP_SLACK <=
+                self.max_bytes):
+            return True
+        compressor = self.compressor.copy()
+        tail = (compressor.compress(b"".join(self.buffer) +
+                                    self.separated(part) + b"]") +
+                compressor.flush())
+        return self.size + len(tail) <= self.max_bytes
+
+    def add(self, part):
+        data = self.separated(part)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.pending += len(data)
+        self.parts.append(part)
+        if self.buffered >= GZIP_FEED_SIZE:
+            self.feed()
+
+    def feed(self):
+        fed = self.buffered
+        output = self.compressor.compress(b"".join(self.buffer))
+        self.buffer, self.buffered = [], 0
+        if output:
+            self.output.append(output)
+            self.size += len(output)
+            # The compressor may still hold what it was just given
+            self.pending = fed
+
+    def finish(self):
+        self.buffer.append(b"]")
+        self.feed()
+        self.output.append(self.compressor.flush())
+        return b"".join(self.output)
+
+
+GZIP_FEED_SIZE = 16384
+# More than the gzip trailer, the end of the deflate stream and the growth
+# of incompressible input
+GZIP_SLACK = 64
+
+
+def test_BatchForBackdrop_limits():
+    import datetime
+    import pytz
+    from nose.tools import assert_equal, assert_raises, assert_true
+
+    timestamp = datetime.datetime(2013, 10, 7, 1, tzinfo=pytz.UTC)
+    documents = [{"_timestamp": timestamp, "n": i, "page": "/" + "x" * i}
+                 for i in range(100)]
+    expected = json.loads(json.dumps(documents,
+                                     default=FieldFormatter().format))
+    assert_equal(expected[0]["_timestamp"], "20131007010000")
+
+    for gzip in [False, True]:
+        for max_docs, max_bytes in [(7, 10 ** 6), (1000, 800), (10, 500)]:
+            plugin = BatchForBackdrop(max_docs, max_bytes, gzip=gzip)
+            batches = plugin(documents)
+            assert_true(all(batch.count <= max_docs for batch in batches))
+            assert_true(all(len(batch) <= max_bytes for batch in batches))
+            assert_equal([document for batch in batches
+                          for document in batch.documents()], expected)
+
+    with assert_raises(ValueError):
+        BatchForBackdrop(max_bytes=50)(documents)
+
+    # Gzipped bodies are filled up to the limit, and a document which only
+    # fits once gzipped is accepted
+    plain = BatchForBackdrop(max_bytes=2000)(documents)
+    gzipped = BatchForBackdrop(max_bytes=2000, gzip=True)(documents)
+    assert_true(len(gzipped) * 3 < len(plain), (len(gzipped), len(plain)))
+    assert_true(all(len(batch) > 1500 for batch in gzipped[:-1]))
+    large = [{"page": "/" + "x" * 5000}]
+    assert_equal(BatchForBackdrop(max_bytes=2000, gzip=True)(large)[0]
+                 .documents(), large)
+
+    # Ids, which are bytes on Python 3, are sent as text
+    (batch,) = BatchForBackdrop()([{"_id": b"MQ=="}])
+    assert_equal(batch.body, b'[{"_id":"MQ=="}]')
+
+
+def test_BatchForBackdrop_posts_to_a_stand_in_server():
+    from nose.tools import assert_equal
+    from .load_plugin import load_pipeline
+    from .overlap import HTTPSink, OverlappedRunner, stand_in_server
+
+    def pages():
+        for page in range(4):
+            yield [{"page": page, "row": row, "customVarValue9": "<D1>"}
+                   for row in range(250)]
+
+    plugin_names = ["ComputeDepartmentKey('customVarValue9')",
+                    "ComputeIdFrom('page', 'row')",
+                    "BatchForBackdrop(max_docs=300, gzip=True)"]
+
+    server, url, requests = stand_in_server()
+    try:
+        runner = OverlappedRunner(load_pipeline(plugin_names), HTTPSink(url))
+        assert_equal(runner.run(pages()), 1000)
+    finally:
+        server.shutdown()
+
+    assert_equal(len(requests), 4)
+    received = []
+    for headers, body in requests:
+        headers = dict((key.lower(), value) for key, value in headers.items())
+        assert_equal(headers["content-encoding"], "gzip")
+        received.extend(Batch(body, None, gzipped=True).documents())
+    assert_equal([(d["page"], d["row"]) for d in received],
+                 [(page, row) for page in range(4) for row in range(250)])
+    assert_equal(received[0]["department"], "attorney-generals-office")
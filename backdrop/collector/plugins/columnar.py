@@ -0,0 +1,340 @@
+"""
+columnar.py
+-----------
+
+An optional column-oriented alternative to a list of documents, for large
+batches where the per-document cost of Python dicts dominates.
+
+A `ColumnBatch` holds one column per key. Columns of ints or floats are
+NumPy arrays when NumPy is installed, and `array.array`s otherwise; any other
+column is a list. Convert at the edges of a chain:
+
+    batch = ColumnBatch.from_documents(documents)
+    for plugin in plugins:
+        batch = plugin(batch)
+    documents = batch.to_documents()
+
+`AggregateKey` (for `aggregate_count` and `aggregate_rate`), `ComputeRank`,
+`ComputeIdFrom`, `ComputeDepartmentKey`, `SetDepartment`, `RemoveKey` and
+`Comment` accept a `ColumnBatch` in place of a list, and give the same
+documents as they would for the list.
+
+"""
+
+from array import array
+
+# numpy is imported by `load_numpy` when a batch first needs it
+_UNLOADED = object()
+numpy = _UNLOADED
+
+
+class ColumnBatch(object):
+
+    """
+    A batch of `length` documents which all have the same keys, stored as a
+    dict of columns.
+    """
+
+    def __init__(self, columns, length=None):
+        self.columns = columns
+        if length is None:
+            length = len(next(iter(columns.values()))) if columns else 0
+        self.length = length
+
+    @classmethod
+    def from_documents(cls, documents):
+        documents = list(documents)
+        if not documents:
+            return cls({}, 0)
+        keys = list(documents[0])
+        columns = dict((key, make_column([document[key]
+                                          for document in documents]))
+                       for key in keys)
+        return cls(columns, len(documents))
+
+    def to_documents(self):
+        keys = list(self.columns)
+        values = [as_list(self.columns[key]) for key in keys]
+        return [dict(zip(keys, row)) for row in zip(*values)]
+
+    def keys(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __setitem__(self, key, column):
+        assert len(column) == self.length, "column is the wrong length"
+        self.columns[key] = column
+
+    def __delitem__(self, key):
+        del self.columns[key]
+
+    def __repr__(self):
+        return "ColumnBatch({0!r}, {1!r})".format(self.columns, self.length)
+
+
+def make_column(values):
+    """
+    Store `values` as a numeric array if they are all ints or all floats.
+    """
+    types = set(type(value) for value in values)
+    try:
+        if types == set([int]):
+            return numeric_column(values, "int64", "l")
+        if types == set([float]):
+            return numeric_column(values, "float64", "d")
+    except OverflowError:
+        pass
+    return list(values)
+
+
+def load_numpy():
+    """
+    Return the numpy module, or None if it is not installed, importing it on
+    first use so that collectors which never build a batch do not pay for it.
+    """
+    global numpy
+    if numpy is _UNLOADED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def numeric_column(values, dtype, typecode):
+    numpy = load_numpy()
+    if numpy is not None:
+        return numpy.array(values, dtype=dtype)
+    return array(typecode, values)
+
+
+def arange(start, stop):
+    numpy = load_numpy()
+    if numpy is not None:
+        return numpy.arange(start, stop, dtype="int64")
+    return array("l", range(start, stop))
+
+
+def as_list(column):
+    """
+    Return the values in `column` as Python objects.
+    """
+    if isinstance(column, list):
+        return column
+    return column.tolist()
+
+
+def is_numeric(column):
+    return not isinstance(column, list)
+
+
+def group_codes(batch, groupkeys):
+    """
+    Number the distinct keys of `batch` in order of first appearance,
+    returning the keys and each row's key number.
+    """
+    index, keys, codes = {}, [], []
+    columns = [as_list(batch[key]) for key in groupkeys]
+    for key in zip(*columns):
+        code = index.get(key)
+        if code is None:
+            code = index[key] = len(keys)
+            keys.append(key)
+        codes.append(code)
+    return keys, codes
+
+
+def group_sum(column, codes, groups):
+    """
+    Sum `column` by group, adding the values of each group in row order.
+    """
+    numpy = load_numpy()
+    if numpy is not None and is_numeric(column):
+        totals = numpy.zeros(groups, dtype=column.dtype)
+        numpy.add.at(totals, numpy.asarray(codes), column)
+        return totals.tolist()
+
+    totals = [0] * groups
+    for code, value in zip(codes, as_list(column)):
+        totals[code] += value
+    return totals
+
+
+def multiply(a, b):
+    numpy = load_numpy()
+    if numpy is not None and is_numeric(a) and is_numeric(b):
+        return a * b
+    return [x * y for x, y in zip(as_list(a), as_list(b))]
+
+
+def aggregate_columns(batch, aggregators):
+    """
+    `AggregateKey` for a `ColumnBatch`, for `Count` and `Rate` aggregators.
+    Anything else is aggregated by converting to documents and back.
+    """
+    from .aggregate import AggregateState, Count, Rate
+
+    if not all(type(aggregator) in (Count, Rate)
+               for aggregator in aggregators):
+        state = AggregateState(aggregators).update(batch.to_documents())
+        return ColumnBatch.from_documents(state.finalize())
+
+    if not len(batch):
+        return ColumnBatch({}, 0)
+
+    aggregate_keys = [aggregator.key for aggregator in aggregators]
+    groupkeys = tuple(set(batch.keys()) - set(aggregate_keys))
+    keys, codes = group_codes(batch, groupkeys)
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+
+    columns = {}
+    for i, key in enumerate(groupkeys):
+        columns[key] = make_column([keys[code][i] for code in order])
+
+    for aggregator in aggregators:
+        if type(aggregator) is Count:
+            values = group_sum(batch[aggregator.key], codes, len(keys))
+        else:
+            counts = batch[aggregator.count_key]
+            weighted = group_sum(multiply(batch[aggregator.key], counts),
+                                 codes, len(keys))
+            totals = group_sum(counts, codes, len(keys))
+            values = [w / t for w, t in zip(weighted, totals)]
+        columns[aggregator.key] = make_column([values[code]
+                                               for code in order])
+
+    return ColumnBatch(columns, len(keys))
+
+
+def rank_columns(batch, var_name, start=1):
+    batch.columns[var_name] = arange(start, start + len(batch))
+    return batch
+
+
+def compute_id_columns(batch, fields, value_id=None, formatters=None):
+    """
+    `ComputeIdFrom` for a `ColumnBatch`, formatting each field's column with
+    its `FieldFormatter` from `formatters`.
+    """
+    from .compute_id import FieldFormatter
+    if value_id is None:
+        from .compute_id import value_id
+    if formatters is None:
+        formatters = [FieldFormatter() for _ in fields]
+
+    parts = [formatter.format_column(as_list(batch[field]))
+             for field, formatter in zip(fields, formatters)]
+
+    if parts:
+        ids = [value_id("_".join(row)) for row in zip(*parts)]
+    else:
+        ids = [value_id("")] * len(batch)
+
+    batch.columns["_id"] = [_id for _id, _ in ids]
+    batch.columns["humanId"] = [humanId for _, humanId in ids]
+    return batch
+
+
+def map_column(batch, key, function):
+    """
+    Apply `function` once to each distinct value in the column `key`.
+    """
+    results = {}
+    column = []
+    for value in as_list(batch[key]):
+        try:
+            result = results[value]
+        except KeyError:
+            result = results[value] = function(value)
+        column.append(result)
+    return column
+
+
+def filter_columns(batch, key, test):
+    """
+    Keep the rows of `batch` where `test` is true of the value of `key`.
+    """
+    keep = [i for i, value in enumerate(as_list(batch[key])) if test(value)]
+    return ColumnBatch(dict((name, take(column, keep))
+                            for name, column in batch.columns.items()),
+                       len(keep))
+
+
+def take(column, indices):
+    if isinstance(column, list):
+        return [column[i] for i in indices]
+    if isinstance(column, array):
+        return array(column.typecode, [column[i] for i in indices])
+    return column[load_numpy().asarray(indices, dtype="int64")]
+
+
+def test_ColumnBatch_round_trip():
+    from nose.tools import assert_equal
+
+    documents = [{"a": 1, "b": 0.5, "c": "x"}, {"a": 2, "b": 1.5, "c": "y"}]
+    batch = ColumnBatch.from_documents(documents)
+
+    assert_equal(len(batch), 2)
+    assert is_numeric(batch["a"]) and is_numeric(batch["b"])
+    assert_equal(batch["c"], ["x", "y"])
+    assert_equal(batch.to_documents(), documents)
+
+
+def check_columnar_matches_rows():
+    import datetime
+    import pytz
+    from nose.tools import assert_equal
+    from .load_plugin import load_plugins
+
+    plugin_names = [
+        "ComputeDepartmentKey('customVarValue9')",
+        "RemoveKey('customVarValue9')",
+        "AggregateKey(aggregate_count('visits'), "
+        "             aggregate_rate('rate', 'visits'))",
+        "ComputeRank('rank')",
+        "ComputeIdFrom('_timestamp', 'department', 'rank', 'visits', "
+        "              'flag')",
+    ]
+
+    def documents():
+        start = datetime.datetime(2013, 10, 7, tzinfo=pytz.UTC)
+        codes = ["<D1>", "<D2><D1>", "<D3>", "<D10><D4>", "<D1><D3>"]
+        return [{"_timestamp": start + datetime.timedelta(days=i % 2),
+                 "customVarValue9": codes[i % 5],
+                 "visits": i, "rate": 0.1 * (i % 7),
+                 # Equal, but formatted differently
+                 "flag": [1, True, 1.0][i % 3]}
+                for i in range(1, 101)]
+
+    rows = documents()
+    for plugin in load_plugins(plugin_names):
+        rows = plugin(rows)
+
+    batch = ColumnBatch.from_documents(documents())
+    for plugin in load_plugins(plugin_names):
+        batch = plugin(batch)
+
+    assert_equal(batch.to_documents(), rows)
+    assert_equal(len(set(row["_id"] for row in rows)), len(rows))
+
+
+def test_columnar_matches_rows():
+    check_columnar_matches_rows()
+
+
+def test_columnar_matches_rows_without_numpy():
+    global numpy
+    saved, numpy = numpy, None
+    try:
+        check_columnar_matches_rows()
+    finally:
+        numpy = saved
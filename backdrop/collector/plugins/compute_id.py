@@ -1,10 +1,30 @@
 import base64
+import binascii
 import datetime
+import hashlib
 
-import pytz
+from .columnar import ColumnBatch, compute_id_columns
+
+try:
+    URLSAFE = bytes.maketrans(b"+/", b"-_")
+except AttributeError:
+    import string
+    URLSAFE = string.maketrans("+/", "-_")
+
+try:
+    CACHED_TYPES = (datetime.datetime, str, unicode)
+except NameError:
+    CACHED_TYPES = (datetime.datetime, str)
+
+FORMAT_CACHE_SIZE = 10000
+
+# Bytes of the SHA-1 digest kept for `id_scheme="digest"`: 22 characters of
+# base64 once the padding is stripped.
+ID_DIGEST_SIZE = 16
 
 
 def to_utc(a_datetime):
+    import pytz
     return a_datetime.astimezone(pytz.UTC)
 
 
@@ -13,24 +33,166 @@ def value_id(value):
     return base64.urlsafe_b64encode(value_bytes), value_bytes
 
 
+def value_ids(values):
+    """
+    `value_id` for each of `values`, without its per-call overhead.
+    """
+    b2a_base64 = binascii.b2a_base64
+    encoded = [value.encode('utf-8') for value in values]
+    return [(b2a_base64(value_bytes)[:-1].translate(URLSAFE), value_bytes)
+            for value_bytes in encoded]
+
+
+def digest_id(value):
+    """
+    Like `value_id`, but `_id` is a fixed-width digest of the value rather
+    than the whole value. SHA-1 is used because it is available everywhere,
+    so ids do not depend on which Python computed them.
+    """
+    value_bytes = value.encode('utf-8')
+    digest = hashlib.sha1(value_bytes).digest()[:ID_DIGEST_SIZE]
+    return base64.urlsafe_b64encode(digest).rstrip(b"="), value_bytes
+
+
+def digest_ids(values):
+    sha1, b2a_base64 = hashlib.sha1, binascii.b2a_base64
+    encoded = [value.encode('utf-8') for value in values]
+    return [(b2a_base64(sha1(value_bytes).digest()[:ID_DIGEST_SIZE])
+             .rstrip(b"=\n").translate(URLSAFE), value_bytes)
+            for value_bytes in encoded]
+
+
+ID_SCHEMES = {
+    "base64": (value_id, value_ids),
+    "digest": (digest_id, digest_ids),
+}
+
+
 class ComputeIdFrom(object):
 
-    def __init__(self, *fields):
+    """
+    Sets `_id` and `humanId` from the values of `fields` in each document.
+
+    Each field has a `FieldFormatter`, which remembers how it formatted
+    repeated values such as timestamps, and documents are processed a field
+    at a time.
+
+    By default `_id` is the base64 of `humanId`. With `id_scheme="digest"` it
+    is instead a 22 character digest of `humanId`, which keeps payloads small
+    when the ids are long; `find_id_collisions` checks a dataset for clashes.
+    """
+
+    row_wise = True
+    writes = frozenset(["_id", "humanId"])
+    deletes = frozenset()
+
+    def __init__(self, *fields, **options):
         self.fields = fields
+        self.reads = frozenset(fields)
+        self.formatters = [FieldFormatter() for _ in fields]
 
-    def __call__(self, documents):
-        for document in documents:
+        self.id_scheme = options.pop("id_scheme", "base64")
+        if options:
+            raise TypeError("ComputeIdFrom got unexpected keyword arguments "
+                            "{0}".format(", ".join(sorted(options))))
+        if self.id_scheme not in ID_SCHEMES:
+            raise ValueError("Unknown id_scheme {0!r}, expected one of {1}"
+                             .format(self.id_scheme, sorted(ID_SCHEMES)))
+        self.value_id, self.value_ids = ID_SCHEMES[self.id_scheme]
 
-            id_parts = (stringify(document[field]) for field in self.fields)
-            id_string = "_".join(id_parts)
+    def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            return compute_id_columns(documents, self.fields, self.value_id,
+                                      self.formatters)
 
-            _id, humanId = value_id(id_string)
+        columns = [formatter.format_column([document[field]
+                                            for document in documents])
+                   for field, formatter in zip(self.fields, self.formatters)]
+        if columns:
+            id_strings = ["_".join(parts) for parts in zip(*columns)]
+        else:
+            id_strings = [""] * len(documents)
 
+        for document, (_id, humanId) in zip(documents,
+                                            self.value_ids(id_strings)):
             document['_id'] = _id
             document['humanId'] = humanId
 
         return documents
 
+    def fused_lines(self, bind):
+        parts = ", ".join("{0}(document[{1}])".format(bind(formatter.format),
+                                                      bind(field))
+                          for field, formatter in zip(self.fields,
+                                                      self.formatters))
+        return [
+            "_id, humanId = {0}({1}.join([{2}]))".format(
+                bind(self.value_id), bind("_"), parts),
+            "document['_id'] = _id",
+            "document['humanId'] = humanId",
+        ]
+
+
+class FieldFormatter(object):
+
+    """
+    `stringify` which remembers the strings it made for datetimes and
+    strings, up to `maxsize` of them. Other types are not remembered, since
+    values which are equal can still be formatted differently (1, 1.0, True).
+    """
+
+    def __init__(self, maxsize=FORMAT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.cache = {}
+
+    def format(self, value):
+        try:
+            return self.cache[value]
+        except (KeyError, TypeError):
+            return self.remember(value)
+
+    def json_default(self, value):
+        """
+        `format`, for use as a JSON encoder's `default`. Bytes, such as the
+        ids set by `ComputeIdFrom` on Python 3, are decoded as ASCII rather
+        than written as their repr.
+        """
+        if isinstance(value, bytes):
+            return value.decode("ascii")
+        return self.format(value)
+
+    def format_column(self, values):
+        try:
+            strings = [self.cache.get(value) for value in values]
+        except TypeError:
+            return [self.format(value) for value in values]
+
+        if None in strings:
+            for i, string in enumerate(strings):
+                if string is None:
+                    strings[i] = self.format(values[i])
+        return strings
+
+    def remember(self, value):
+        string = stringify(value)
+        if type(value) in CACHED_TYPES:
+            if len(self.cache) >= self.maxsize:
+                self.cache.clear()
+            self.cache[value] = string
+        return string
+
+
+def find_id_collisions(documents):
+    """
+    Return `{_id: set of humanIds}` for every `_id` in `documents` which was
+    computed from more than one distinct `humanId`.
+    """
+    human_ids = {}
+    for document in documents:
+        human_ids.setdefault(document['_id'], set()).add(document['humanId'])
+    return dict((_id, humans) for _id, humans in human_ids.items()
+                if len(humans) > 1)
+
 
 def stringify(item):
     if isinstance(item, datetime.datetime):
@@ -68,3 +230,68 @@ def test_ComputeIdFrom():
     assert_equal(_id, document['_id'])
     assert_equal(humanId, document['humanId'])
 
+
+def test_ComputeIdFrom_matches_unformatted_ids():
+    """
+    test_ComputeIdFrom_matches_unformatted_ids()
+
+    Remembered formatting gives exactly the ids which formatting every value
+    from scratch does, including for values which are equal but format
+    differently.
+    """
+    from nose.tools import assert_equal
+    import pytz
+
+    london = pytz.timezone("Europe/London")
+    timestamp = datetime.datetime(2013, 10, 7, 12, tzinfo=pytz.UTC)
+    values = [1, 1.0, True, "a", u"a", u"caf\xe9", timestamp,
+              timestamp.astimezone(london), None, ("a", 1), [1]]
+
+    documents = [{"a": a, "b": b} for a in values for b in values]
+    plugin = ComputeIdFrom("a", "b")
+
+    for _ in range(2):
+        output = plugin([dict(document) for document in documents])
+        for document in output:
+            _id, humanId = value_id("_".join([stringify(document["a"]),
+                                              stringify(document["b"])]))
+            assert_equal((type(_id), _id), (type(document["_id"]),
+                                            document["_id"]))
+            assert_equal(humanId, document["humanId"])
+
+
+def test_FieldFormatter_is_bounded():
+    from nose.tools import assert_equal
+
+    formatter = FieldFormatter(maxsize=2)
+    assert_equal(formatter.format_column(["a", "b", "c", "a"]),
+                 [u"a", u"b", u"c", u"a"])
+    assert len(formatter.cache) <= 2
+
+
+def test_ComputeIdFrom_digest_scheme():
+    from nose.tools import assert_equal
+
+    documents = [{"a": i, "b": u"caf\xe9"} for i in range(100)]
+    plugin = ComputeIdFrom("a", "b", id_scheme="digest")
+    output = plugin([dict(document) for document in documents])
+
+    base64_ids = ComputeIdFrom("a", "b")(documents)
+
+    for document, base64_document in zip(output, base64_ids):
+        assert_equal(document["humanId"], base64_document["humanId"])
+        assert_equal(document["_id"], digest_id(
+            document["humanId"].decode("utf-8"))[0])
+        assert_equal(len(document["_id"]), 22)
+
+    assert_equal(find_id_collisions(output), {})
+
+
+def test_find_id_collisions():
+    from nose.tools import assert_equal
+
+    documents = [{"_id": "x", "humanId": "1"}, {"_id": "x", "humanId": "1"},
+                 {"_id": "x", "humanId": "2"}, {"_id": "y", "humanId": "3"}]
+
+    assert_equal(find_id_collisions(documents), {"x": set(["1", "2"])})
+
@@ -0,0 +1,250 @@
+"""
+deduplicate.py
+--------------
+
+Drops documents whose `key` (by default the `_id` set by `ComputeIdFrom`)
+has already been seen, keeping the first, so that rows repeated by GA paging
+glitches or overlapping date ranges are only sent once.
+
+    Deduplicate()
+    Deduplicate("_id", strategy="bloom", capacity=5000000, error_rate=0.001)
+
+With `strategy="exact"` a 16 byte digest of each key is remembered, about 70
+bytes a document however long the ids are. With `strategy="bloom"` the keys
+go into a Bloom filter sized for `capacity` keys, which takes a fixed
+`capacity * 1.44 * log2(1 / error_rate)` bits; a new document is then wrongly
+dropped with probability at most `error_rate` while no more than `capacity`
+keys have been seen. Called on a list, the filter is sized for the length of
+the list if that is less than `capacity`, so that a small call does not
+allocate a filter for a whole run. Keys are compared by their string form,
+so `1` and `"1"` are the same key.
+
+Called on a list, duplicates within that list are dropped; in a pipeline,
+duplicates anywhere in the run. The plugin counts the `documents` it has
+checked and the `duplicates` it dropped, over every run.
+
+"""
+
+import hashlib
+import math
+import struct
+
+from .columnar import ColumnBatch, filter_columns
+
+
+DEFAULT_CAPACITY = 10000000
+DEFAULT_ERROR_RATE = 0.001
+
+try:
+    TEXT = unicode
+except NameError:
+    TEXT = str
+
+
+def key_digest(value):
+    if isinstance(value, TEXT):
+        value = value.encode("utf-8")
+    elif not isinstance(value, bytes):
+        value = TEXT(value).encode("utf-8")
+    return hashlib.md5(value).digest()
+
+
+class ExactSeen(object):
+
+    """
+    Remembers the digest of every key added.
+    """
+
+    def __init__(self):
+        self.digests = set()
+
+    def add(self, value):
+        """
+        Remember `value`, returning whether it was new.
+        """
+        digests = self.digests
+        digest = key_digest(value)
+        if digest in digests:
+            return False
+        digests.add(digest)
+        return True
+
+    def __len__(self):
+        return len(self.digests)
+
+
+class BloomSeen(object):
+
+    """
+    A Bloom filter of `capacity` keys with a false positive rate of
+    `error_rate`. Each key's bit positions come from one MD5 digest, split
+    into two hashes which are combined `hashes` ways.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE):
+        self.bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / float(capacity) *
+                                       math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        # 32 bit hashes keep the arithmetic in small ints on Python 2
+        first, second, _, _ = struct.unpack("<4I", key_digest(value))
+        bits = self.bits
+        return [(first + i * second) % bits for i in range(self.hashes)]
+
+    def add(self, value):
+        """
+        Remember `value`, returning whether it was (probably) new.
+        """
+        array, positions = self.array, self.positions(value)
+        if all(array[position >> 3] & 1 << (position & 7)
+               for position in positions):
+            return False
+        for position in positions:
+            array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+        return True
+
+    def __contains__(self, value):
+        array = self.array
+        return all(array[position >> 3] & 1 << (position & 7)
+                   for position in self.positions(value))
+
+    def error_rate(self):
+        """
+        The chance that the next new key is taken for a duplicate.
+        """
+        return (1 - math.exp(-self.hashes * self.count /
+                             float(self.bits))) ** self.hashes
+
+    def __len__(self):
+        return self.count
+
+
+class Deduplicate(object):
+
+    """
+    Drops documents whose `key` has been seen before in the same call, or
+    run of a pipeline, keeping the first.
+    """
+
+    writes = deletes = frozenset()
+
+    def __init__(self, key="_id", **options):
+        self.key = key
+        self.reads = frozenset([key])
+        self.strategy = options.pop("strategy", "exact")
+        self.capacity = options.pop("capacity", DEFAULT_CAPACITY)
+        self.error_rate = options.pop("error_rate", DEFAULT_ERROR_RATE)
+        if options:
+            raise TypeError("Deduplicate got unexpected keyword arguments "
+                            "{0}".format(", ".join(sorted(options))))
+        if self.strategy not in ("exact", "bloom"):
+            raise ValueError("Unknown strategy {0!r}, expected 'exact' or "
+                             "'bloom'".format(self.strategy))
+        if not 0 < self.error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.documents = 0
+        self.duplicates = 0
+
+    def start(self, expected=None):
+        """
+        Return an empty set of seen keys, for at most `expected` keys if
+        that is known.
+        """
+        if self.strategy == "bloom":
+            capacity = self.capacity
+            if expected is not None:
+                capacity = max(1, min(capacity, expected))
+            return BloomSeen(capacity, self.error_rate)
+        return ExactSeen()
+
+    def __call__(self, documents):
+        expected = len(documents) if hasattr(documents, "__len__") else None
+        return self.deduplicate(documents, self.start(expected))
+
+    def stream(self, chunks):
+        seen = self.start()
+        for chunk in chunks:
+            yield self.deduplicate(chunk, seen)
+
+    def deduplicate(self, documents, seen):
+        key, add = self.key, seen.add
+        if isinstance(documents, ColumnBatch):
+            kept = filter_columns(documents, key, add)
+            checked = len(documents)
+        else:
+            kept = []
+            checked = 0
+            for document in documents:
+                checked += 1
+                if add(document[key]):
+                    kept.append(document)
+        self.documents += checked
+        self.duplicates += checked - len(kept)
+        return kept
+
+    def __repr__(self):
+        arguments = [repr(self.key)]
+        if self.strategy == "bloom":
+            arguments.append("strategy='bloom', capacity={0!r}, "
+                             "error_rate={1!r}".format(self.capacity,
+                                                       self.error_rate))
+        return "Deduplicate({0})".format(", ".join(arguments))
+
+
+def test_Deduplicate():
+    from nose.tools import assert_equal, assert_raises, assert_true
+    from .load_plugin import load_pipeline
+
+    documents = [{"_id": "abc"[i % 3] * (i % 5 + 1), "n": i}
+                 for i in range(30)]
+    expected = []
+    for document in documents:
+        if document["_id"] not in [d["_id"] for d in expected]:
+            expected.append(document)
+    assert_equal(len(expected), 15)
+
+    for strategy in ["exact", "bloom"]:
+        plugin = Deduplicate(strategy=strategy, capacity=1000)
+        assert_equal(plugin(documents), expected)
+        assert_equal(plugin(documents[::-1])[0], documents[-1])
+
+        pipeline = load_pipeline(["Deduplicate(strategy={0!r})".format(
+            strategy)], chunk_size=7)
+        assert_equal(pipeline(documents), expected)
+
+        batch = plugin(ColumnBatch.from_documents(documents))
+        assert_equal(batch.to_documents(), expected)
+        assert_equal((plugin.documents, plugin.duplicates), (90, 45))
+        assert_equal(plugin(iter(documents)), expected)
+        assert_equal((plugin.documents, plugin.duplicates), (120, 60))
+
+    plugin = Deduplicate(strategy="bloom")
+    assert_equal(len(plugin.start(len(documents)).array), 54)
+    assert_equal(len(plugin.start(0).array), 2)
+    assert_true(len(plugin.start().array) > 10 ** 7)
+
+    assert_equal(Deduplicate("n")([{"n": 1}, {"n": 1.0}, {"n": "1"}]),
+                 [{"n": 1}, {"n": 1.0}])
+    with assert_raises(ValueError):
+        Deduplicate(strategy="fuzzy")
+    with assert_raises(ValueError):
+        Deduplicate(strategy="bloom", error_rate=1)
+    with assert_raises(TypeError):
+        Deduplicate(capacty=5)
+
+
+def test_BloomSeen_error_rate():
+    from nose.tools import assert_true
+
+    seen = BloomSeen(capacity=10000, error_rate=0.01)
+    assert_true(sum(seen.add(i) for i in range(0, 20000, 2)) > 9900)
+    assert_true(all(i in seen for i in range(0, 20000, 2)))
+    false_positives = sum(i in seen for i in range(1, 20000, 2))
+    assert_true(false_positives < 200, false_positives)
+    assert_true(0.005 < seen.error_rate() < 0.02, seen.error_rate())
@@ -1,4 +1,12 @@
 import re
+from functools import partial
+
+from .columnar import ColumnBatch, map_column
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+FIRST_CODE_RE = re.compile("^(<[^>]+>).*$")
 
 
 class ComputeDepartmentKey(object):
@@ -7,22 +15,75 @@ class ComputeDepartmentKey(object):
     Adds a 'department' key to a dictionary by looking up the department from
     the specified, key_name. It takes the first department code of form
     <[code]> from document[key_name].
+
+    There are only a few hundred distinct values of key_name, so each one is
+    resolved once per batch of documents and remembered in a `ResolutionCache`
+    of at most `cache_size` entries.
+
+    Codes are looked up in DEPARTMENT_MAPPING, or in the JSON or CSV file
+    `mapping` if given (see `department_mapping`).
     """
 
-    def __init__(self, key_name):
+    row_wise = True
+    writes = frozenset(["department"])
+    deletes = frozenset()
+
+    def __init__(self, key_name, cache_size=DEFAULT_CACHE_SIZE, mapping=None):
         self.key_name = key_name
+        self.reads = frozenset([key_name])
+        self.cache = resolution_cache(department_for_codes, cache_size,
+                                      mapping)
 
     def __call__(self, documents):
-        def compute_department(department):
-            assert self.key_name in document, (
-                'key "{}" not found "{}"'.format(self.key_name, document))
-            department_codes = document[self.key_name]
-            department_code = take_first_department_code(department_codes)
-            document["department"] = DEPARTMENT_MAPPING.get(
-                department_code, department_code)
-            return document
+        key_name = self.key_name
+        self.cache.refresh()
+        if isinstance(documents, ColumnBatch):
+            assert key_name in documents or not len(documents), (
+                'key "{}" not found "{}"'.format(key_name, documents))
+            documents["department"] = map_column(documents, key_name,
+                                                 self.cache)
+            return documents
+
+        departments = {}
+        output = []
 
-        return [compute_department(document) for document in documents]
+        for document in documents:
+            assert key_name in document, (
+                'key "{}" not found "{}"'.format(key_name, document))
+            department_codes = document[key_name]
+            try:
+                department = departments[department_codes]
+            except KeyError:
+                department = departments[department_codes] = self.cache(
+                    department_codes)
+            document["department"] = department
+            output.append(document)
+
+        self.cache.hits += len(output) - len(departments)
+        return output
+
+    def fused_setup(self, bind):
+        cache = bind(self.cache)
+        return ["{0}.refresh()".format(cache),
+                "{0}_lookups, {0}_misses = 0, {0}.misses".format(cache)]
+
+    def fused_lines(self, bind):
+        key_name, cache = bind(self.key_name), bind(self.cache)
+        return [
+            "assert {0} in document, {1}.format({0}, document)".format(
+                key_name, bind('key "{}" not found "{}"')),
+            "{0}_lookups += 1".format(cache),
+            "department = {0}(document[{1}])".format(
+                bind(self.cache.values.get), key_name),
+            "if department is None:",
+            "    department = {0}(document[{1}])".format(cache, key_name),
+            "document['department'] = department",
+        ]
+
+    def fused_teardown(self, bind):
+        cache = bind(self.cache)
+        return ["{0}.hits += {0}_lookups - ({0}.misses - {0}_misses)".format(
+            cache)]
 
 
 class SetDepartment(object):
@@ -41,20 +102,231 @@ class SetDepartment(object):
         SetDepartment("Department for fooing the bar")
     """
 
+    row_wise = True
+    reads = deletes = frozenset()
+    writes = frozenset(["department"])
+
     def __init__(self, department_or_code):
         self.department_or_code = department_or_code
         self.value = try_get_department(self.department_or_code)
 
     def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            documents["department"] = [self.value] * len(documents)
+            return documents
+
         for document in documents:
             document["department"] = self.value
         return documents
 
+    def fused_lines(self, bind):
+        return ["document['department'] = {0}".format(bind(self.value))]
+
+
+class ComputeDepartments(object):
+
+    """
+    Adds a `key` ('departments' by default) holding the list of departments
+    for every department code in document[key_name], in order and without
+    repeats, where `ComputeDepartmentKey` only takes the first. Unknown codes
+    are kept as they are.
+
+    Like `ComputeDepartmentKey`, each distinct value of key_name is scanned
+    once and remembered in a `ResolutionCache` of at most `cache_size`
+    entries, and codes can be looked up in a `mapping` file.
+    """
+
+    row_wise = True
+    deletes = frozenset()
+
+    def __init__(self, key_name, key="departments",
+                 cache_size=DEFAULT_CACHE_SIZE, mapping=None):
+        self.key_name = key_name
+        self.key = key
+        self.reads = frozenset([key_name])
+        self.writes = frozenset([key])
+        self.cache = resolution_cache(departments_for_codes, cache_size,
+                                      mapping)
+
+    def __call__(self, documents):
+        key_name, key, cache = self.key_name, self.key, self.cache
+        cache.refresh()
+        if isinstance(documents, ColumnBatch):
+            documents[key] = [list(departments) for departments in
+                              map_column(documents, key_name, cache)]
+            return documents
+
+        resolved = {}
+        output = []
+        for document in documents:
+            department_codes = document[key_name]
+            try:
+                departments = resolved[department_codes]
+            except KeyError:
+                departments = resolved[department_codes] = cache(
+                    department_codes)
+            document[key] = list(departments)
+            output.append(document)
+
+        cache.hits += len(output) - len(resolved)
+        return output
+
+    def fused_setup(self, bind):
+        return ["{0}.refresh()".format(bind(self.cache))]
+
+    def fused_lines(self, bind):
+        return ["document[{0}] = list({1}(document[{2}]))".format(
+            bind(self.key), bind(self.cache), bind(self.key_name))]
+
+
+class ExplodeDepartments(object):
+
+    """
+    Like `ComputeDepartments`, but outputs a copy of each document for each
+    of its departments, with the department in `key` ('department' by
+    default), so that content shared by several departments counts towards
+    each of them. Documents without a department code are dropped.
+    """
+
+    row_wise = True
+
+    def __init__(self, key_name, key="department",
+                 cache_size=DEFAULT_CACHE_SIZE, mapping=None):
+        self.key_name = key_name
+        self.key = key
+        self.cache = resolution_cache(departments_for_codes, cache_size,
+                                      mapping)
+
+    def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            return ColumnBatch.from_documents(self(documents.to_documents()))
+
+        key_name, key, cache = self.key_name, self.key, self.cache
+        cache.refresh()
+        exploded = []
+        append = exploded.append
+        for document in documents:
+            departments = cache(document[key_name])
+            if not departments:
+                continue
+            document[key] = departments[0]
+            append(document)
+            for department in departments[1:]:
+                copy = document.copy()
+                copy[key] = department
+                append(copy)
+        return exploded
+
+
+class ResolutionCache(object):
+
+    """
+    Remembers `resolve(value)` for up to `maxsize` distinct values, counting
+    hits and misses. When it is full it is emptied and starts again, which
+    keeps a hit down to a single dict lookup.
+
+    If `resolve` depends on a `department_mapping.MappingFile`, pass it as
+    `table`: `refresh` empties the cache when the file has changed.
+    """
+
+    def __init__(self, resolve, maxsize=DEFAULT_CACHE_SIZE, table=None):
+        assert maxsize > 0, "maxsize must be positive"
+        self.resolve = resolve
+        self.maxsize = maxsize
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.table = table
+        self.version = None if table is None else table.version
+
+    def refresh(self):
+        if self.table is not None and self.table.refresh() != self.version:
+            self.values.clear()
+            self.version = self.table.version
+
+    def __call__(self, value):
+        try:
+            result = self.values[value]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self.resolve(value)
+        if len(self.values) >= self.maxsize:
+            self.values.clear()
+        self.values[value] = result
+        return result
+
+
+def resolution_cache(resolve, maxsize, mapping=None):
+    """
+    A `ResolutionCache` of `resolve`, which looks codes up in the file
+    `mapping` if one is given rather than in DEPARTMENT_MAPPING.
+    """
+    if mapping is None:
+        return ResolutionCache(resolve, maxsize)
+    from .department_mapping import mapping_file
+    table = mapping_file(mapping)
+    return ResolutionCache(partial(resolve, table=table), maxsize, table)
+
+
+def code_index(mapping):
+    """
+    `mapping` keyed by each code without its closing ">", as
+    `departments_for_codes` finds them.
+    """
+    return dict((code[:-1], department)
+                for code, department in mapping.items())
+
+
+def department_for_codes(department_codes, table=None):
+    """
+    Map the first department code in `department_codes` to a department,
+    or return the code itself if it is unknown.
+    """
+    mapping = DEPARTMENT_MAPPING if table is None else table.mapping
+    department_code = take_first_department_code(department_codes)
+    return mapping.get(department_code, department_code)
+
+
+def departments_for_codes(department_codes, table=None):
+    """
+    Map every department code in `department_codes` to a department, in
+    order and without repeats, returning a tuple. Codes are what
+    `<[^>]+>` matches, as for `ComputeDepartmentKey`, but may appear
+    anywhere in the string. Unknown codes are kept as they are, and text
+    outside the codes is ignored.
+    """
+    index = CODE_INDEX if table is None else table.index
+    departments = []
+    find = department_codes.find
+    start = find("<")
+    while start >= 0:
+        end = find(">", start + 1)
+        if end < 0:
+            break
+        if end > start + 1:
+            code = department_codes[start:end]
+            department = index.get(code)
+            if department is None:
+                department = code + ">"
+            if department not in departments:
+                departments.append(department)
+        start = find("<", end + 1)
+    return tuple(departments)
+
 
 def try_get_department(department_or_code):
     """
     Try to take the first department code, or fall back to string as passed
     """
+    return try_get_department_cache(department_or_code)
+
+
+def _try_get_department(department_or_code):
     try:
         value = take_first_department_code(department_or_code)
     except AssertionError:
@@ -66,6 +338,9 @@ def try_get_department(department_or_code):
     return value
 
 
+try_get_department_cache = ResolutionCache(_try_get_department)
+
+
 def test_try_get_department():
     from nose.tools import assert_equal
     assert_equal(try_get_department("<D1>"), "attorney-generals-office")
@@ -74,8 +349,7 @@ def test_try_get_department():
 
 
 def take_first_department_code(department_codes):
-    get_first_re = re.compile("^(<[^>]+>).*$")
-    match = get_first_re.match(department_codes)
+    match = FIRST_CODE_RE.match(department_codes)
     assert match is not None
     (department_code, ) = match.groups()
     return department_code
@@ -124,6 +398,156 @@ def test_takes_first_code():
                  "department-for-work-pensions")
 
 
+def test_ResolutionCache_counts_and_bounds():
+    from nose.tools import assert_equal
+
+    calls = []
+
+    def resolve(value):
+        calls.append(value)
+        return value.upper()
+
+    cache = ResolutionCache(resolve, maxsize=2)
+
+    assert_equal([cache(v) for v in "aaba"], ["A", "A", "B", "A"])
+    assert_equal((cache.hits, cache.misses), (2, 2))
+
+    cache("c")
+    assert_equal(len(cache.values), 1)
+    assert_equal(cache("a"), "A")
+    assert_equal(calls, ["a", "b", "c", "a"])
+
+
+def test_ComputeDepartmentKey_resolves_each_value_once():
+    from nose.tools import assert_equal
+
+    plugin = ComputeDepartmentKey("key_name")
+    documents = [{"key_name": code} for code in ["<D10>", "<D1>", "<D10>"]]
+
+    plugin(documents)
+    plugin([{"key_name": "<D1>"}])
+
+    assert_equal([document["department"] for document in documents],
+                 ["department-for-work-pensions", "attorney-generals-office",
+                  "department-for-work-pensions"])
+    assert_equal((plugin.cache.hits, plugin.cache.misses), (2, 2))
+
+    (document,) = plugin(iter([{"key_name": "<D1>"}]))
+    assert_equal(document["department"], "attorney-generals-office")
+    assert_equal((plugin.cache.hits, plugin.cache.misses), (3, 2))
+
+
+def test_departments_for_codes():
+    from nose.tools import assert_equal
+
+    assert_equal(departments_for_codes("<D1><D2>"),
+                 ("attorney-generals-office", "cabinet-office"))
+    assert_equal(departments_for_codes("x<D2> <NOPE><D2><EA26>y<D1"),
+                 ("cabinet-office", "<NOPE>", "companies-house"))
+    assert_equal(departments_for_codes("no codes"), ())
+    assert_equal(departments_for_codes("<><D1>"),
+                 ("attorney-generals-office",))
+    assert_equal(departments_for_codes("<<D1>"), ("<<D1>",))
+
+
+def test_ComputeDepartments():
+    from nose.tools import assert_equal
+    from .load_plugin import compile_plugins
+
+    def documents():
+        return [{"key_name": codes} for codes in
+                ["<D1><D2>", "<D2>", "<D1><D2>", "", "<D2><D2><D9999>"]]
+
+    expected = [["attorney-generals-office", "cabinet-office"],
+                ["cabinet-office"],
+                ["attorney-generals-office", "cabinet-office"], [],
+                ["cabinet-office", "<D9999>"]]
+
+    plugin = ComputeDepartments("key_name")
+    output = plugin(iter(documents()))
+    assert_equal([document["departments"] for document in output], expected)
+    output[0]["departments"].append("changed")
+    assert_equal(output[2]["departments"], expected[2])
+    assert_equal((plugin.cache.hits, plugin.cache.misses), (1, 4))
+
+    (fused,) = compile_plugins([plugin, SetDepartment("<D1>")])
+    assert_equal([document["departments"] for document in fused(documents())],
+                 expected)
+
+    batch = plugin(ColumnBatch.from_documents(documents()))
+    assert_equal(batch["departments"], expected)
+
+
+def test_ExplodeDepartments():
+    from nose.tools import assert_equal
+    from .load_plugin import load_pipeline
+
+    documents = [{"key_name": "<D1><D2>", "visits": 3},
+                 {"key_name": "none", "visits": 2},
+                 {"key_name": "<D2>", "visits": 1}]
+    expected = [("attorney-generals-office", 3), ("cabinet-office", 3),
+                ("cabinet-office", 1)]
+
+    def departments(output):
+        return [(d["department"], d["visits"]) for d in output]
+
+    plugin = ExplodeDepartments("key_name")
+    assert_equal(departments(plugin([dict(d) for d in documents])),
+                 expected)
+    assert_equal(departments(plugin(ColumnBatch.from_documents(
+        documents)).to_documents()), expected)
+
+    pipeline = load_pipeline(["ExplodeDepartments('key_name')",
+                              "RemoveKey('key_name')",
+                              "AggregateKey(aggregate_count('visits'))"],
+                             chunk_size=1)
+    assert_equal(
+        sorted(departments(pipeline([dict(d) for d in documents]))),
+        [("attorney-generals-office", 3), ("cabinet-office", 4)])
+
+
+def test_department_plugins_use_a_mapping_file():
+    import os
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal
+    from .load_plugin import compile_plugins
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "departments.csv")
+    try:
+        with open(path, "wb") as f:
+            f.write(b"<D1>,first-name\n<NEW1>,new-department\n")
+
+        plugins = [ComputeDepartmentKey("codes", mapping=path),
+                   ComputeDepartments("codes", mapping=path)]
+        (fused,) = compile_plugins(plugins)
+        explode = ExplodeDepartments("codes", mapping=path)
+
+        def run():
+            documents = [{"codes": "<D1><NEW1><D2>"}]
+            (document,) = fused(documents)
+            exploded = explode([{"codes": "<NEW1><D2>"}])
+            return (document["department"], document["departments"],
+                    [d["department"] for d in exploded])
+
+        assert_equal(run(), ("first-name",
+                             ["first-name", "new-department", "<D2>"],
+                             ["new-department", "<D2>"]))
+
+        with open(path, "wb") as f:
+            f.write(b"<D1>,renamed\n<D2>,second\n")
+        os.utime(path, (0, 0))
+        assert_equal(run(), ("renamed", ["renamed", "<NEW1>", "second"],
+                             ["<NEW1>", "second"]))
+
+        # The built in table is still the default
+        (document,) = ComputeDepartmentKey("codes")([{"codes": "<D1>"}])
+        assert_equal(document["department"], "attorney-generals-office")
+    finally:
+        shutil.rmtree(directory)
+
+
 DEPARTMENT_MAPPING = {
     "<D1>": "attorney-generals-office",
     "<D2>": "cabinet-office",
@@ -531,3 +955,5 @@ DEPARTMENT_MAPPING = {
     "<PC472>": "marine-accident-investigation-branch",
     "<PC493>": "london-and-continental-railways-ltd",
 }
+
+CODE_INDEX = code_index(DEPARTMENT_MAPPING)
@@ -0,0 +1,333 @@
+"""
+department_mapping.py
+---------------------
+
+Department tables loaded from a file rather than the `DEPARTMENT_MAPPING`
+built into `department.py`, so that a new department code does not need a
+release:
+
+    ComputeDepartmentKey("customVarValue9", mapping="departments.json")
+
+A `.json` file holds an object mapping each code to its department:
+
+    {"<D1>": "attorney-generals-office", "<D2>": "cabinet-office"}
+
+and a `.csv` file has a code and its department on each line, optionally
+under a `code,department` header.
+
+Parsing is only done once for each version of a file: the table is compiled
+to a marshal file named after a checksum of the file, next to it (or, if
+that is not writable, in a directory in the temporary directory which only
+the current user can use), which later processes load instead. A compiled
+table which is not a table of department codes is ignored. The file is
+checked for changes each time a plugin is called, and reloaded if it has
+changed.
+
+"""
+
+import csv
+import hashlib
+import json
+import marshal
+import os
+import stat
+import sys
+import tempfile
+
+from .department import code_index
+
+
+# Marshal's format depends on the version of Python which wrote it
+COMPILED_SUFFIX = ".py{0}{1}.marshal".format(*sys.version_info[:2])
+
+STRING_TYPES = (str, type(u""))
+
+_files = {}
+
+
+class MappingFile(object):
+
+    """
+    The table in the file at `path`: `mapping` maps each code to its
+    department and `index` maps each code without its closing ">" to its
+    department. `version` changes whenever a changed file is reloaded.
+    """
+
+    def __init__(self, path, cache_dir=None):
+        self.path = os.path.abspath(path)
+        self.cache_dir = cache_dir
+        self.stat = None
+        self.checksum = None
+        self.version = 0
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reload the table if the file has changed, returning its version.
+        """
+        stat = os.stat(self.path)
+        stat = (stat.st_mtime, stat.st_size)
+        if stat != self.stat:
+            with open(self.path, "rb") as source:
+                data = source.read()
+            checksum = hashlib.sha1(data).hexdigest()
+            if checksum != self.checksum:
+                self.mapping = compiled_mapping(self.path, data, checksum,
+                                                self.cache_dir)
+                self.index = code_index(self.mapping)
+                self.checksum = checksum
+                self.version += 1
+            self.stat = stat
+        return self.version
+
+
+def mapping_file(path, cache_dir=None):
+    """
+    The `MappingFile` for `path`, shared by every plugin which uses it.
+    """
+    key = (os.path.abspath(path), cache_dir)
+    table = _files.get(key)
+    if table is None:
+        table = _files[key] = MappingFile(path, cache_dir)
+    return table
+
+
+def compiled_mapping(path, data, checksum, cache_dir=None):
+    """
+    The table in `data`, read from `path`, loaded from its compiled form if
+    there is one, and otherwise parsed and compiled. Compiled tables are
+    kept in `cache_dir`, or by default next to `path` or, if that directory
+    is not writable, in `private_cache_dir()`.
+    """
+    if cache_dir is None:
+        directories = [os.path.dirname(path)]
+        private = private_cache_dir()
+        if private is not None:
+            directories.append(private)
+    else:
+        directories = [cache_dir]
+    name = "{0}.{1}{2}".format(os.path.basename(path), checksum,
+                               COMPILED_SUFFIX)
+
+    for directory in directories:
+        try:
+            with open(os.path.join(directory, name), "rb") as cached:
+                return check_mapping(path, marshal.load(cached))
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+    mapping = parse_mapping(path, data)
+    for directory in directories:
+        try:
+            # Written under a temporary name, so that other processes never
+            # see half a file
+            handle, temporary = tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle, "wb") as output:
+                marshal.dump(mapping, output)
+            os.rename(temporary, os.path.join(directory, name))
+        except (IOError, OSError):
+            continue
+        remove_stale(directory, path, name)
+        break
+    return mapping
+
+
+def private_cache_dir():
+    """
+    A directory in the temporary directory for this user's compiled tables,
+    created if need be, or None if it is not private to this user.
+    """
+    getuid = getattr(os, "getuid", None)
+    if getuid is None:
+        return None
+    directory = os.path.join(
+        tempfile.gettempdir(),
+        "backdrop-department-mappings-{0}".format(getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        pass
+    try:
+        info = os.lstat(directory)
+    except OSError:
+        return None
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != getuid() or
+            info.st_mode & 0o077):
+        return None
+    return directory
+
+
+def remove_stale(directory, path, name):
+    """
+    Remove the tables compiled from earlier versions of `path`.
+    """
+    prefix = os.path.basename(path) + "."
+    for other in os.listdir(directory):
+        if (other != name and other.startswith(prefix) and
+                other.endswith(COMPILED_SUFFIX)):
+            try:
+                os.remove(os.path.join(directory, other))
+            except OSError:
+                pass
+
+
+def parse_mapping(path, data):
+    """
+    Parse the JSON or CSV table `data`, raising ValueError if it is not a
+    table of department codes.
+    """
+    text = data.decode("utf-8")
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".json":
+        mapping = json.loads(text)
+        if not isinstance(mapping, dict):
+            raise ValueError("{0} should hold a JSON object".format(path))
+        rows = sorted(mapping.items())
+    elif extension == ".csv":
+        rows = [row for row in csv_rows(data) if row]
+        if rows and [cell.strip().lower() for cell in rows[0]] == [
+                "code", "department"]:
+            rows = rows[1:]
+    else:
+        raise ValueError("Unknown department mapping format {0!r}, expected "
+                         ".json or .csv".format(extension))
+
+    mapping = {}
+    for row in rows:
+        if len(row) != 2:
+            raise ValueError("{0}: expected a code and a department, got "
+                             "{1!r}".format(path, row))
+        if not all(isinstance(cell, STRING_TYPES) for cell in row):
+            raise ValueError("{0}: expected a code and a department as "
+                             "strings, got {1!r}".format(path, row))
+        code, department = [cell.strip() for cell in row]
+        mapping[code] = department
+    return check_mapping(path, mapping)
+
+
+def check_mapping(path, mapping):
+    """
+    Return `mapping`, raising ValueError unless it maps department codes to
+    strings.
+    """
+    if not isinstance(mapping, dict):
+        raise ValueError("{0}: expected a table of department codes".format(
+            path))
+    for code, department in mapping.items():
+        if not (isinstance(code, STRING_TYPES) and code.startswith("<") and
+                code.endswith(">") and ">" not in code[:-1] and
+                len(code) > 2):
+            raise ValueError("{0}: {1!r} is not a department code".format(
+                path, code))
+        if not isinstance(department, STRING_TYPES):
+            raise ValueError("{0}: {1!r} is not a department".format(
+                path, department))
+    return mapping
+
+
+def csv_rows(data):
+    lines = data.splitlines()
+    if str is bytes:
+        return [[cell.decode("utf-8") for cell in row]
+                for row in csv.reader(lines)]
+    return list(csv.reader(line.decode("utf-8") for line in lines))
+
+
+def test_MappingFile_loads_json_and_csv():
+    import shutil
+    from nose.tools import assert_equal, assert_raises
+
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, "a.json"), "wb") as f:
+            f.write(b'{"<D1>": "ago", "<X9>": "new-department"}')
+        with open(os.path.join(directory, "b.csv"), "wb") as f:
+            f.write(b"code,department\r\n<D1>,ago\n\n<X9>, new-department\n")
+
+        expected = {"<D1>": "ago", "<X9>": "new-department"}
+        for name in ["a.json", "b.csv"]:
+            table = MappingFile(os.path.join(directory, name), directory)
+            assert_equal(table.mapping, expected)
+            assert_equal(table.index["<X9"], "new-department")
+
+        compiled = [name for name in os.listdir(directory)
+                    if name.endswith(COMPILED_SUFFIX)]
+        assert_equal(len(compiled), 2)
+
+        for name, content in [("c.json", b'["<D1>"]'),
+                              ("d.csv", b"D1,ago\n"),
+                              ("e.csv", b"<D1>,ago,extra\n"),
+                              ("g.json", b'{"<D1>": null}'),
+                              ("h.json", b'{"<D1>": 1}'),
+                              ("i.json", b'{"<>": "ago"}'),
+                              ("f.txt", b"<D1> ago\n")]:
+            path = os.path.join(directory, name)
+            with open(path, "wb") as f:
+                f.write(content)
+            with assert_raises(ValueError):
+                MappingFile(path, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_MappingFile_uses_compiled_table_and_reloads():
+    import shutil
+    from nose.tools import assert_equal
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "departments.json")
+    try:
+        with open(path, "wb") as f:
+            f.write(b'{"<D1>": "ago"}')
+        table = MappingFile(path, directory)
+        assert_equal(table.refresh(), 1)
+
+        # A second process finds the compiled table rather than parsing
+        (compiled,) = [name for name in os.listdir(directory)
+                       if name.endswith(COMPILED_SUFFIX)]
+        with open(os.path.join(directory, compiled), "wb") as f:
+            marshal.dump({"<D1>": "from-compiled"}, f)
+        assert_equal(MappingFile(path, directory).mapping,
+                     {"<D1>": "from-compiled"})
+
+        # but parses the file again if the compiled table is not a table
+        for planted in [["<D1>"], {"<D1>": 1}, {"D1": "ago"}]:
+            with open(os.path.join(directory, compiled), "wb") as f:
+                marshal.dump(planted, f)
+            assert_equal(MappingFile(path, directory).mapping,
+                         {"<D1>": "ago"})
+
+        with open(path, "wb") as f:
+            f.write(b'{"<D1>": "attorney-generals-office", "<D2>": "co"}')
+        os.utime(path, (0, 0))
+        assert_equal(table.refresh(), 2)
+        assert_equal(table.mapping["<D2>"], "co")
+        assert_equal(table.refresh(), 2)
+        assert_equal(len([name for name in os.listdir(directory)
+                          if name.endswith(COMPILED_SUFFIX)]), 1)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_private_cache_dir():
+    import shutil
+    from nose.tools import assert_equal
+
+    if not hasattr(os, "getuid"):
+        return
+    temporary, tempfile.tempdir = tempfile.tempdir, tempfile.mkdtemp()
+    try:
+        directory = private_cache_dir()
+        assert_equal(os.path.dirname(directory), tempfile.tempdir)
+        assert_equal(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        assert_equal(private_cache_dir(), directory)
+
+        # Not used if anyone else could write to it
+        os.chmod(directory, 0o777)
+        assert_equal(private_cache_dir(), None)
+        os.rmdir(directory)
+        os.symlink(tempfile.tempdir, directory)
+        assert_equal(private_cache_dir(), None)
+    finally:
+        shutil.rmtree(tempfile.tempdir)
+        tempfile.tempdir = temporary
@@ -0,0 +1,155 @@
+"""
+filter.py
+---------
+
+Drops the documents which do not match a predicate on one key, given in
+plugin strings as `Filter(key, op, value)`:
+
+    Filter("visits", ">", 0)
+    Filter("department", "not in", ["Cabinet Office", "HM Treasury"])
+    Filter("pagePath", "matches", "^/government/")
+
+`op` is one of the comparisons `==`, `!=`, `<`, `<=`, `>`, `>=`, `in` or
+`not in`, or `matches`, which keeps documents where the regular expression
+`value` matches somewhere in the key's value. Documents without the key are
+an error. The predicate is compiled once into a closure, and fuses with
+neighbouring row-wise plugins into a single loop.
+
+"""
+
+import operator
+import re
+
+from .columnar import ColumnBatch, filter_columns
+
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+OPS = sorted(COMPARISONS) + ["in", "not in", "matches"]
+
+
+class Filter(object):
+
+    row_wise = True
+    filters = True
+    writes = deletes = frozenset()
+
+    def __init__(self, key, op, value):
+        if op not in OPS:
+            raise ValueError("Unknown Filter op {0!r}, expected one of {1}"
+                             .format(op, ", ".join(OPS)))
+        self.key = key
+        self.op = op
+        self.value = value
+        self.reads = frozenset([key])
+        self.compile()
+
+    def compile(self):
+        key, op, value = self.key, self.op, self.value
+        if op in COMPARISONS:
+            compare = COMPARISONS[op]
+            self.test_value = lambda v: compare(v, value)
+        elif op == "matches":
+            search = re.compile(value).search
+            self.test_value = lambda v: search(v) is not None
+        else:
+            values = self.operand()
+            if op == "in":
+                self.test_value = lambda v: v in values
+            else:
+                self.test_value = lambda v: v not in values
+
+    def operand(self):
+        """
+        The value of an `in` or `not in`, as a frozenset if it can be.
+        """
+        try:
+            return frozenset(self.value)
+        except TypeError:
+            return list(self.value)
+
+    def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            return filter_columns(documents, self.key, self.test_value)
+        key, test_value = self.key, self.test_value
+        return [document for document in documents
+                if test_value(document[key])]
+
+    def fused_lines(self, bind):
+        value = "document[{0}]".format(bind(self.key))
+        if self.op in COMPARISONS:
+            test = "{0} {1} {2}".format(value, self.op, bind(self.value))
+        elif self.op == "matches":
+            test = "{0}({1}) is not None".format(
+                bind(re.compile(self.value).search), value)
+        else:
+            test = "{0} {1} {2}".format(value, self.op, bind(self.operand()))
+        return ["if not ({0}):".format(test), "    continue"]
+
+    def __repr__(self):
+        return "Filter({0!r}, {1!r}, {2!r})".format(self.key, self.op,
+                                                    self.value)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["test_value"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+
+def test_Filter():
+    from nose.tools import assert_equal
+
+    documents = [{"page": "/government/a", "visits": 0, "dept": "dft"},
+                 {"page": "/browse/b", "visits": 3, "dept": "hmrc"},
+                 {"page": "/government/c", "visits": 5, "dept": "co"}]
+
+    def pages(*args):
+        return [d["page"] for d in Filter(*args)(documents)]
+
+    assert_equal(pages("visits", ">", 0), ["/browse/b", "/government/c"])
+    assert_equal(pages("visits", "<=", 3), ["/government/a", "/browse/b"])
+    assert_equal(pages("visits", "==", 5), ["/government/c"])
+    assert_equal(pages("dept", "in", ["dft", "co"]),
+                 ["/government/a", "/government/c"])
+    assert_equal(pages("dept", "not in", ("dft", "co")), ["/browse/b"])
+    assert_equal(pages("page", "matches", "^/government/[b-z]"),
+                 ["/government/c"])
+
+
+def test_Filter_fused_and_columnar_match():
+    import pickle
+    from nose.tools import assert_equal, assert_raises
+    from .load_plugin import compile_plugins, load_plugins
+
+    documents = [{"a": i % 7, "b": "x{0}".format(i)} for i in range(50)]
+    plugin_strings = ["Filter('a', '>=', 2)", "Filter('a', '!=', 4)",
+                      "Filter('a', 'not in', [6])",
+                      "Filter('b', 'matches', '[1-3]$')"]
+    plugins = load_plugins(plugin_strings)
+
+    expected = documents
+    for plugin in plugins:
+        expected = plugin(expected)
+    assert_equal([d["a"] for d in expected], [2, 3, 5, 2, 3, 5])
+
+    (fused,) = compile_plugins(plugins)
+    assert_equal(fused([dict(d) for d in documents]), expected)
+
+    batch = ColumnBatch.from_documents(documents)
+    for plugin in plugins:
+        batch = pickle.loads(pickle.dumps(plugin))(batch)
+    assert_equal(batch.to_documents(), expected)
+
+    with assert_raises(ValueError):
+        Filter("a", "like", "b")
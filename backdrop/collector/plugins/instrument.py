@@ -0,0 +1,376 @@
+"""
+instrument.py
+-------------
+
+Optional per-plugin timing and counters, for finding out which plugin in a
+collector's configuration is making it slow.
+
+    instrumentation = Instrumentation(reporter=LogReporter())
+    plugins = load_plugins(plugin_names, instrumentation)
+    ...
+    instrumentation.stats  # one StageStats per plugin
+
+Without an `Instrumentation` the plugins are returned unwrapped, so it costs
+nothing when it is not being used.
+
+"""
+
+import logging
+import re
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock
+
+
+class StageStats(object):
+
+    """
+    Totals for one plugin over every call made to it. Times are in seconds,
+    `allocated` is the net change in traced memory in bytes, or None when
+    allocations are not being traced.
+    """
+
+    FIELDS = ("name", "calls", "wall_time", "cpu_time", "documents_in",
+              "documents_out", "allocated")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.documents_in = 0
+        self.documents_out = 0
+        self.allocated = None
+
+    def add(self, measurement, documents_in=0, documents_out=0):
+        wall, cpu, allocated = measurement
+        self.wall_time += wall
+        self.cpu_time += cpu
+        self.documents_in += documents_in
+        self.documents_out += documents_out
+        if allocated is not None:
+            self.allocated = (self.allocated or 0) + allocated
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __repr__(self):
+        return "StageStats({0})".format(", ".join(
+            "{0}={1!r}".format(field, getattr(self, field))
+            for field in self.FIELDS))
+
+
+class Instrumentation(object):
+
+    """
+    Wraps plugins so that each one records a `StageStats`, which is passed
+    to `reporter` (if any) after every call.
+
+    Allocations are only measured if `trace_allocations` is set (which starts
+    tracemalloc, and slows everything down) or tracemalloc is already tracing.
+    `close()` stops tracemalloc again if this started it.
+    """
+
+    def __init__(self, reporter=None, trace_allocations=False):
+        self.reporter = reporter
+        self.stats = []
+        self.started_tracing = False
+        if trace_allocations and tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+
+    def wrap(self, plugins, names=None):
+        plugins = list(plugins)
+        if names is None:
+            names = [type(plugin).__name__ for plugin in plugins]
+        return [self.wrap_plugin(plugin, name)
+                for plugin, name in zip(plugins, names)]
+
+    def wrap_plugin(self, plugin, name):
+        stats = StageStats(name)
+        self.stats.append(stats)
+        return InstrumentedPlugin(plugin, stats, self.reporter)
+
+    def as_dicts(self):
+        return [stats.as_dict() for stats in self.stats]
+
+    def close(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+
+class InstrumentedPlugin(object):
+
+    """
+    A plugin which records how long `plugin` takes and how many documents go
+    in and out of it. Row-wise and streaming plugins stay that way; time
+    spent upstream of a streaming plugin is not counted against it. The
+    keys `plugin` declares it reads, writes and deletes are declared by the
+    wrapper too, so that `optimise_plugins` can still move it.
+    """
+
+    def __init__(self, plugin, stats, reporter=None):
+        self.plugin = plugin
+        self.stats = stats
+        self.reporter = reporter
+        self.row_wise = getattr(plugin, "row_wise", False)
+        if hasattr(plugin, "stream"):
+            self.stream = self._stream
+        for name in ("reads", "writes", "deletes", "filters",
+                     "filter_commutes"):
+            if hasattr(plugin, name):
+                setattr(self, name, getattr(plugin, name))
+
+    def __call__(self, documents):
+        if not hasattr(documents, "__len__"):
+            documents = list(documents)
+        documents_in = len(documents)
+        start = snapshot()
+        output = self.plugin(documents)
+        if not hasattr(output, "__len__"):
+            output = list(output)
+        measurement = since(start)
+        self.record(measurement, documents_in, len(output))
+        return output
+
+    def _stream(self, chunks):
+        upstream = [(0.0, 0.0, None)]
+
+        def counted(chunks):
+            chunks = iter(chunks)
+            while True:
+                start = snapshot()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    upstream[0] = combine(upstream[0], since(start))
+                    return
+                upstream[0] = combine(upstream[0], since(start))
+                self.stats.documents_in += len(chunk)
+                yield chunk
+
+        output = iter(self.plugin.stream(counted(chunks)))
+        while True:
+            upstream[0] = (0.0, 0.0, None)
+            start = snapshot()
+            try:
+                chunk = next(output)
+            except StopIteration:
+                self.record(subtract(since(start), upstream[0]))
+                return
+            self.record(subtract(since(start), upstream[0]),
+                        documents_out=len(chunk))
+            yield chunk
+
+    def record(self, measurement, documents_in=0, documents_out=0):
+        self.stats.calls += 1
+        self.stats.add(measurement, documents_in, documents_out)
+        if self.reporter is not None:
+            self.reporter(self.stats)
+
+
+def snapshot():
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        allocated = tracemalloc.get_traced_memory()[0]
+    else:
+        allocated = None
+    return time.time(), cpu_time(), allocated
+
+
+def since(start):
+    now = snapshot()
+    allocated = None
+    if start[2] is not None and now[2] is not None:
+        allocated = now[2] - start[2]
+    return now[0] - start[0], now[1] - start[1], allocated
+
+
+def combine(a, b):
+    allocated = None
+    if a[2] is not None or b[2] is not None:
+        allocated = (a[2] or 0) + (b[2] or 0)
+    return a[0] + b[0], a[1] + b[1], allocated
+
+
+def subtract(a, b):
+    return combine(a, (-b[0], -b[1], -b[2] if b[2] is not None else None))
+
+
+class LogReporter(object):
+
+    """
+    Reports each stage's running totals as a log line.
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, stats):
+        self.logger.log(
+            self.level,
+            "plugin %s: calls=%d wall=%.6fs cpu=%.6fs in=%d out=%d "
+            "allocated=%s", stats.name, stats.calls, stats.wall_time,
+            stats.cpu_time, stats.documents_in, stats.documents_out,
+            stats.allocated)
+
+
+class StatsdReporter(object):
+
+    """
+    Reports each call in the style of statsd: `send(metric, value, kind)`
+    where `kind` is "ms" for timers and "c" for counters, and metric names
+    are `prefix.<plugin name>.<measurement>`.
+    """
+
+    def __init__(self, send, prefix="backdrop.collector.plugins"):
+        self.send = send
+        self.prefix = prefix
+        self.previous = {}
+
+    def __call__(self, stats):
+        name = "{0}.{1}".format(self.prefix, metric_name(stats.name))
+        previous = self.previous.get(id(stats), StageStats(stats.name))
+
+        self.send(name + ".wall_time",
+                  (stats.wall_time - previous.wall_time) * 1000, "ms")
+        self.send(name + ".cpu_time",
+                  (stats.cpu_time - previous.cpu_time) * 1000, "ms")
+        self.send(name + ".documents_in",
+                  stats.documents_in - previous.documents_in, "c")
+        self.send(name + ".documents_out",
+                  stats.documents_out - previous.documents_out, "c")
+
+        copy = StageStats(stats.name)
+        copy.add((stats.wall_time, stats.cpu_time, None),
+                 stats.documents_in, stats.documents_out)
+        self.previous[id(stats)] = copy
+
+
+def metric_name(plugin_name):
+    """
+    Turn a plugin string such as `RemoveKey('a', 'b')` into something
+    usable in a metric name: `RemoveKey_a_b`.
+    """
+    return re.sub(r"[^A-Za-z0-9]+", "_", plugin_name).strip("_")
+
+
+def test_Instrumentation_records_each_stage():
+    from nose.tools import assert_equal
+    from .aggregate import AggregateKey, aggregate_count
+    from .remove_key import RemoveKey
+
+    instrumentation = Instrumentation()
+    plugins = instrumentation.wrap(
+        [RemoveKey("b"), AggregateKey(aggregate_count("c"))],
+        ["RemoveKey('b')", "AggregateKey(aggregate_count('c'))"])
+
+    documents = [{"a": i % 2, "b": i, "c": 1} for i in range(5)]
+    for plugin in plugins:
+        documents = plugin(documents)
+
+    remove_key, aggregate_key = instrumentation.stats
+    assert_equal((remove_key.name, remove_key.calls, remove_key.documents_in,
+                  remove_key.documents_out), ("RemoveKey('b')", 1, 5, 5))
+    assert_equal((aggregate_key.documents_in, aggregate_key.documents_out),
+                 (5, 2))
+    assert remove_key.wall_time >= 0
+
+
+def test_InstrumentedPlugin_declares_keys():
+    from nose.tools import assert_equal
+    from .department import ComputeDepartmentKey
+    from .filter import Filter
+    from .optimise import optimise_plugins
+
+    department, filter = Instrumentation().wrap(
+        [ComputeDepartmentKey("c"), Filter("a", ">", 1)])
+
+    assert_equal(department.writes, frozenset(["department"]))
+    assert_equal(optimise_plugins([department, filter]), [filter, department])
+
+
+def test_Instrumentation_keeps_streaming():
+    from nose.tools import assert_equal, assert_true
+    from .pipeline import Pipeline
+    from .rank import ComputeRank
+    from .remove_key import RemoveKey
+
+    instrumentation = Instrumentation()
+    plugins = instrumentation.wrap([RemoveKey("b"), ComputeRank("rank")])
+    assert_true(plugins[0].row_wise)
+    assert_true(hasattr(plugins[1], "stream"))
+
+    output = Pipeline(plugins, chunk_size=2)([{"b": i} for i in range(5)])
+
+    assert_equal(output, [{"rank": i} for i in range(1, 6)])
+    rank = instrumentation.stats[1]
+    assert_equal((rank.documents_in, rank.documents_out), (5, 5))
+
+
+def test_InstrumentedPlugin_counts_iterators():
+    from nose.tools import assert_equal
+
+    class Consuming(object):
+        def __call__(self, documents):
+            return (document for document in documents if document["b"])
+
+    instrumentation = Instrumentation()
+    plugin = instrumentation.wrap([Consuming()])[0]
+
+    output = plugin(iter([{"b": i} for i in range(5)]))
+
+    assert_equal(output, [{"b": i} for i in range(1, 5)])
+    stats = instrumentation.stats[0]
+    assert_equal((stats.documents_in, stats.documents_out), (5, 4))
+
+
+def test_Instrumentation_only_stops_tracing_it_started():
+    from nose.tools import assert_false, assert_true
+    if tracemalloc is None:
+        return
+
+    tracemalloc.start()
+    try:
+        instrumentation = Instrumentation(trace_allocations=True)
+        instrumentation.close()
+        assert_true(tracemalloc.is_tracing())
+    finally:
+        tracemalloc.stop()
+
+    instrumentation = Instrumentation(trace_allocations=True)
+    assert_true(tracemalloc.is_tracing())
+    instrumentation.close()
+    assert_false(tracemalloc.is_tracing())
+
+
+def test_StatsdReporter_sends_increments():
+    from nose.tools import assert_equal
+
+    sent = []
+    reporter = StatsdReporter(lambda *metric: sent.append(metric),
+                              prefix="test")
+    stats = StageStats("RemoveKey('b')")
+
+    stats.add((0.5, 0.25, None), 3, 3)
+    reporter(stats)
+    stats.add((0.5, 0.25, None), 2, 1)
+    reporter(stats)
+
+    assert_equal(sent[-4:], [
+        ("test.RemoveKey_b.wall_time", 500.0, "ms"),
+        ("test.RemoveKey_b.cpu_time", 250.0, "ms"),
+        ("test.RemoveKey_b.documents_in", 2, "c"),
+        ("test.RemoveKey_b.documents_out", 1, "c"),
+    ])
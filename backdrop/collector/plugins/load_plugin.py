@@ -4,26 +4,211 @@ load_plugin.py
 
 Responsible for taking plugin strings and returning plugin callables.
 
+A plugin string is a call to one of the plugins or aggregation functions
+named in `backdrop.collector.plugins.PLUGIN_NAMES`, whose arguments are
+literals or further such calls, for example:
+
+    AggregateKey(aggregate_count("visits"), aggregate_rate("rate", "visits"))
+
+Strings are parsed once per process, so loading many collector
+configurations which share plugin strings is cheap, but every call to
+`load_plugins` or `load_pipeline` builds new plugins, so that collectors
+never share a plugin's caches, counters or connections.
+
 """
 
-# For the linter
-import __builtin__
+import ast
 
 import backdrop.collector.plugins
 
-from backdrop.collector.plugins import AggregateKey, ComputeDepartmentKey
+from backdrop.collector.plugins.pipeline import DEFAULT_CHUNK_SIZE, Pipeline
+
+
+_specs = {}
+
+
+def load_plugins(plugin_names, instrumentation=None):
+    """
+    Load each of `plugin_names`. If an `Instrumentation` is given, each plugin
+    is wrapped so that it records its timings under its plugin string.
+    """
+    plugins = [load_plugin(plugin_name) for plugin_name in plugin_names]
+    if instrumentation is not None:
+        return instrumentation.wrap(plugins, plugin_names)
+    return plugins
+
+
+def load_pipeline(plugin_names, chunk_size=DEFAULT_CHUNK_SIZE,
+                  instrumentation=None, optimise=False):
+    """
+    Load `plugin_names` as a single `Pipeline` which streams documents
+    through the plugins `chunk_size` at a time. With `optimise=True` the
+    plugins are first rewritten by `optimise_plugins`. Instrumented plugins
+    are wrapped after optimising, so that the timings are of the plan which
+    runs, and are not fused, so that each keeps its own timings.
+    """
+    plugins = load_plugins(plugin_names)
+    names = list(plugin_names)
+    if optimise:
+        from .optimise import Optimiser
+        optimiser = Optimiser(plugins, names).run()
+        plugins = optimiser.plugins
+        names = [stage.name for stage in optimiser.stages]
+    if instrumentation is not None:
+        plugins = instrumentation.wrap(plugins, names)
+    return Pipeline(compile_plugins(plugins), chunk_size)
+
+
+def clear_caches():
+    """
+    Forget every parsed plugin string.
+    """
+    _specs.clear()
+
+
+def compile_plugins(plugins):
+    """
+    Replace each run of adjacent plugins which can be fused (those with a
+    `fused_lines` method) with a single `FusedPlugins`, so that every document
+    is visited once per run instead of once per plugin.
+    """
+    compiled, run = [], []
+
+    for plugin in list(plugins) + [None]:
+        if hasattr(plugin, "fused_lines"):
+            run.append(plugin)
+            continue
+
+        if len(run) > 1:
+            compiled.append(FusedPlugins(run))
+        else:
+            compiled.extend(run)
+        run = []
+
+        if plugin is not None:
+            compiled.append(plugin)
+
+    return compiled
+
+
+class FusedPlugins(object):
+
+    """
+    Several row-wise plugins compiled into one loop over the documents.
+
+    Each plugin's `fused_lines(bind)` returns the statements it applies to
+    `document`; `bind(value)` returns a name by which the generated code can
+    refer to `value`. A statement may `continue` to drop the document.
+    Plugins may also have `fused_setup(bind)` and `fused_teardown(bind)`,
+    which return statements to run before and after the loop.
+    """
+
+    row_wise = True
+
+    def __init__(self, plugins):
+        self.plugins = list(plugins)
+        self.source, self.function = compile_fused(self.plugins)
 
+    def __call__(self, documents):
+        return self.function(documents)
 
-def load_plugins(plugin_names):
-    return [load_plugin(plugin_name) for plugin_name in plugin_names]
+    def __getstate__(self):
+        return {"plugins": self.plugins}
+
+    def __setstate__(self, state):
+        self.__init__(state["plugins"])
+
+
+def compile_fused(plugins):
+    namespace, names = {}, {}
+
+    def bind(value):
+        name = names.get(id(value))
+        if name is None:
+            name = names[id(value)] = "_{0}".format(len(namespace))
+            namespace[name] = value
+        return name
+
+    def lines(method):
+        return [line for plugin in plugins if hasattr(plugin, method)
+                for line in getattr(plugin, method)(bind)]
+
+    setup = lines("fused_setup")
+    body = lines("fused_lines")
+    teardown = lines("fused_teardown")
+
+    source = "\n".join(
+        ["def fused(documents):",
+         "    output = []",
+         "    append = output.append"] +
+        ["    " + line for line in setup] +
+        ["    for document in documents:"] +
+        ["        " + line for line in body] +
+        ["        append(document)"] +
+        ["    " + line for line in teardown] +
+        ["    return output"])
+
+    exec(compile(source, "<fused plugins>", "exec"), namespace)
+    return source, namespace["fused"]
 
 
 def load_plugin(plugin_name):
+    spec = _specs.get(plugin_name)
+    if spec is None:
+        spec = _specs[plugin_name] = parse_plugin(plugin_name)
+    return build(spec)
+
+
+def parse_plugin(plugin_name):
+    """
+    Parse a plugin string into a spec: `("literal", value)` or
+    `("call", name, (arg_spec...), ((keyword, spec)...))`. Raises ValueError
+    for anything else.
+    """
+    try:
+        tree = ast.parse(plugin_name.strip(), "backdrop.collector plugin",
+                         "eval")
+    except SyntaxError as e:
+        raise ValueError("Invalid plugin {0!r}: {1}".format(plugin_name, e))
+    return parse_node(tree.body, plugin_name)
+
 
-    expr = compile(plugin_name, "backdrop.collector plugin", "eval")
+def parse_node(node, plugin_name):
+    if not isinstance(node, ast.Call):
+        try:
+            return ("literal", ast.literal_eval(node))
+        except ValueError:
+            raise ValueError("Invalid plugin {0!r}: arguments must be "
+                             "literals or calls to plugins".format(
+                                 plugin_name))
 
-    return eval(expr, __builtin__.__dict__,
-                backdrop.collector.plugins.__dict__)
+    if not (isinstance(node.func, ast.Name) and
+            node.func.id in backdrop.collector.plugins.PLUGIN_NAMES):
+        raise ValueError("Invalid plugin {0!r}: only plugins and aggregation "
+                         "functions can be called".format(plugin_name))
+
+    starred = [arg for arg in node.args
+               if type(arg).__name__ == "Starred"]
+    if (starred or getattr(node, "starargs", None) or
+            getattr(node, "kwargs", None) or
+            any(keyword.arg is None for keyword in node.keywords)):
+        raise ValueError("Invalid plugin {0!r}: * and ** arguments are not "
+                         "allowed".format(plugin_name))
+
+    return ("call", node.func.id,
+            tuple(parse_node(arg, plugin_name) for arg in node.args),
+            tuple((keyword.arg, parse_node(keyword.value, plugin_name))
+                  for keyword in node.keywords))
+
+
+def build(spec):
+    if spec[0] == "literal":
+        return spec[1]
+    _, name, args, keywords = spec
+    function = getattr(backdrop.collector.plugins, name)
+    return function(*[build(arg) for arg in args],
+                    **dict((keyword, build(value))
+                           for keyword, value in keywords))
 
 
 def test_load_plugin_trivial():
@@ -34,6 +219,7 @@ def test_load_plugin_trivial():
 
 def test_load_plugin_compute_department_key():
     from nose.tools import assert_is_instance
+    from backdrop.collector.plugins import ComputeDepartmentKey
 
     plugin = load_plugin('ComputeDepartmentKey("customVarValue9")')
     assert_is_instance(plugin, ComputeDepartmentKey)
@@ -41,7 +227,176 @@ def test_load_plugin_compute_department_key():
 
 def test_load_plugin_compute_aggregate_key():
     from nose.tools import assert_is_instance
+    from backdrop.collector.plugins import AggregateKey
 
     plugin = load_plugin('AggregateKey(aggregate_count("visits"),'
                          '             aggregate_rate("rate", "visits"))')
     assert_is_instance(plugin, AggregateKey)
+
+
+def test_load_pipeline():
+    from nose.tools import assert_equal, assert_is_instance
+
+    pipeline = load_pipeline(['RemoveKey("b")', 'ComputeRank("rank")'],
+                             chunk_size=2)
+    assert_is_instance(pipeline, Pipeline)
+
+    assert_equal(pipeline([{"a": 1, "b": 1}, {"a": 2, "b": 2},
+                           {"a": 3, "b": 3}]),
+                 [{"a": 1, "rank": 1}, {"a": 2, "rank": 2},
+                  {"a": 3, "rank": 3}])
+
+
+def test_load_pipeline_optimised():
+    from nose.tools import assert_equal, assert_is_instance
+    from backdrop.collector.plugins import RemoveKey
+
+    plugin_names = ['ComputeRank("rank")', 'Comment("b is not needed")',
+                    'RemoveKey("b")']
+    pipeline = load_pipeline(plugin_names, optimise=True)
+    (remove, rank) = pipeline.plugins
+    assert_is_instance(remove, RemoveKey)
+
+    assert_equal(pipeline([{"a": 1, "b": 1}, {"a": 2, "b": 2}]),
+                 load_pipeline(plugin_names)([{"a": 1, "b": 1},
+                                              {"a": 2, "b": 2}]))
+
+
+def test_compile_plugins_fuses_adjacent_row_wise_plugins():
+    from nose.tools import assert_equal, assert_is_instance
+
+    plugins = compile_plugins(load_plugins([
+        'ComputeDepartmentKey("customVarValue9")',
+        'Comment("drop the raw codes")',
+        'RemoveKey("customVarValue9")',
+        'AggregateKey(aggregate_count("visits"))',
+        'ComputeIdFrom("department")',
+    ]))
+
+    assert_equal([type(plugin).__name__ for plugin in plugins],
+                 ["FusedPlugins", "AggregateKey", "ComputeIdFrom"])
+    assert_is_instance(plugins[0], FusedPlugins)
+    assert_equal(len(plugins[0].plugins), 3)
+
+
+def test_FusedPlugins_matches_plugin_by_plugin():
+    from nose.tools import assert_equal
+
+    plugin_names = [
+        'ComputeDepartmentKey("customVarValue9")',
+        'RemoveKey("customVarValue9")',
+        'SetDepartment("<D2>")',
+        'ComputeIdFrom("_timestamp", "department", "visits")',
+    ]
+
+    def documents():
+        import datetime
+        import pytz
+        timestamp = datetime.datetime(2013, 10, 1, tzinfo=pytz.UTC)
+        return [{"_timestamp": timestamp, "customVarValue9": code,
+                 "visits": i}
+                for i, code in enumerate(["<D1>", u"<D10><D1>", "<Dx>"])]
+
+    expected = documents()
+    for plugin in load_plugins(plugin_names):
+        expected = plugin(expected)
+
+    (fused,) = compile_plugins(load_plugins(plugin_names))
+
+    assert_equal(fused(documents()), expected)
+
+
+def test_FusedPlugins_keeps_assertions():
+    from nose.tools import assert_raises
+
+    (fused,) = compile_plugins(load_plugins([
+        'ComputeDepartmentKey("customVarValue9")',
+        'RemoveKey("customVarValue9")',
+    ]))
+
+    with assert_raises(AssertionError):
+        fused([{"foo": "<D1>"}])
+
+
+def test_load_plugins_instrumented():
+    from nose.tools import assert_equal
+    from backdrop.collector.plugins.instrument import Instrumentation
+
+    instrumentation = Instrumentation()
+    (plugin,) = load_plugins(['RemoveKey("b")'], instrumentation)
+    plugin([{"b": 1}])
+
+    (stats,) = instrumentation.stats
+    assert_equal((stats.name, stats.documents_in), ('RemoveKey("b")', 1))
+
+
+def test_load_pipeline_instrumented_and_optimised():
+    from nose.tools import assert_equal
+    from backdrop.collector.plugins.instrument import Instrumentation
+
+    instrumentation = Instrumentation()
+    pipeline = load_pipeline(['ComputeRank("rank")', 'Comment("no-op")',
+                              'RemoveKey("b")'],
+                             instrumentation=instrumentation, optimise=True)
+    pipeline([{"a": 1, "b": 1}])
+
+    assert_equal([stats.name for stats in instrumentation.stats],
+                 ['RemoveKey("b")', 'ComputeRank("rank")'])
+
+
+def test_FusedPlugins_counts_department_cache_hits():
+    from nose.tools import assert_equal
+
+    plugins = load_plugins(['ComputeDepartmentKey("customVarValue9")',
+                            'RemoveKey("customVarValue9")'])
+    (fused,) = compile_plugins(plugins)
+
+    fused([{"customVarValue9": code} for code in ["<D1>", "<D2>", "<D1>"]])
+
+    cache = plugins[0].cache
+    assert_equal((cache.hits, cache.misses), (1, 2))
+
+
+def test_parse_plugin():
+    from nose.tools import assert_equal
+
+    assert_equal(parse_plugin("ComputeIdFrom('a', id_scheme=u'digest')"),
+                 ("call", "ComputeIdFrom", (("literal", "a"),),
+                  (("id_scheme", ("literal", u"digest")),)))
+    assert_equal(parse_plugin("AggregateKey(aggregate_count('v'))"),
+                 ("call", "AggregateKey",
+                  (("call", "aggregate_count", (("literal", "v"),), ()),),
+                  ()))
+
+
+def test_parse_plugin_rejects_everything_else():
+    from nose.tools import assert_raises
+
+    for plugin_name in ["__import__('os').system('true')",
+                        "open('/etc/passwd')",
+                        "RemoveKey(*['a'])",
+                        "RemoveKey(**{'a': 1})",
+                        "RemoveKey(aggregate.os)",
+                        "AggregateKey(('v', lambda docs: 0))",
+                        "RemoveKey('a').__class__",
+                        "RemoveKey('a'",
+                        "load_plugins(['Comment(1)'])",
+                        "HTTPSink('http://example.com/')",
+                        "ParallelExecutor([])",
+                        "records(record_type(['a']), [])"]:
+        with assert_raises(ValueError):
+            parse_plugin(plugin_name)
+
+
+def test_load_plugins_builds_fresh_plugins():
+    from nose.tools import assert_equal, assert_in, assert_is_not
+
+    plugin_names = ['Deduplicate()', 'ComputeRank("rank")']
+
+    first, second = load_plugins(plugin_names), load_plugins(plugin_names)
+    assert_is_not(first[0], second[0])
+    assert_is_not(load_pipeline(plugin_names), load_pipeline(plugin_names))
+    assert_in(plugin_names[0], _specs)
+
+    first[0]([{"_id": 1}, {"_id": 1}])
+    assert_equal((first[0].duplicates, second[0].duplicates), (1, 0))
@@ -0,0 +1,361 @@
+"""
+optimise.py
+-----------
+
+Rewrites a chain of plugins into a cheaper one which gives the same output.
+
+Plugins describe what they do to documents with three sets of keys:
+
+* `reads`: the keys whose values the plugin's output depends on. `None`
+  means any key, as for `AggregateKey`, which groups by every key it does
+  not aggregate. Declaring a set promises that each output document is an
+  input document with `writes` set and `deletes` removed, and that which
+  documents come out, and in what order, depends only on `reads`.
+* `writes`: the keys it sets.
+* `deletes`: the keys it removes.
+
+Plugins without `reads` are left where they are, and nothing moves past
+them. Plugins with `filters = True` only drop documents. A plugin which is
+not `row_wise` can say that dropping documents before it is the same as
+dropping them after it with `filter_commutes(keys)`.
+
+The rewrites are:
+
+* Plugins which read, write and delete nothing, such as `Comment`, are
+  dropped.
+* A row-wise plugin whose writes are all replaced or removed before anything
+  reads them is dropped, and the keys it wrote which were removed are then
+  removed with `missing_ok=True`.
+* Filters move ahead of every plugin which does not write or delete the keys
+  they read and which they commute with, and `RemoveKey`s move ahead of
+  every plugin which does not touch their keys, so that later stages handle
+  fewer and smaller documents. A `RemoveKey` never moves ahead of
+  `AggregateKey`, since removing a key before grouping changes the groups.
+* Adjacent `RemoveKey`s are merged.
+
+A chain can raise an error on bad input, such as a missing key, where its
+original would have too but the optimised chain drops the document or the
+key first, so it may fail less often; it never fails where the original
+succeeded. Plugins are not changed, only rearranged.
+
+"""
+
+from .remove_key import RemoveKey
+
+
+class Stage(object):
+
+    def __init__(self, plugin, name):
+        self.plugin = plugin
+        self.name = name
+
+    @property
+    def declared(self):
+        return getattr(self.plugin, "reads", None) is not None
+
+    @property
+    def reads(self):
+        return self.plugin.reads
+
+    @property
+    def writes(self):
+        return getattr(self.plugin, "writes", frozenset())
+
+    @property
+    def deletes(self):
+        return getattr(self.plugin, "deletes", frozenset())
+
+    @property
+    def touches(self):
+        return self.reads | self.writes | self.deletes
+
+    @property
+    def row_wise(self):
+        return getattr(self.plugin, "row_wise", False)
+
+    @property
+    def filters(self):
+        return getattr(self.plugin, "filters", False)
+
+    @property
+    def is_projection(self):
+        return isinstance(self.plugin, RemoveKey)
+
+
+class Optimiser(object):
+
+    """
+    Applies the rewrites to `plugins` until none apply, noting each one.
+    `names` are used to describe the plugins, and default to their reprs.
+    """
+
+    def __init__(self, plugins, names=None):
+        if names is None:
+            names = [describe(plugin) for plugin in plugins]
+        self.stages = [Stage(plugin, name)
+                       for plugin, name in zip(plugins, names)]
+        self.notes = []
+
+    @property
+    def plugins(self):
+        return [stage.plugin for stage in self.stages]
+
+    def run(self):
+        # Earlier rewrites are tried again before moving on to later ones
+        while (self.drop_no_ops() or self.drop_dead_writes() or
+               self.hoist() or self.merge_projections()):
+            pass
+        return self
+
+    def drop_no_ops(self):
+        changed = False
+        for stage in list(self.stages):
+            if (stage.declared and stage.row_wise and not stage.filters and
+                    not stage.touches):
+                self.stages.remove(stage)
+                self.notes.append("dropped {0}, which has no effect".format(
+                    stage.name))
+                changed = True
+        return changed
+
+    def drop_dead_writes(self):
+        for i, stage in enumerate(self.stages):
+            if not (stage.declared and stage.row_wise and stage.writes and
+                    not stage.deletes and not stage.filters):
+                continue
+            live, removals = set(stage.writes), []
+            for later in self.stages[i + 1:]:
+                if not later.declared or later.reads & live:
+                    break
+                if later.is_projection and later.deletes & live:
+                    removals.append(later)
+                elif later.deletes & live:
+                    break
+                live -= later.writes | later.deletes
+                if not live:
+                    break
+            if live:
+                continue
+
+            self.stages.remove(stage)
+            for removal in removals:
+                self.tolerate_missing(removal, stage.writes)
+            self.notes.append("dropped {0}, since {1} replaced or removed "
+                              "before being read".format(
+                                  stage.name, describe_keys(stage.writes)))
+            return True
+        return False
+
+    def tolerate_missing(self, stage, keys):
+        """
+        Split the keys `stage` removes into those it always finds and those
+        in `keys`, which it may no longer.
+        """
+        plugin = stage.plugin
+        found = [key for key in plugin.remove_keys if key not in keys]
+        missing = [key for key in plugin.remove_keys if key in keys]
+        replacements = [RemoveKey(*missing, missing_ok=True)]
+        if found:
+            replacements.insert(0, RemoveKey(*found,
+                                             missing_ok=plugin.missing_ok))
+        i = self.stages.index(stage)
+        self.stages[i:i + 1] = [Stage(replacement, describe(replacement))
+                                for replacement in replacements]
+
+    def hoist(self):
+        changed = False
+        for i in range(1, len(self.stages)):
+            stage = self.stages[i]
+            j = i
+            while j > 0 and can_hoist(stage, self.stages[j - 1]):
+                j -= 1
+            if j < i:
+                passed = self.stages[j:i]
+                self.stages[j:i + 1] = [stage] + passed
+                self.notes.append("moved {0} ahead of {1}".format(
+                    stage.name, ", ".join(other.name for other in passed)))
+                changed = True
+        return changed
+
+    def merge_projections(self):
+        for i in range(len(self.stages) - 1):
+            first, second = self.stages[i], self.stages[i + 1]
+            if not (first.is_projection and second.is_projection and
+                    first.plugin.missing_ok == second.plugin.missing_ok):
+                continue
+            keys = list(first.plugin.remove_keys)
+            keys.extend(key for key in second.plugin.remove_keys
+                        if key not in keys)
+            merged = RemoveKey(*keys, missing_ok=first.plugin.missing_ok)
+            self.stages[i:i + 2] = [Stage(merged, describe(merged))]
+            self.notes.append("merged {0} and {1}".format(first.name,
+                                                          second.name))
+            return True
+        return False
+
+    def explain(self):
+        lines = ["Plan:"]
+        lines.extend("  {0}".format(stage.name) for stage in self.stages)
+        if self.notes:
+            lines.append("Rewrites:")
+            lines.extend("  {0}".format(note) for note in self.notes)
+        else:
+            lines.append("No rewrites.")
+        return "\n".join(lines)
+
+
+def can_hoist(stage, other):
+    """
+    Whether `stage` can run before `other` rather than after it.
+    """
+    if stage.filters:
+        if other.filters:
+            return False
+        if hasattr(other.plugin, "filter_commutes"):
+            return other.plugin.filter_commutes(stage.reads)
+        return (other.declared and other.row_wise and
+                not stage.reads & (other.writes | other.deletes))
+
+    if stage.is_projection:
+        if other.filters or other.is_projection or not other.declared:
+            return False
+        return not stage.plugin.deletes & other.touches
+
+    return False
+
+
+def optimise_plugins(plugins):
+    """
+    Return a cheaper list of plugins which gives the same output as
+    `plugins`.
+    """
+    return Optimiser(plugins).run().plugins
+
+
+def explain(plugin_names):
+    """
+    Describe how the plugins loaded from `plugin_names` would be optimised.
+    """
+    from .load_plugin import load_plugins
+
+    plugins = load_plugins(plugin_names)
+    return Optimiser(plugins, plugin_names).run().explain()
+
+
+def describe(plugin):
+    if type(plugin).__repr__ is not object.__repr__:
+        return repr(plugin)
+    return type(plugin).__name__
+
+
+def describe_keys(keys):
+    keys = sorted(keys)
+    if len(keys) == 1:
+        return "{0!r} is".format(keys[0])
+    return "{0} are".format(", ".join(repr(key) for key in keys))
+
+
+def test_optimise_plugins():
+    from nose.tools import assert_equal
+    from .load_plugin import load_plugins
+
+    plugin_names = [
+        "SetDepartment('<D1>')",
+        "Comment('department is not wanted after all')",
+        "ComputeDepartmentKey('customVarValue9')",
+        "ComputeIdFrom('customVarValue9')",
+        "RemoveKey('department')",
+        "SortBy('visits')",
+        "RemoveKey('customVarValue9')",
+        "ComputeRank('rank')",
+        "RemoveKey('humanId')",
+    ]
+
+    assert_equal(explain(plugin_names).split("\n"), [
+        "Plan:",
+        "  RemoveKey('department', missing_ok=True)",
+        "  ComputeIdFrom('customVarValue9')",
+        "  RemoveKey('customVarValue9', 'humanId')",
+        "  SortBy('visits')",
+        "  ComputeRank('rank')",
+        "Rewrites:",
+        "  dropped Comment('department is not wanted after all'), which has "
+        "no effect",
+        "  dropped SetDepartment('<D1>'), since 'department' is replaced or "
+        "removed before being read",
+        "  dropped ComputeDepartmentKey('customVarValue9'), since "
+        "'department' is replaced or removed before being read",
+        "  moved RemoveKey('department', missing_ok=True) ahead of "
+        "ComputeIdFrom('customVarValue9')",
+        "  moved RemoveKey('customVarValue9') ahead of SortBy('visits')",
+        "  moved RemoveKey('humanId') ahead of SortBy('visits'), "
+        "ComputeRank('rank')",
+        "  merged RemoveKey('customVarValue9') and RemoveKey('humanId')",
+    ])
+
+    def run(plugins, documents):
+        for plugin in plugins:
+            documents = plugin(documents)
+        return documents
+
+    def documents():
+        return [{"customVarValue9": "<D{0}>".format(i), "visits": 5 - i}
+                for i in range(5)] + [{"customVarValue9": "<D7>", "visits": 3,
+                                       "department": "y"}]
+
+    plugins = load_plugins(plugin_names)
+    assert_equal(run(optimise_plugins(plugins), documents()),
+                 run(plugins, documents()))
+
+
+def test_optimise_plugins_keeps_AggregateKey_groups():
+    from nose.tools import assert_equal
+    from .load_plugin import load_plugins
+
+    plugin_names = ["ComputeDepartmentKey('customVarValue9')",
+                    "AggregateKey(aggregate_count('visits'))",
+                    "RemoveKey('department')",
+                    "RemoveKey('customVarValue9')"]
+
+    assert_equal(explain(plugin_names).split("\n"), [
+        "Plan:",
+        "  ComputeDepartmentKey('customVarValue9')",
+        "  AggregateKey(aggregate_count('visits'))",
+        "  RemoveKey('department', 'customVarValue9')",
+        "Rewrites:",
+        "  merged RemoveKey('department') and RemoveKey('customVarValue9')",
+    ])
+
+
+def test_optimise_plugins_hoists_filters():
+    from nose.tools import assert_equal
+    from .load_plugin import load_plugins
+
+    plugin_names = ["ComputeDepartmentKey('customVarValue9')",
+                    "RemoveKey('customVarValue9')",
+                    "AggregateKey(aggregate_count('visits'))",
+                    "ComputeIdFrom('department')",
+                    "Filter('department', '!=', 'cabinet-office')",
+                    "Filter('visits', '>', 2)"]
+
+    assert_equal(explain(plugin_names).split("\n")[1:7], [
+        "  ComputeDepartmentKey('customVarValue9')",
+        "  Filter('department', '!=', 'cabinet-office')",
+        "  RemoveKey('customVarValue9')",
+        "  AggregateKey(aggregate_count('visits'))",
+        "  Filter('visits', '>', 2)",
+        "  ComputeIdFrom('department')",
+    ])
+
+    documents = [{"customVarValue9": code, "visits": visits}
+                 for code, visits in [("<D1>", 1), ("<D2>", 1), ("<D1>", 2),
+                                      ("<D3>", 2), ("<D4>", 5)]]
+    plugins = load_plugins(plugin_names)
+    expected = [dict(d) for d in documents]
+    for plugin in plugins:
+        expected = plugin(expected)
+    output = [dict(d) for d in documents]
+    for plugin in optimise_plugins(plugins):
+        output = plugin(output)
+    assert_equal(output, expected)
+    assert_equal(len(output), 2)
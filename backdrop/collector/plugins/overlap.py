@@ -0,0 +1,364 @@
+"""
+overlap.py
+----------
+
+Runs a collector's three phases, fetching pages of GA results, running the
+plugins and uploading the output, at the same time rather than one after the
+other.
+
+    runner = OverlappedRunner(load_pipeline(plugin_names),
+                              HTTPSink(url, token))
+    runner.run(fetch_pages())
+
+Pages are fetched on one thread and uploaded on another, and the plugins run
+on the calling thread, connected by queues of at most `queue_size` pages. A
+full queue blocks the stage which fills it, so a slow upload slows fetching
+down rather than letting pages pile up in memory.
+
+Any plugin works: plugins are run with the same `stage` as `Pipeline`, so
+row-wise plugins handle each page as it arrives, plugins with `stream` see
+the pages one at a time, and anything else waits for every page. Python 2
+has no asyncio, so the phases overlap on threads; fetching and uploading
+spend their time waiting on the network, which releases the GIL.
+
+"""
+
+import json
+import sys
+import threading
+
+try:
+    from queue import Empty, Full, Queue
+    from urllib.request import Request, urlopen
+except ImportError:
+    from Queue import Empty, Full, Queue
+    from urllib2 import Request, urlopen
+
+from .batch import Batch
+from .compute_id import FieldFormatter
+from .pipeline import DEFAULT_CHUNK_SIZE, stage
+
+
+DEFAULT_QUEUE_SIZE = 4
+# How often blocked threads check whether another has failed, in seconds
+POLL_INTERVAL = 0.05
+
+_END = object()
+
+
+class Aborted(Exception):
+    """
+    Raised in a stage when another has failed.
+    """
+
+
+class Failure(object):
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+if sys.version_info[0] >= 3:
+    def reraise(exc_info):
+        """
+        Raise the exception of `sys.exc_info()`, with its traceback.
+        """
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec("""def reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
+""")
+
+
+class OverlappedRunner(object):
+
+    """
+    Feeds pages of documents from an iterable through `plugin` (such as a
+    `Pipeline`) and hands each page of output to `sink`, with fetching,
+    processing and `sink` running concurrently.
+    """
+
+    def __init__(self, plugin, sink, queue_size=DEFAULT_QUEUE_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.plugin = plugin
+        self.sink = sink
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+
+    def run(self, pages):
+        """
+        Process every page of `pages`, returning the number of documents
+        handed to the sink. An error in any stage stops the others and is
+        raised here.
+        """
+        stop = threading.Event()
+        fetched, processed = Queue(self.queue_size), Queue(self.queue_size)
+        errors, sent = [], [0]
+
+        def fetch():
+            try:
+                for page in pages:
+                    put(fetched, list(page), stop)
+                put(fetched, _END, stop)
+            except Aborted:
+                pass
+            except Exception:
+                try:
+                    put(fetched, Failure(sys.exc_info()), stop)
+                except Aborted:
+                    pass
+
+        def upload():
+            try:
+                while True:
+                    chunk = get(processed, stop)
+                    if chunk is _END:
+                        return
+                    self.sink(chunk)
+                    sent[0] += document_count(chunk)
+            except Aborted:
+                pass
+            except Exception:
+                errors.append(sys.exc_info())
+                stop.set()
+
+        threads = [threading.Thread(target=fetch),
+                   threading.Thread(target=upload)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for chunk in stage(self.plugin, received(fetched, stop),
+                               self.chunk_size):
+                if chunk:
+                    put(processed, chunk, stop)
+            put(processed, _END, stop)
+        except Aborted:
+            pass
+        except Exception:
+            errors.append(sys.exc_info())
+            stop.set()
+
+        for thread in threads:
+            thread.join()
+        if errors:
+            reraise(errors[0])
+        return sent[0]
+
+
+def put(queue, item, stop):
+    while True:
+        if stop.is_set():
+            raise Aborted()
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return
+        except Full:
+            pass
+
+
+def get(queue, stop):
+    while True:
+        if stop.is_set():
+            raise Aborted()
+        try:
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            pass
+
+
+def document_count(chunk):
+    if chunk and isinstance(chunk[0], Batch):
+        return sum(batch.count for batch in chunk)
+    return len(chunk)
+
+
+def received(queue, stop):
+    """
+    Generate the pages put on `queue` up to the end, raising the fetching
+    thread's error if it failed.
+    """
+    while True:
+        page = get(queue, stop)
+        if page is _END:
+            return
+        if isinstance(page, Failure):
+            reraise(page.exc_info)
+        yield page
+
+
+class HTTPSink(object):
+
+    """
+    POSTs each page of documents to a backdrop bucket `url` as a JSON list.
+    Datetimes are written as `compute_id.stringify` writes them, and bytes
+    (such as `_id`s on Python 3) are decoded as ASCII. A page of `Batch`es
+    from `BatchForBackdrop` is sent as one POST per batch.
+    """
+
+    def __init__(self, url, token=None, timeout=60):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+
+    def __call__(self, documents):
+        if documents and isinstance(documents[0], Batch):
+            return [self.post(batch.body, batch.headers)
+                    for batch in documents]
+        body = json.dumps(
+            documents, default=FieldFormatter().json_default).encode("utf-8")
+        return self.post(body, {"Content-Type": "application/json"})
+
+    def post(self, body, headers):
+        headers = dict(headers)
+        if self.token is not None:
+            headers["Authorization"] = "Bearer {0}".format(self.token)
+        response = urlopen(Request(self.url, body, headers),
+                           timeout=self.timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+
+def stand_in_server():
+    """
+    Start a local HTTP server which records the body and headers of each
+    POST, returning `(server, url, requests)`. Shut it down with
+    `server.shutdown()`.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            requests.append((dict(self.headers.items()),
+                             self.rfile.read(length)))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'{"status": "ok"}')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{0}/data/test/visitors".format(
+        server.server_address[1])
+    return server, url, requests
+
+
+def test_OverlappedRunner_posts_to_a_stand_in_server():
+    import datetime
+    import pytz
+    from nose.tools import assert_equal, assert_false
+    from .load_plugin import load_pipeline
+
+    timestamp = datetime.datetime(2013, 10, 7, tzinfo=pytz.UTC)
+
+    def pages():
+        for page in range(5):
+            yield [{"_timestamp": timestamp, "customVarValue9": "<D1>",
+                    "page": page, "row": row, "visits": row}
+                   for row in range(3)]
+
+    plugin_names = ["ComputeDepartmentKey('customVarValue9')",
+                    "RemoveKey('customVarValue9')",
+                    "ComputeIdFrom('_timestamp', 'page', 'row')"]
+    expected = load_pipeline(plugin_names)(
+        [document for page in pages() for document in page])
+
+    server, url, requests = stand_in_server()
+    try:
+        runner = OverlappedRunner(load_pipeline(plugin_names),
+                                  HTTPSink(url, "token"), queue_size=1)
+        assert_equal(runner.run(pages()), 15)
+    finally:
+        server.shutdown()
+
+    assert_equal(len(requests), 5)
+    received = [document for _, body in requests
+                for document in json.loads(body.decode("utf-8"))]
+    assert_equal(received, json.loads(json.dumps(
+        expected, default=FieldFormatter().json_default)))
+    assert_equal(received[0]["_timestamp"], "20131007000000")
+    assert_false(received[0]["_id"].startswith("b'"))
+    headers = dict((key.lower(), value)
+                   for key, value in requests[0][0].items())
+    assert_equal(headers["authorization"], "Bearer token")
+
+
+def test_OverlappedRunner_bounds_queues_and_overlaps():
+    import time
+    from nose.tools import assert_equal, assert_true
+    from .remove_key import RemoveKey
+
+    events = []
+
+    def pages():
+        for page in range(20):
+            events.append(("fetched", page))
+            yield [{"page": page, "drop": None}]
+
+    def slow_sink(documents):
+        time.sleep(0.005)
+        events.append(("sent", documents[0]["page"]))
+
+    runner = OverlappedRunner(RemoveKey("drop"), slow_sink, queue_size=2)
+    assert_equal(runner.run(pages()), 20)
+
+    fetched = sent = ahead = 0
+    for event, _ in events:
+        if event == "fetched":
+            fetched += 1
+        else:
+            sent += 1
+        ahead = max(ahead, fetched - sent)
+    # Two pages in each queue, one being processed, one being sent and one
+    # being fetched
+    assert_true(ahead <= 7, ahead)
+    assert_true(events.index(("sent", 0)) < events.index(("fetched", 19)))
+
+
+def test_OverlappedRunner_raises_errors():
+    import traceback
+    from nose.tools import assert_raises, assert_true
+    from .remove_key import RemoveKey
+
+    def pages():
+        yield [{"a": 1}]
+        raise IOError("GA went away")
+
+    with assert_raises(IOError):
+        OverlappedRunner(RemoveKey("a"), lambda documents: None).run(pages())
+
+    def failing_sink(documents):
+        raise ValueError("backdrop said no")
+
+    endless = ([{"a": 1}] for _ in iter(int, 1))
+    with assert_raises(ValueError):
+        OverlappedRunner(RemoveKey("a"), failing_sink).run(endless)
+
+    # Errors keep the traceback of the thread they were raised in
+    for page_source, sink, function in [
+            (pages(), lambda documents: None, "pages"),
+            ([[{"a": 1}]], failing_sink, "failing_sink")]:
+        try:
+            OverlappedRunner(RemoveKey("a"), sink).run(page_source)
+        except (IOError, ValueError):
+            functions = [frame[2] for frame in
+                         traceback.extract_tb(sys.exc_info()[2])]
+        assert_true(function in functions, functions)
+
+    with assert_raises(KeyError):
+        OverlappedRunner(RemoveKey("b"), lambda documents: None).run(
+            [[{"a": 1}]] * 10)
@@ -0,0 +1,224 @@
+"""
+parallel.py
+-----------
+
+Runs the CPU-heavy parts of a plugin chain in a pool of processes.
+
+The documents are split into consecutive partitions. Each run of row-wise
+plugins is applied to every partition in a worker, and if the run is
+followed by an `AggregateKey` the workers also aggregate their partition, so
+that only the partial aggregates have to be merged. Partitions are always
+put back together in input order. Any other plugin (such as `ComputeRank`,
+which depends on the order of all of the documents) runs on its own in the
+calling process, exactly as it would without the pool.
+
+Workers are forked for each segment, so that they inherit its input and
+plugins rather than having them pickled; only their results are sent back.
+Input too small to give each worker `min_partition_size` documents, or a
+single process, is run in the calling process instead.
+
+"""
+
+import multiprocessing
+
+
+DEFAULT_MIN_PARTITION_SIZE = 20000
+
+# (segment, documents) being run, inherited by forked workers
+_work = None
+
+
+class ParallelExecutor(object):
+
+    """
+    A plugin which runs `plugins` over `partitions` slices of its input using
+    `processes` worker processes (by default, one per CPU and four partitions
+    per process), with at least `min_partition_size` documents in each.
+
+    Workers are forked, so this needs the `fork` start method.
+    """
+
+    def __init__(self, plugins, processes=None, partitions=None,
+                 min_partition_size=DEFAULT_MIN_PARTITION_SIZE):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.partitions = partitions or self.processes * 4
+        self.min_partition_size = min_partition_size
+        self.steps = plan(plugins)
+
+    def __call__(self, documents):
+        documents = list(documents)
+        for step in self.steps:
+            if isinstance(step, Segment):
+                partitions = min(self.partitions,
+                                 len(documents) // self.min_partition_size)
+                if self.processes > 1 and partitions > 1:
+                    documents = step.run(documents, self.processes,
+                                         partitions)
+                else:
+                    documents = step(documents)
+            else:
+                documents = step(documents)
+        return documents
+
+
+class Segment(object):
+
+    """
+    A run of row-wise plugins, optionally followed by an aggregation, which
+    can be applied to partitions of the documents independently.
+    """
+
+    def __init__(self, plugins, aggregation=None):
+        self.plugins = plugins
+        self.aggregation = aggregation
+
+    def __call__(self, documents):
+        documents = run_plugins(self.plugins, documents)
+        if self.aggregation is not None:
+            return self.aggregation(documents)
+        return documents
+
+    def run(self, documents, processes, partitions):
+        """
+        Run the segment over `partitions` slices of `documents` in a pool of
+        `processes` forked workers.
+        """
+        global _work
+        _work = (self, documents)
+        try:
+            pool = fork_context().Pool(min(processes, partitions))
+            try:
+                results = pool.map(run_partition,
+                                   list(partition_bounds(len(documents),
+                                                         partitions)),
+                                   chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _work = None
+
+        if self.aggregation is not None:
+            return self.aggregation.merge(results)
+        return [document for result in results for document in result]
+
+
+def plan(plugins):
+    """
+    Group `plugins` into `Segment`s which can run in parallel, and plugins
+    which must run in the calling process.
+    """
+    steps, row_wise = [], []
+
+    for plugin in plugins:
+        if getattr(plugin, "row_wise", False):
+            row_wise.append(plugin)
+        elif getattr(plugin, "mergeable", False):
+            steps.append(Segment(row_wise, plugin))
+            row_wise = []
+        else:
+            if row_wise:
+                steps.append(Segment(row_wise))
+                row_wise = []
+            steps.append(plugin)
+
+    if row_wise:
+        steps.append(Segment(row_wise))
+
+    return steps
+
+
+def fork_context():
+    get_context = getattr(multiprocessing, "get_context", None)
+    if get_context is None:
+        # Python 2 always forks
+        return multiprocessing
+    return get_context("fork")
+
+
+def run_partition(bounds):
+    segment, documents = _work
+    documents = run_plugins(segment.plugins, documents[slice(*bounds)])
+    if segment.aggregation is not None:
+        return segment.aggregation.partial(documents)
+    return documents
+
+
+def run_plugins(plugins, documents):
+    for plugin in plugins:
+        documents = plugin(documents)
+    return documents
+
+
+def partition_bounds(length, partitions):
+    """
+    Split `length` documents into at most `partitions` consecutive, nearly
+    equal slices, giving the `(start, end)` of each.
+    """
+    size, remainder = divmod(length, partitions)
+    start = 0
+    for i in range(partitions):
+        end = start + size + (1 if i < remainder else 0)
+        if end > start:
+            yield start, end
+        start = end
+
+
+def test_partition_bounds():
+    from nose.tools import assert_equal
+
+    assert_equal(list(partition_bounds(7, 3)), [(0, 3), (3, 5), (5, 7)])
+    assert_equal(list(partition_bounds(1, 3)), [(0, 1)])
+
+
+def test_plan():
+    from nose.tools import assert_equal
+    from .aggregate import AggregateKey, aggregate_count
+    from .rank import ComputeRank
+    from .remove_key import RemoveKey
+
+    remove, aggregate, rank = (RemoveKey("a"),
+                               AggregateKey(aggregate_count("b")),
+                               ComputeRank("c"))
+
+    steps = plan([remove, aggregate, rank, remove])
+
+    assert_equal([type(step).__name__ for step in steps],
+                 ["Segment", "ComputeRank", "Segment"])
+    assert_equal((steps[0].plugins, steps[0].aggregation), ([remove],
+                                                            aggregate))
+    assert_equal((steps[2].plugins, steps[2].aggregation), ([remove], None))
+
+
+def test_ParallelExecutor_matches_serial():
+    import datetime
+    import pytz
+    from nose.tools import assert_equal
+    from .load_plugin import compile_plugins, load_plugins
+
+    plugin_names = [
+        "ComputeDepartmentKey('customVarValue9')",
+        "RemoveKey('customVarValue9')",
+        "AggregateKey(aggregate_count('visits'), "
+        "             aggregate_rate('rate', 'visits'))",
+        "ComputeRank('rank')",
+        "ComputeIdFrom('_timestamp', 'department', 'rank')",
+    ]
+
+    def documents():
+        timestamp = datetime.datetime(2013, 10, 7, tzinfo=pytz.UTC)
+        codes = ["<D1>", "<D2><D1>", "<D3>", "<D10><D4>", "<D1><D3>"]
+        return [{"_timestamp": timestamp, "customVarValue9": codes[i % 5],
+                 "visits": i, "rate": 0.1 * (i % 7)}
+                for i in range(1, 101)]
+
+    expected = documents()
+    for plugin in load_plugins(plugin_names):
+        expected = plugin(expected)
+
+    plugins = compile_plugins(load_plugins(plugin_names))
+    for executor in [ParallelExecutor(plugins, processes=2, partitions=7,
+                                      min_partition_size=1),
+                     # Too few documents to fork for
+                     ParallelExecutor(plugins, processes=2)]:
+        assert_equal(executor(documents()), expected)
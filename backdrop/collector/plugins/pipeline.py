@@ -0,0 +1,156 @@
+"""
+pipeline.py
+-----------
+
+Runs a chain of plugins lazily over chunks of documents, rather than
+handing each plugin the complete output of the one before it.
+
+A plugin takes part in streaming in one of three ways:
+
+* It has a `stream(chunks)` method, which takes an iterator of lists of
+  documents and yields lists of documents. This is for plugins which must see
+  every document but can keep a bounded amount of state while doing so
+  (`AggregateKey`, `ComputeRank`).
+* It has `row_wise = True`, meaning that calling it on any chunk on its own
+  gives the same documents as calling it on the whole list.
+* Otherwise it is treated as blocking: every chunk is collected into a single
+  list which it is called on once.
+
+"""
+
+from itertools import islice
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class Pipeline(object):
+
+    """
+    A chain of plugins which is itself a plugin. Only blocking stages hold
+    more than `chunk_size` documents at a time.
+    """
+
+    def __init__(self, plugins, chunk_size=DEFAULT_CHUNK_SIZE):
+        assert chunk_size > 0, "chunk_size must be positive"
+        self.plugins = list(plugins)
+        self.chunk_size = chunk_size
+
+    @property
+    def row_wise(self):
+        return all(getattr(plugin, "row_wise", False)
+                   for plugin in self.plugins)
+
+    def __call__(self, documents):
+        return list(self.run(documents))
+
+    def run(self, documents):
+        """
+        Generate output documents from any iterable of input `documents`.
+        """
+        for chunk in self.stream(chunked(documents, self.chunk_size)):
+            for document in chunk:
+                yield document
+
+    def stream(self, chunks):
+        for plugin in self.plugins:
+            chunks = stage(plugin, chunks, self.chunk_size)
+        return chunks
+
+
+def stage(plugin, chunks, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return an iterator of output chunks for `plugin` given input `chunks`.
+    """
+    if hasattr(plugin, "stream"):
+        return plugin.stream(chunks)
+    if getattr(plugin, "row_wise", False):
+        return (plugin(chunk) for chunk in chunks)
+    return blocking_stage(plugin, chunks, chunk_size)
+
+
+def blocking_stage(plugin, chunks, chunk_size):
+    documents = [document for chunk in chunks for document in chunk]
+    return chunked(plugin(documents), chunk_size)
+
+
+def chunked(documents, chunk_size):
+    """
+    Split any iterable of documents into lists of at most `chunk_size`.
+    """
+    documents = iter(documents)
+    while True:
+        chunk = list(islice(documents, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def test_chunked():
+    from nose.tools import assert_equal
+
+    assert_equal(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+    assert_equal(list(chunked([], 2)), [])
+
+
+def test_Pipeline_streams_row_wise_stages():
+    """
+    test_Pipeline_streams_row_wise_stages()
+
+    Output is available before the input has been fully consumed.
+    """
+    from nose.tools import assert_equal
+    from .remove_key import RemoveKey
+
+    consumed = []
+
+    def source():
+        for i in range(10):
+            consumed.append(i)
+            yield {"a": i, "b": i}
+
+    pipeline = Pipeline([RemoveKey("b")], chunk_size=3)
+    output = pipeline.run(source())
+
+    assert_equal(next(output), {"a": 0})
+    assert_equal(len(consumed), 3)
+    assert_equal(list(output), [{"a": i} for i in range(1, 10)])
+
+
+def test_Pipeline_matches_plugin_by_plugin():
+    from nose.tools import assert_equal
+    from .aggregate import AggregateKey, aggregate_count
+    from .compute_id import ComputeIdFrom
+    from .department import ComputeDepartmentKey
+    from .rank import ComputeRank
+    from .remove_key import RemoveKey
+
+    def plugins():
+        return [ComputeDepartmentKey("customVarValue9"),
+                RemoveKey("customVarValue9"),
+                AggregateKey(aggregate_count("visits")),
+                ComputeRank("rank"),
+                ComputeIdFrom("department")]
+
+    def documents():
+        codes = ["<D1>", "<D2><D1>", "<D3>", "<D1><D4>"]
+        return [{"customVarValue9": codes[i % 4], "visits": i}
+                for i in range(20)]
+
+    expected = documents()
+    for plugin in plugins():
+        expected = plugin(expected)
+
+    assert_equal(Pipeline(plugins(), chunk_size=3)(documents()), expected)
+
+
+def test_Pipeline_blocking_stage():
+    from nose.tools import assert_equal
+
+    def reverse(documents):
+        return documents[::-1]
+
+    pipeline = Pipeline([reverse], chunk_size=2)
+
+    assert_equal(pipeline([{"a": i} for i in range(5)]),
+                 [{"a": i} for i in reversed(range(5))])
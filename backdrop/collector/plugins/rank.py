@@ -1,14 +1,30 @@
+from .columnar import ColumnBatch, rank_columns
+
 
 class ComputeRank(object):
 
+    reads = deletes = frozenset()
+
     def __init__(self, var_name):
         self.var_name = var_name
+        self.writes = frozenset([var_name])
 
-    def __call__(self, documents):
-        for i, document in enumerate(documents, 1):
+    def __call__(self, documents, start=1):
+        if isinstance(documents, ColumnBatch):
+            return rank_columns(documents, self.var_name, start)
+        for i, document in enumerate(documents, start):
             document[self.var_name] = i
         return documents
 
+    def stream(self, chunks):
+        """
+        Number documents consecutively across all of the chunks.
+        """
+        start = 1
+        for documents in chunks:
+            yield self(documents, start)
+            start += len(documents)
+
 def test_rank():
     plugin = ComputeRank("rank")
 
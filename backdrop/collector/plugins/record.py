@@ -0,0 +1,240 @@
+"""
+record.py
+---------
+
+A compact alternative to dicts for documents whose keys are known in
+advance. Every GA row of a collector has the same keys, and a dict per row
+spends most of its memory on its hash table; a record stores its values in
+`__slots__`, and repeated string values can be shared between records.
+
+    Record = record_type(["_timestamp", "customVarValue9", "visitors",
+                          "department", "_id", "humanId"])
+    documents = records(Record, documents)
+
+Records behave as mutable mappings, so every plugin accepts them in place of
+dicts. Keys outside of the record's type are kept in a dict of their own.
+
+"""
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+_record_types = {}
+
+_missing = object()
+
+
+class Record(MutableMapping):
+
+    """
+    Base class of the types returned by `record_type`.
+    """
+
+    __slots__ = ()
+
+    _keys = ()
+    _slots = {}
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        slot = self._slots.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return getattr(self, slot, _missing) is not _missing
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key, slot in zip(self._keys, self.__slots__):
+            if getattr(self, slot, _missing) is not _missing:
+                yield key
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return type(self)(self)
+
+    def __reduce__(self):
+        return make_record, (self._keys, dict(self), type(self).__name__)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self))
+
+
+def record_type(keys, name="Record"):
+    """
+    Return the `Record` subclass called `name` with a slot for each of
+    `keys`. Types are shared between calls with the same keys and name.
+    """
+    keys = tuple(keys)
+    cls = _record_types.get((keys, name))
+    if cls is None:
+        slots = tuple("_{0}".format(i) for i in range(len(keys)))
+        cls = _record_types[keys, name] = type(name, (Record,), {
+            "__slots__": slots + ("_extra",),
+            "_keys": keys,
+            "_slots": dict(zip(keys, slots)),
+        })
+    return cls
+
+
+def make_record(keys, values, name="Record"):
+    return record_type(keys, name)(values)
+
+
+try:
+    basestring_types = basestring
+except NameError:
+    basestring_types = str
+
+
+def records(cls, documents):
+    """
+    Convert `documents` (any iterable) to records of type `cls`, making
+    equal string values of the same type share one object, so that repeated
+    dimension values (department slugs, dataType, timeSpan...) are only
+    stored once.
+    """
+    strings, slots = {}, cls._slots
+    output = []
+    for document in documents:
+        record = cls()
+        for key, value in document.items():
+            if isinstance(value, basestring_types):
+                value = strings.setdefault((type(value), value), value)
+            slot = slots.get(key)
+            if slot is None:
+                record[key] = value
+            else:
+                setattr(record, slot, value)
+        output.append(record)
+    return output
+
+
+def test_Record_is_a_mapping():
+    from nose.tools import assert_equal, assert_raises
+    import pickle
+
+    Record = record_type(["a", "b"])
+    record = Record({"a": 1, "c": 3})
+
+    assert_equal(record, {"a": 1, "c": 3})
+    assert_equal(sorted(record), ["a", "c"])
+    assert "b" not in record and "c" in record
+    with assert_raises(KeyError):
+        record["b"]
+
+    record["b"] = 2
+    del record["a"]
+    del record["c"]
+    assert_equal(dict(record), {"b": 2})
+    assert_equal(pickle.loads(pickle.dumps(record, 2)), record)
+    assert_equal(type(record.copy()), Record)
+
+
+def test_records_intern_strings():
+    from nose.tools import assert_equal
+
+    Record = record_type(["a"])
+    first, second = records(Record, [{"a": "".join(["x", "y"])},
+                                     {"a": "".join(["x", "y"])}])
+
+    assert_equal(first, second)
+    assert first["a"] is second["a"]
+
+    first, second = records(Record, [{"a": "x"}, {"a": u"x"}])
+    assert_equal(type(first["a"]), type("x"))
+    assert_equal(type(second["a"]), type(u"x"))
+
+
+def test_record_type_names():
+    from nose.tools import assert_equal
+    import pickle
+
+    Record = record_type(["a"])
+    Page = record_type(["a"], "Page")
+
+    assert_equal(Record.__name__, "Record")
+    assert_equal(Page.__name__, "Page")
+    assert record_type(["a"], "Page") is Page
+    assert_equal(type(pickle.loads(pickle.dumps(Page({"a": 1}), 2))), Page)
+
+
+def test_plugins_accept_records():
+    import datetime
+    import pytz
+    from nose.tools import assert_equal
+    from .load_plugin import compile_plugins, load_pipeline, load_plugins
+
+    plugin_names = [
+        "ComputeDepartmentKey('customVarValue9')",
+        "Comment('records work too')",
+        "RemoveKey('customVarValue9')",
+        "SetDepartment('<D2>')",
+        "AggregateKey(aggregate_count('visits'), "
+        "             aggregate_rate('rate', 'visits'))",
+        "ComputeRank('rank')",
+        "ComputeIdFrom('_timestamp', 'department', 'rank')",
+    ]
+
+    def documents():
+        timestamp = datetime.datetime(2013, 10, 7, tzinfo=pytz.UTC)
+        codes = ["<D1>", "<D2><D1>", "<D3>"]
+        return [{"_timestamp": timestamp, "customVarValue9": codes[i % 3],
+                 "visits": i, "rate": 0.25 * (i % 4)} for i in range(30)]
+
+    expected = documents()
+    for plugin in load_plugins(plugin_names):
+        expected = plugin(expected)
+
+    Record = record_type(["_timestamp", "customVarValue9", "visits", "rate",
+                          "department", "rank", "_id", "humanId"])
+
+    output = records(Record, documents())
+    for plugin in compile_plugins(load_plugins(plugin_names)):
+        output = plugin(output)
+    assert_equal(output, expected)
+    assert all(isinstance(record, Record) for record in output)
+
+    output = load_pipeline(plugin_names)(records(Record, documents()))
+    assert_equal(output, expected)
@@ -1,19 +1,55 @@
+from .columnar import ColumnBatch
+
 
 class RemoveKey(object):
 
     """
-    Remove all of the specified keys from the input documents.
+    Remove all of the specified keys from the input documents. A missing key
+    is an error, unless `missing_ok=True`.
     """
 
-    def __init__(self, *remove_keys):
+    row_wise = True
+    reads = writes = frozenset()
+
+    def __init__(self, *remove_keys, **options):
         self.remove_keys = remove_keys
+        self.missing_ok = options.pop("missing_ok", False)
+        if options:
+            raise TypeError("RemoveKey got unexpected keyword arguments "
+                            "{0}".format(", ".join(sorted(options))))
+        self.deletes = frozenset(remove_keys)
 
     def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            for key in self.remove_keys:
+                if not self.missing_ok or key in documents:
+                    del documents[key]
+            return documents
+
+        if self.missing_ok:
+            for document in documents:
+                for key in self.remove_keys:
+                    document.pop(key, None)
+            return documents
+
         for document in documents:
             for key in self.remove_keys:
                 del document[key]
         return documents
 
+    def fused_lines(self, bind):
+        if self.missing_ok:
+            return ["document.pop({0}, None)".format(bind(key))
+                    for key in self.remove_keys]
+        return ["del document[{0}]".format(bind(key))
+                for key in self.remove_keys]
+
+    def __repr__(self):
+        arguments = [repr(key) for key in self.remove_keys]
+        if self.missing_ok:
+            arguments.append("missing_ok=True")
+        return "RemoveKey({0})".format(", ".join(arguments))
+
 
 def test_RemoveKey():
     from nose.tools import assert_equal
@@ -25,3 +61,14 @@ def test_RemoveKey():
 
     expected_doc = {"a": None}
     assert_equal(expected_doc, output_doc)
+
+
+def test_RemoveKey_missing_ok():
+    from nose.tools import assert_equal, assert_raises
+
+    with assert_raises(KeyError):
+        RemoveKey("b")([{"a": 1}])
+
+    plugin = RemoveKey("b", missing_ok=True)
+    assert_equal(plugin([{"a": 1}, {"a": 2, "b": 3}]), [{"a": 1}, {"a": 2}])
+    assert_equal(repr(plugin), "RemoveKey('b', missing_ok=True)")
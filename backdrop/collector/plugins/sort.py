@@ -0,0 +1,208 @@
+"""
+sort.py
+-------
+
+Sorts documents by the values of some of their keys, spilling to disk when
+there are more than fit in memory.
+
+While streaming, up to `memory_limit` documents are held and sorted in
+memory. Past that, each full buffer is sorted and written to a temporary file
+as a "run", and the runs are merged with a k-way merge as the output is
+read, so only one block of each run is held while merging.
+
+The sort is stable, also with `reverse=True`: documents with equal keys keep
+their input order, exactly as `list.sort` would leave them.
+
+"""
+
+import heapq
+import tempfile
+from itertools import count
+from operator import itemgetter
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .columnar import ColumnBatch
+from .pipeline import DEFAULT_CHUNK_SIZE, chunked
+
+
+DEFAULT_MEMORY_LIMIT = 100000
+RUN_BLOCK_SIZE = 1000
+
+
+class SortBy(object):
+
+    """
+    Sort documents by `keys`, largest first with `reverse=True`.
+
+    Called on a list, a sorted copy is returned in one `list.sort`, since
+    the documents are already in memory. In a pipeline, at most
+    `memory_limit` documents are held before sorted runs are written to
+    temporary files in `temp_dir`.
+    """
+
+    def __init__(self, *keys, **options):
+        if not keys:
+            raise TypeError("SortBy needs at least one key")
+        self.keys = keys
+        self.reads = frozenset(keys)
+        self.writes = self.deletes = frozenset()
+        self.key = itemgetter(*keys)
+        self.reverse = options.pop("reverse", False)
+        self.memory_limit = options.pop("memory_limit", DEFAULT_MEMORY_LIMIT)
+        self.temp_dir = options.pop("temp_dir", None)
+        if options:
+            raise TypeError("SortBy got unexpected keyword arguments "
+                            "{0}".format(", ".join(sorted(options))))
+        if self.memory_limit < 1:
+            raise ValueError("SortBy needs a memory_limit of at least 1")
+
+    def filter_commutes(self, keys):
+        """
+        Dropping documents before a stable sort leaves the others in the same
+        order as dropping them after it.
+        """
+        return True
+
+    def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            return ColumnBatch.from_documents(
+                self(documents.to_documents()))
+        documents = list(documents)
+        documents.sort(key=self.key, reverse=self.reverse)
+        return documents
+
+    def stream(self, chunks):
+        buffer, runs = [], []
+        try:
+            for documents in chunks:
+                buffer.extend(documents)
+                while len(buffer) >= self.memory_limit:
+                    run = self(buffer[:self.memory_limit])
+                    runs.append(write_run(run, self.temp_dir))
+                    del buffer[:self.memory_limit]
+
+            if not runs:
+                for chunk in chunked(self(buffer), DEFAULT_CHUNK_SIZE):
+                    yield chunk
+                return
+
+            sources = [read_run(run) for run in runs] + [self(buffer)]
+            del buffer
+            merged = merge_sorted(sources, self.key, self.reverse)
+            for chunk in chunked(merged, DEFAULT_CHUNK_SIZE):
+                yield chunk
+        finally:
+            for run in runs:
+                run.close()
+
+
+class Descending(object):
+
+    """
+    Wraps a value so that it sorts in the opposite order.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def merge_sorted(sources, key, reverse=False):
+    """
+    Merge iterables which are each sorted by `key` into one sorted iterator.
+    Items with equal keys come out in the order of their sources, then in
+    their order within a source, so a stable sort of the concatenated
+    sources gives the same order.
+    """
+    def decorate(position, source):
+        ordinal = count()
+        if reverse:
+            return ((Descending(key(item)), position, next(ordinal), item)
+                    for item in source)
+        return ((key(item), position, next(ordinal), item)
+                for item in source)
+
+    decorated = [decorate(position, source)
+                 for position, source in enumerate(sources)]
+    for item in heapq.merge(*decorated):
+        yield item[-1]
+
+
+def write_run(items, directory=None):
+    """
+    Write `items` to a new temporary file, which is deleted when closed.
+
+    Items are pickled `RUN_BLOCK_SIZE` at a time, so that values repeated
+    between documents, such as timezones and key names, are only written
+    once per block, and reading holds one block per run.
+    """
+    run = tempfile.TemporaryFile(dir=directory)
+    for block in chunked(items, RUN_BLOCK_SIZE):
+        pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    """
+    Generate the items written to `run` by `write_run`.
+    """
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        for item in block:
+            yield item
+
+
+def test_SortBy():
+    from nose.tools import assert_equal
+
+    documents = [{"a": a, "b": b} for a, b in [(2, 1), (1, 2), (2, 0),
+                                              (1, 1)]]
+
+    assert_equal(SortBy("a")([dict(d) for d in documents]),
+                 [{"a": 1, "b": 2}, {"a": 1, "b": 1},
+                  {"a": 2, "b": 1}, {"a": 2, "b": 0}])
+    assert_equal(SortBy("a", "b", reverse=True)(documents),
+                 [{"a": 2, "b": 1}, {"a": 2, "b": 0},
+                  {"a": 1, "b": 2}, {"a": 1, "b": 1}])
+
+
+def test_SortBy_spills_runs_and_stays_stable():
+    import random
+    from nose.tools import assert_equal
+    from .pipeline import chunked
+
+    rng = random.Random(3)
+    documents = [{"id": i, "k": rng.randint(0, 9), "j": rng.choice("xyz")}
+                 for i in range(1000)]
+
+    # 15 runs of 64 documents and 40 left in memory, one run and one
+    # document left, and everything in memory
+    for memory_limit in [64, 999, 1001]:
+        for reverse in [False, True]:
+            plugin = SortBy("k", "j", reverse=reverse,
+                            memory_limit=memory_limit)
+            output = [document for chunk in plugin.stream(chunked(documents,
+                                                                  100))
+                      for document in chunk]
+            expected = sorted(documents, key=lambda d: (d["k"], d["j"]),
+                              reverse=reverse)
+            assert_equal([d["id"] for d in output],
+                         [d["id"] for d in expected])
@@ -0,0 +1,217 @@
+"""
+top_n.py
+--------
+
+Keep the `n` documents with the largest `metric` in each partition, ranked,
+and drop the rest.
+
+Each partition holds a heap of at most `n` documents, so selecting from `d`
+documents takes O(d log n) time and memory for only the documents kept.
+Ranks use "competition" numbering: documents with equal values share a rank
+and the next rank skips, as in 1, 2, 2, 4. Documents tied with the last one
+kept are kept too, so the cut never chooses arbitrarily between equal values.
+Output is grouped by partition, in order of each partition's first document,
+largest value first, with ties in input order.
+
+"""
+
+import heapq
+
+from .columnar import ColumnBatch
+from .pipeline import DEFAULT_CHUNK_SIZE, chunked
+
+
+class TopN(object):
+
+    mergeable = True
+
+    def __init__(self, metric, n, partition_by=(), rank_key="rank"):
+        if n < 1:
+            raise ValueError("TopN needs n of at least 1, not {0!r}".format(n))
+        if isinstance(partition_by, (str, type(u""))):
+            partition_by = (partition_by,)
+        self.metric = metric
+        self.n = n
+        self.partition_by = tuple(partition_by)
+        self.rank_key = rank_key
+        self.reads = frozenset((metric,) + self.partition_by)
+        self.writes = frozenset([rank_key])
+        self.deletes = frozenset()
+
+    def __call__(self, documents):
+        if isinstance(documents, ColumnBatch):
+            return ColumnBatch.from_documents(
+                self(documents.to_documents()))
+        return self.start().update(documents).finalize()
+
+    def start(self):
+        return TopNState(self.metric, self.n, self.partition_by,
+                         self.rank_key)
+
+    def stream(self, chunks):
+        state = self.start()
+        for documents in chunks:
+            state.update(documents)
+        for chunk in chunked(state.finalize(), DEFAULT_CHUNK_SIZE):
+            yield chunk
+
+    def partial(self, documents):
+        """
+        Return the unfinished `TopNState` of `documents`, to be combined with
+        those of the documents before and after them using `merge`.
+        """
+        return self.start().update(documents)
+
+    def merge(self, partials):
+        """
+        Combine partial states, given in input order, into the documents
+        which selecting from all of their input at once would give.
+        """
+        state = self.start()
+        for partial in partials:
+            state.merge(partial)
+        return state.finalize()
+
+
+class TopNState(object):
+
+    """
+    The documents kept so far for each partition. Each partition is a
+    min-heap of `(value, -position, document)`, so that its root is the
+    document to drop next, and a list of the dropped documents which are
+    tied with the root.
+    """
+
+    def __init__(self, metric, n, partition_by, rank_key):
+        self.metric = metric
+        self.n = n
+        self.partition_by = partition_by
+        self.rank_key = rank_key
+        self.partitions = {}
+        self.order = []
+        self.count = 0
+
+    def update(self, documents):
+        metric, partition_by = self.metric, self.partition_by
+        for position, document in enumerate(documents, self.count):
+            key = tuple(document[name] for name in partition_by)
+            self.offer(key, (document[metric], -position, document))
+            self.count = position + 1
+        return self
+
+    def offer(self, key, item):
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = self.partitions[key] = ([], [])
+            self.order.append(key)
+        heap, ties = partition
+
+        if len(heap) < self.n:
+            heapq.heappush(heap, item)
+            return
+
+        least = heap[0][0]
+        dropped = heapq.heappushpop(heap, item)
+        if dropped[0] == heap[0][0]:
+            ties.append(dropped)
+        elif heap[0][0] != least:
+            # The cut-off went up, so nothing below it is tied any more
+            del ties[:]
+
+    def merge(self, other):
+        """
+        Fold in `other`, the state of documents which came after those of
+        this one, returning this state.
+        """
+        for key in other.order:
+            heap, ties = other.partitions[key]
+            for value, position, document in sorted(heap + ties,
+                                                    key=lambda item: -item[1]):
+                self.offer(key, (value, position - self.count, document))
+        self.count += other.count
+        return self
+
+    def finalize(self):
+        output = []
+        for key in self.order:
+            heap, ties = self.partitions[key]
+            ranked = sorted(heap + ties, reverse=True)
+            rank, previous = 0, None
+            for i, (value, _, document) in enumerate(ranked, 1):
+                if i == 1 or value != previous:
+                    rank, previous = i, value
+                document[self.rank_key] = rank
+                output.append(document)
+        return output
+
+
+def test_TopN():
+    from nose.tools import assert_equal
+
+    documents = [{"page": name, "department": department, "visits": visits}
+                 for name, department, visits in [
+                     ("a", "hmrc", 10), ("b", "dft", 5), ("c", "hmrc", 30),
+                     ("d", "hmrc", 20), ("e", "dft", 7), ("f", "hmrc", 5)]]
+
+    output = TopN("visits", 2, partition_by="department")(documents)
+
+    assert_equal([(d["page"], d["rank"]) for d in output],
+                 [("c", 1), ("d", 2), ("e", 1), ("b", 2)])
+
+
+def test_TopN_keeps_ties():
+    from nose.tools import assert_equal
+
+    visits = [3, 5, 5, 1, 4, 4, 9, 4]
+    documents = [{"page": i, "visits": v} for i, v in enumerate(visits)]
+
+    output = TopN("visits", 4, rank_key="position")(documents)
+
+    assert_equal([(d["page"], d["position"]) for d in output],
+                 [(6, 1), (1, 2), (2, 2), (4, 4), (5, 4), (7, 4)])
+
+
+def test_TopN_matches_sorting():
+    import random
+    from nose.tools import assert_equal
+
+    rng = random.Random(7)
+    documents = [{"id": i, "p": rng.randint(0, 3), "v": rng.randint(0, 20)}
+                 for i in range(500)]
+
+    def expected(n):
+        output = []
+        for p in sorted(set(d["p"] for d in documents),
+                        key=[d["p"] for d in documents].index):
+            ranked = sorted((d for d in documents if d["p"] == p),
+                            key=lambda d: (-d["v"], d["id"]))
+            cut = ranked[min(n, len(ranked)) - 1]["v"]
+            output.extend((d["id"], 1 + sum(1 for e in ranked
+                                            if e["v"] > d["v"]))
+                          for d in ranked if d["v"] >= cut)
+        return output
+
+    for n in [1, 3, 10, 200]:
+        plugin = TopN("v", n, partition_by=["p"])
+        chunks = [documents[i:i + 64] for i in range(0, 500, 64)]
+
+        for output in [plugin([dict(d) for d in documents]),
+                       [document for chunk in plugin.stream(chunks)
+                        for document in chunk],
+                       plugin.merge([plugin.partial(chunk)
+                                     for chunk in chunks])]:
+            assert_equal([(d["id"], d["rank"]) for d in output], expected(n))
+
+
+def test_TopN_stream_yields_chunks():
+    from nose.tools import assert_equal
+
+    plugin = TopN("v", DEFAULT_CHUNK_SIZE + 1)
+    documents = [{"v": i} for i in range(DEFAULT_CHUNK_SIZE + 1)]
+
+    chunks = list(plugin.stream([documents[:10], documents[10:]]))
+
+    assert_equal([len(chunk) for chunk in chunks], [DEFAULT_CHUNK_SIZE, 1])
+    assert_equal([d for chunk in chunks for d in chunk],
+                 plugin([dict(d) for d in documents]))
+    assert_equal(list(plugin.stream([])), [])
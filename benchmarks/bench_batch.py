@@ -0,0 +1,60 @@
+"""
+Compare serialising a collector's output as one `json.dumps` of the whole
+list, as `HTTPSink` does with plain documents, with `BatchForBackdrop`, with
+and without gzip. Checks that the batches hold the same documents.
+
+    python benchmarks/bench_batch.py [rows] [max_docs]
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import BatchForBackdrop
+from backdrop.collector.plugins.compute_id import stringify
+
+from documents import ga_documents
+
+
+def best_of(repeat, function, documents):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        output = function(documents)
+        timings.append(time.time() - start)
+    return min(timings), output
+
+
+def dumps(documents):
+    return [json.dumps(documents, default=stringify).encode("utf-8")]
+
+
+def main(rows=100000, max_docs=1000, repeat=3):
+    documents = ga_documents(rows)
+    expected = json.loads(dumps(documents)[0].decode("utf-8"))
+
+    cases = [
+        ("json.dumps", dumps),
+        ("batched", BatchForBackdrop(max_docs)),
+        ("batched gzip", BatchForBackdrop(max_docs, gzip=True)),
+    ]
+
+    for name, function in cases:
+        seconds, output = best_of(repeat, function, documents)
+        if name != "json.dumps":
+            received = [document for batch in output
+                        for document in batch.documents()]
+            assert received == expected, "{0} differs".format(name)
+        size = sum(len(body) for body in output)
+        print("{0:>12}: {1} rows in {2:.3f}s, {3:,.0f} rows/s, {4} bodies, "
+              "{5:,} bytes".format(name, rows, seconds, rows / seconds,
+                                   len(output), size))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
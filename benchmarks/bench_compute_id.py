@@ -0,0 +1,74 @@
+"""
+Compare ComputeIdFrom against formatting every value of every document from
+scratch, as it used to, and check that the ids are byte-identical. Then
+compare the default base64 `_id`s with `id_scheme="digest"` for speed and for
+the size of the JSON payload they produce.
+
+    python benchmarks/bench_compute_id.py [rows]
+"""
+
+from __future__ import print_function
+
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import ComputeIdFrom
+from backdrop.collector.plugins.compute_id import (
+    FieldFormatter, find_id_collisions, stringify, value_id)
+
+from documents import ga_documents
+
+
+FIELDS = ("_timestamp", "timeSpan", "dataType", "customVarValue9")
+
+
+def unformatted(documents):
+    for document in documents:
+        id_string = "_".join(stringify(document[field]) for field in FIELDS)
+        document['_id'], document['humanId'] = value_id(id_string)
+    return documents
+
+
+def best_of(repeat, function, documents):
+    timings = []
+    for _ in range(repeat):
+        fresh = copy.deepcopy(documents)
+        start = time.time()
+        output = function(fresh)
+        timings.append(time.time() - start)
+    return min(timings), output
+
+
+def main(rows=100000, repeat=3):
+    documents = ga_documents(rows)
+
+    before, expected = best_of(repeat, unformatted, documents)
+    after, output = best_of(repeat, ComputeIdFrom(*FIELDS), documents)
+    assert output == expected, "ids differ"
+
+    print("ComputeIdFrom: {0} rows, unformatted {1:.3f}s, "
+          "remembered {2:.3f}s, speed-up {3:.2f}x".format(
+              rows, before, after, before / after))
+
+    for scheme in ["base64", "digest"]:
+        seconds, output = best_of(
+            repeat, ComputeIdFrom(*FIELDS, id_scheme=scheme), documents)
+        ids = [{"_id": document["_id"], "humanId": document["humanId"]}
+               for document in output]
+        payload = len(json.dumps(
+            output, default=FieldFormatter().json_default))
+        print("{0:>13}: {1:.3f}s, _id {2:.1f} bytes on average, payload "
+              "{3:,} bytes, {4} collisions".format(
+                  scheme, seconds,
+                  sum(len(document["_id"]) for document in output) /
+                  float(rows),
+                  payload, len(find_id_collisions(ids))))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,77 @@
+"""
+Compare the speed and memory of `Deduplicate`'s strategies on GA-shaped
+documents with a tenth repeated, as an overlapping date range would repeat
+them, against a plain set of the `_id`s.
+
+    python benchmarks/bench_dedup.py [rows]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import ComputeIdFrom, Deduplicate
+
+from documents import ga_documents
+
+
+def set_size(values):
+    return sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+
+
+def plain_set(documents):
+    seen, kept = set(), []
+    for document in documents:
+        if document["_id"] not in seen:
+            seen.add(document["_id"])
+            kept.append(document)
+    return kept, set_size(seen)
+
+
+def strategy(name, **options):
+    plugin = Deduplicate(strategy=name, **options)
+
+    def run(documents):
+        seen = plugin.start()
+        kept = plugin.deduplicate(documents, seen)
+        if name == "exact":
+            return kept, set_size(seen.digests)
+        return kept, sys.getsizeof(seen.array)
+    return run
+
+
+def main(rows=1000000, repeat=3):
+    documents = ga_documents(rows, pages=rows // 10)
+    ComputeIdFrom("_timestamp", "pagePath", "customVarValue9", "visits",
+                  id_scheme="base64")(documents)
+    documents.extend(documents[:rows // 10])
+
+    cases = [
+        ("set of _id", plain_set),
+        ("exact", strategy("exact")),
+        ("bloom", strategy("bloom", capacity=rows)),
+        ("bloom 1%", strategy("bloom", capacity=rows, error_rate=0.01)),
+    ]
+
+    expected = None
+    for name, run in cases:
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            kept, size = run(documents)
+            timings.append(time.time() - start)
+        if expected is None:
+            expected = len(kept)
+        seconds = min(timings)
+        print("{0:>10}: {1} rows in {2:.3f}s, {3:,.0f} rows/s, {4} kept "
+              "({5} wrongly dropped), {6:,.1f} MB".format(
+                  name, len(documents), seconds, len(documents) / seconds,
+                  len(kept), expected - len(kept), size / 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Compare keeping a tenth of the departments with a `Filter` at the end of the
+example chain, after `AggregateKey` and `ComputeIdFrom`, with filtering as
+soon as the department is known, by hand or by `load_pipeline(...,
+optimise=True)`. Checks that all three give the same documents.
+
+    python benchmarks/bench_filter.py [rows]
+"""
+
+from __future__ import print_function
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import load_pipeline
+from backdrop.collector.plugins.department import try_get_department
+
+from documents import ga_documents
+
+
+KEPT = sorted(set(try_get_department("<D{0}>".format(i))
+                  for i in range(1, 13)))
+FILTER = "Filter('department', 'in', {0!r})".format(KEPT)
+
+CHAIN = [
+    "ComputeDepartmentKey('customVarValue9')",
+    "RemoveKey('customVarValue9', 'visits', 'bounceRate')",
+    "AggregateKey(aggregate_count('visitors'))",
+    "ComputeIdFrom('_timestamp', 'timeSpan', 'dataType', 'department')",
+]
+
+
+def best_of(repeat, pipeline, documents):
+    timings = []
+    for _ in range(repeat):
+        fresh = copy.deepcopy(documents)
+        start = time.time()
+        output = pipeline(fresh)
+        timings.append(time.time() - start)
+    return min(timings), output
+
+
+def main(rows=100000, repeat=3):
+    documents = ga_documents(rows)
+
+    cases = [
+        ("filter last", load_pipeline(CHAIN + [FILTER])),
+        ("filter first", load_pipeline(CHAIN[:1] + [FILTER] + CHAIN[1:])),
+        ("optimised", load_pipeline(CHAIN + [FILTER], optimise=True)),
+    ]
+
+    expected = None
+    for name, pipeline in cases:
+        seconds, output = best_of(repeat, pipeline, documents)
+        if expected is None:
+            expected = output
+        assert output == expected, "{0} gives different output".format(name)
+        print("{0:>12}: {1} rows in {2:.3f}s, {3:,.0f} rows/s, {4} out".format(
+            name, rows, seconds, rows / seconds, len(output)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,69 @@
+"""
+Compare the README example chain run plugin by plugin against the same chain
+with adjacent row-wise plugins fused by `compile_plugins`.
+
+    python benchmarks/bench_fusion.py [rows]
+"""
+
+from __future__ import print_function
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import load_plugins
+from backdrop.collector.plugins.load_plugin import compile_plugins
+
+from documents import ga_documents
+
+
+README_CHAIN = [
+    "ComputeDepartmentKey('customVarValue9')",
+    "Comment('customVarValue9 must be removed from the document before "
+    "aggregation')",
+    "RemoveKey('customVarValue9', 'visits', 'bounceRate')",
+    "AggregateKey(aggregate_count('visitors'))",
+    "ComputeIdFrom('_timestamp', 'timeSpan', 'dataType', 'department')",
+]
+
+ROW_WISE_CHAIN = [
+    "ComputeDepartmentKey('customVarValue9')",
+    "RemoveKey('customVarValue9')",
+    "ComputeIdFrom('_timestamp', 'timeSpan', 'dataType', 'department')",
+]
+
+
+def run(plugins, documents):
+    for plugin in plugins:
+        documents = plugin(documents)
+    return documents
+
+
+def best_of(repeat, plugins, documents):
+    timings = []
+    for _ in range(repeat):
+        fresh = copy.deepcopy(documents)
+        start = time.time()
+        run(plugins, fresh)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(rows=100000, repeat=3):
+    documents = ga_documents(rows)
+
+    for name, chain in [("readme", README_CHAIN),
+                        ("row-wise", ROW_WISE_CHAIN)]:
+        separate = best_of(repeat, load_plugins(chain), documents)
+        fused = best_of(repeat, compile_plugins(load_plugins(chain)),
+                        documents)
+        print("{0:>10}: {1} rows, separate {2:.3f}s, fused {3:.3f}s, "
+              "speed-up {4:.2f}x".format(name, rows, separate, fused,
+                                         separate / fused))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,73 @@
+"""
+Time how long a fresh collector process takes to import the plugins and load
+its configuration, for a configuration which only removes a key, for the
+example chain, and for importing every plugin module up front as the package
+used to.
+
+    python benchmarks/bench_import.py [repeat]
+
+Each case runs in a new interpreter, and the best of `repeat` runs is shown.
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+MODULES = ["aggregate", "columnar", "comment", "compute_id", "department",
+           "instrument", "load_plugin", "parallel", "pipeline", "rank",
+           "record", "remove_key"]
+
+CASES = [
+    ("RemoveKey only",
+     "from backdrop.collector.plugins import load_pipeline\n"
+     "load_pipeline(['RemoveKey(\"visits\")'])"),
+    ("example chain",
+     "from backdrop.collector.plugins import load_pipeline\n"
+     "load_pipeline(['ComputeDepartmentKey(\"customVarValue9\")',\n"
+     "               'AggregateKey(aggregate_count(\"visitors\"))',\n"
+     "               'ComputeIdFrom(\"_timestamp\", \"department\")'])"),
+    ("every module",
+     "import importlib\n"
+     "for name in {0!r}:\n"
+     "    importlib.import_module('backdrop.collector.plugins.' + name)\n"
+     "try:\n"
+     "    import numpy\n"
+     "except ImportError:\n"
+     "    pass".format(MODULES)),
+]
+
+TEMPLATE = """
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.time()
+{code}
+print(time.time() - start)
+print(' '.join(sorted(name for name, module in sys.modules.items()
+                      if name.startswith('backdrop.collector.plugins.') and
+                      module is not None)))
+"""
+
+
+def time_case(code, repeat):
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", TEMPLATE.format(root=ROOT, code=code)])
+        seconds, modules = output.decode("ascii").split("\n")[:2]
+        timings.append(float(seconds))
+    return min(timings), modules.split()
+
+
+def main(repeat=5):
+    for name, code in CASES:
+        seconds, modules = time_case(code, repeat)
+        print("{0:>15}: {1:6.1f}ms, {2} plugin modules imported".format(
+            name, seconds * 1000, len(modules)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
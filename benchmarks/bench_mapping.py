@@ -0,0 +1,91 @@
+"""
+Compare loading the department table from the literal in `department.py`,
+from JSON and CSV files, and from the marshal file they are compiled to, and
+the speed of looking codes up in each.
+
+    python benchmarks/bench_mapping.py [lookups]
+"""
+
+from __future__ import print_function
+
+import csv
+import json
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import ComputeDepartmentKey, ComputeDepartments
+from backdrop.collector.plugins.department import DEPARTMENT_MAPPING
+from backdrop.collector.plugins.department_mapping import (COMPILED_SUFFIX,
+                                                           MappingFile)
+
+from documents import ga_documents
+
+
+def write_files(directory):
+    paths = {}
+    paths["json"] = os.path.join(directory, "departments.json")
+    with open(paths["json"], "w") as f:
+        json.dump(DEPARTMENT_MAPPING, f)
+    paths["csv"] = os.path.join(directory, "departments.csv")
+    with open(paths["csv"], "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["code", "department"])
+        writer.writerows(sorted(DEPARTMENT_MAPPING.items()))
+    return paths
+
+
+def best_of(function, number=200):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main(lookups=1000000):
+    directory = tempfile.mkdtemp()
+    try:
+        paths = write_files(directory)
+        literal = compile(repr(DEPARTMENT_MAPPING), "<literal>", "eval")
+        MappingFile(paths["json"])
+        (compiled,) = [name for name in os.listdir(directory)
+                       if name.endswith(COMPILED_SUFFIX)]
+
+        def load_compiled():
+            with open(os.path.join(directory, compiled), "rb") as f:
+                return marshal.load(f)
+
+        def parse_json():
+            with open(paths["json"]) as f:
+                return json.load(f)
+
+        loads = [
+            ("literal dict", lambda: eval(literal)),
+            ("json.load", parse_json),
+            ("MappingFile csv", lambda: MappingFile(paths["csv"]).mapping),
+            ("MappingFile json", lambda: MappingFile(paths["json"]).mapping),
+            ("marshal.load", load_compiled),
+        ]
+        for name, load in loads:
+            assert load() == DEPARTMENT_MAPPING, name
+            print("{0:>20}: {1:8.1f} us to load {2} codes".format(
+                name, best_of(load) * 1e6, len(DEPARTMENT_MAPPING)))
+
+        documents = ga_documents(lookups)
+        for name, mapping in [("built in", None), ("from file",
+                                                   paths["json"])]:
+            for plugin in [ComputeDepartmentKey("customVarValue9",
+                                                mapping=mapping),
+                           ComputeDepartments("customVarValue9",
+                                              mapping=mapping)]:
+                seconds = best_of(lambda: plugin(documents), number=1)
+                print("{0:>20}: {1:>11,.0f} rows/s with {2} table".format(
+                    type(plugin).__name__, lookups / seconds, name))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+"""
+Compare the memory used by GA-shaped documents held as dicts with the same
+documents held as interned records.
+
+    python benchmarks/bench_records.py [rows]
+
+Each representation is built in a forked child; memory is the growth of its
+peak resident set size while building.
+"""
+
+from __future__ import print_function
+
+import gc
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import record_type, records
+
+from documents import ga_documents, iter_ga_documents
+
+
+KEYS = ["_timestamp", "timeSpan", "dataType", "customVarValue9", "visitors",
+        "visits", "bounceRate", "department", "_id", "humanId"]
+
+
+def as_dicts(rows):
+    return ga_documents(rows)
+
+
+def as_records(rows):
+    # The same documents as `as_dicts`, converted as they are generated so
+    # that the dicts do not all exist at once
+    return records(record_type(KEYS), iter_ga_documents(rows))
+
+
+def measure(build, rows, send):
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    documents = build(rows)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    send.send((seconds, (after - before) * 1024, len(documents)))
+
+
+def main(rows=1000000):
+    for build in [as_dicts, as_records]:
+        receive, send = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=measure,
+                                          args=(build, rows, send))
+        process.start()
+        seconds, growth, count = receive.recv()
+        process.join()
+        print("{0:>10}: {1} rows in {2:.1f}s, {3:.1f} MiB, {4:.0f} bytes "
+              "per row".format(build.__name__, count, seconds,
+                               growth / 2.0 ** 20, growth / float(count)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""
+Synthetic documents shaped like the rows backdrop-ga-collector produces.
+"""
+
+import datetime
+import random
+
+import pytz
+
+
+def ga_documents(count, seed=0, departments=300, timestamps=4, pages=0):
+    """
+    Return `count` GA-shaped documents, generated reproducibly from `seed`.
+
+    `departments` is the number of distinct `customVarValue9` strings (each
+    holds one to three department codes), `timestamps` the number of distinct
+    weekly `_timestamp`s, and if `pages` is non-zero each document also gets
+    one of that many distinct `pagePath`s.
+    """
+    return list(iter_ga_documents(count, seed, departments, timestamps,
+                                  pages))
+
+
+def iter_ga_documents(count, seed=0, departments=300, timestamps=4, pages=0):
+    """
+    Generate the documents `ga_documents` returns one at a time.
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2013, 10, 7, tzinfo=pytz.UTC)
+    weeks = [start + datetime.timedelta(weeks=i) for i in range(timestamps)]
+    codes = ["<D{0}>".format(i) for i in range(1, 120)]
+    department_codes = ["".join(rng.sample(codes, rng.randint(1, 3)))
+                        for _ in range(departments)]
+    page_paths = ["/government/publications/{0}".format(i)
+                  for i in range(pages)]
+
+    def document():
+        visits = rng.randint(1, 1000)
+        doc = {"_timestamp": rng.choice(weeks),
+               "timeSpan": "week",
+               "dataType": "content_dashboard_visitors_count",
+               "customVarValue9": rng.choice(department_codes),
+               "visitors": rng.randint(1, visits),
+               "visits": visits,
+               "bounceRate": rng.randint(0, 100) / 100.0}
+        if page_paths:
+            doc["pagePath"] = rng.choice(page_paths)
+        return doc
+
+    for _ in range(count):
+        yield document()
@@ -0,0 +1,284 @@
+"""
+Time every plugin, and the README example chain, over synthetic GA-shaped
+documents, and compare throughput with the numbers in `baselines.json`.
+
+    python benchmarks/run.py [--sizes 1000,100000,1000000] [--only NAME]
+                             [--tolerance 0.25] [--save]
+
+Each case runs in a forked child process so that its peak memory can be
+measured on its own, and is repeated at least `MIN_REPEATS` times and until
+`MIN_SECONDS` of runs have been timed; the best run counts. Cases too fast
+to time that long within `MAX_SECONDS` are reported but neither compared nor
+saved. A case which seems more than `tolerance` slower (in rows per second)
+than its baseline is measured again, and the run exits non-zero if it still
+is; `--save` records the current numbers as the new baselines instead.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from backdrop.collector.plugins import (
+    ColumnBatch, ParallelExecutor, load_pipeline, load_plugins)
+from backdrop.collector.plugins.load_plugin import compile_plugins
+from backdrop.collector.plugins.parallel import fork_context
+
+from documents import ga_documents
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "baselines.json")
+
+# Time spent in the plugins for a case to be compared with its baseline, the
+# fewest runs, and the most time to spend on a case, copying documents
+# included
+MIN_SECONDS = 1.0
+MIN_REPEATS = 5
+MAX_SECONDS = 30.0
+# Times a case which seems to have regressed is measured again
+RETRIES = 2
+
+timer = getattr(time, "perf_counter", time.time)
+
+# The README's example, with the metrics it does not query removed as well
+README_CHAIN = [
+    "ComputeDepartmentKey('customVarValue9')",
+    "Comment('customVarValue9 must be removed from the document before "
+    "aggregation')",
+    "RemoveKey('customVarValue9', 'visits', 'bounceRate')",
+    "AggregateKey(aggregate_count('visitors'))",
+    "ComputeIdFrom('_timestamp', 'timeSpan', 'dataType', 'department')",
+]
+
+# name -> plugin strings, run one after the other
+CASES = [
+    ("AggregateKey", ["AggregateKey(aggregate_count('visits'), "
+                      "aggregate_count('visitors'), "
+                      "aggregate_rate('bounceRate', 'visits'))"]),
+    ("Comment", ["Comment('nothing to see here')"]),
+    ("ComputeDepartmentKey", ["ComputeDepartmentKey('customVarValue9')"]),
+    ("ComputeDepartments", ["ComputeDepartments('customVarValue9')"]),
+    ("ComputeIdFrom", ["ComputeIdFrom('_timestamp', 'timeSpan', 'dataType', "
+                       "'customVarValue9')"]),
+    ("ComputeRank", ["ComputeRank('rank')"]),
+    ("Deduplicate", ["Deduplicate('customVarValue9')"]),
+    ("Deduplicate-bloom", ["Deduplicate('customVarValue9', strategy='bloom', "
+                           "capacity=1000000)"]),
+    ("ExplodeDepartments", ["ExplodeDepartments('customVarValue9')"]),
+    ("Filter", ["Filter('visits', '>', 500)"]),
+    ("RemoveKey", ["RemoveKey('customVarValue9')"]),
+    ("SetDepartment", ["SetDepartment('<D1>')"]),
+    ("SortBy", ["SortBy('customVarValue9', 'visits')"]),
+    ("TopN", ["TopN('visits', 10, partition_by='customVarValue9')"]),
+    ("readme-chain", README_CHAIN),
+]
+
+
+def load_parallel(plugin_names):
+    return ParallelExecutor(compile_plugins(load_plugins(plugin_names)))
+
+
+def load_columnar(plugin_names):
+    plugins = load_plugins(plugin_names)
+
+    def run(documents):
+        batch = ColumnBatch.from_documents(documents)
+        for plugin in plugins:
+            batch = plugin(batch)
+        return batch.to_documents()
+
+    return run
+
+
+def load_streamed(plugin_names):
+    pipeline = load_pipeline(plugin_names)
+
+    def run(documents):
+        # Discard the output as it is made, so only the stages' own memory
+        # is counted
+        for _ in pipeline.run(documents):
+            pass
+
+    return run
+
+
+# name -> (function from plugin strings to a single plugin, plugin strings)
+LOADERS = {
+    "readme-pipeline": (load_pipeline, README_CHAIN),
+    "readme-parallel": (load_parallel, README_CHAIN),
+    "readme-columnar": (load_columnar, README_CHAIN),
+    "AggregateKey-columnar": (load_columnar, CASES[0][1]),
+    # 1200 groups, spilled to disk past 200
+    "AggregateKey-spill": (load_streamed,
+                           ["AggregateKey(aggregate_count('visits'), "
+                            "aggregate_count('visitors'), "
+                            "aggregate_rate('bounceRate', 'visits'), "
+                            "max_groups=200)"]),
+    # Spills sorted runs to disk past 50k rows
+    "SortBy-spill": (load_streamed,
+                     ["SortBy('customVarValue9', 'visits', "
+                      "memory_limit=50000)"]),
+}
+
+
+def chain(plugin_names):
+    plugins = load_plugins(plugin_names)
+
+    def run(documents):
+        for plugin in plugins:
+            documents = plugin(documents)
+        return documents
+
+    return run
+
+
+def all_cases():
+    cases = [(name, chain, plugin_names) for name, plugin_names in CASES]
+    cases.extend((name, loader, plugin_names)
+                 for name, (loader, plugin_names) in sorted(LOADERS.items()))
+    return cases
+
+
+def measure(load, plugin_names, documents):
+    """
+    Return `(seconds, timed, peak_bytes)`: the peak memory of one run of the
+    loaded plugins, and then the best of repeated runs and their total time.
+    """
+    plugin, copy = prepare(load, plugin_names, documents)
+    if tracemalloc is not None:
+        tracemalloc.start()
+        plugin(copy)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        # ru_maxrss is in kilobytes on Linux: report the growth of the peak
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        plugin(copy)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = (after - before) * 1024
+    del plugin, copy
+
+    started = timer()
+    timings = []
+    while ((sum(timings) < MIN_SECONDS or len(timings) < MIN_REPEATS) and
+           timer() - started < MAX_SECONDS):
+        plugin, copy = prepare(load, plugin_names, documents)
+        # As timeit does, so that collections of earlier garbage do not
+        # land in the middle of a run
+        gc.disable()
+        try:
+            start = timer()
+            plugin(copy)
+            timings.append(timer() - start)
+        finally:
+            gc.enable()
+    return min(timings), sum(timings), peak
+
+
+def prepare(load, plugin_names, documents):
+    """
+    Load the plugins and copy `documents`, so that neither copy-on-write of
+    the parent's pages nor an earlier run's changes are counted.
+    """
+    plugin = load(plugin_names)
+    documents = [dict(document) for document in documents]
+    gc.collect()
+    return plugin, documents
+
+
+def measure_in_child(load, plugin_names, documents):
+    """
+    Fork, so that the case has its own peak memory and mutating `documents`
+    does not affect the next case.
+    """
+    context = fork_context()
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(target=measure_and_send,
+                              args=(send, load, plugin_names, documents))
+    process.start()
+    result = receive.recv()
+    process.join()
+    return result
+
+
+def measure_and_send(send, load, plugin_names, documents):
+    send.send(measure(load, plugin_names, documents))
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES):
+        return {}
+    with open(BASELINES) as baselines:
+        return json.load(baselines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--only", action="append", default=[])
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save", action="store_true")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cases = [case for case in all_cases()
+             if not args.only or case[0] in args.only]
+    baselines = load_baselines()
+    regressions = []
+
+    for size in sizes:
+        documents = ga_documents(size)
+
+        for name, load, plugin_names in cases:
+            seconds, timed, peak = measure_in_child(load, plugin_names,
+                                                    documents)
+            rate = size / max(seconds, 1e-9)
+
+            baseline = baselines.get(name, {}).get(str(size))
+            retries = RETRIES if baseline is not None and not args.save else 0
+            while retries and rate < baseline * (1 - args.tolerance):
+                again, _, _ = measure_in_child(load, plugin_names, documents)
+                rate = max(rate, size / max(again, 1e-9))
+                retries -= 1
+
+            if timed < MIN_SECONDS:
+                verdict = "too fast to time ({0:.1f} us a run)".format(
+                    seconds * 1e6)
+            elif args.save:
+                baselines.setdefault(name, {})[str(size)] = round(rate)
+                verdict = "saved"
+            elif baseline is None:
+                verdict = "no baseline"
+            elif rate < baseline * (1 - args.tolerance):
+                verdict = "REGRESSION ({0:.0%} of baseline)".format(
+                    rate / baseline)
+                regressions.append((name, size))
+            else:
+                verdict = "ok ({0:.0%} of baseline)".format(rate / baseline)
+
+            print("{0:>22} {1:>8} rows {2:>12,.0f} rows/s {3:>8.1f} MiB peak"
+                  "  {4}".format(name, size, rate, peak / 2.0 ** 20, verdict))
+
+    if args.save:
+        with open(BASELINES, "w") as output:
+            json.dump(baselines, output, indent=2, sort_keys=True)
+            output.write("\n")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())